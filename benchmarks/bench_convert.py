@@ -0,0 +1,56 @@
+"""
+Throughput of the conversions over the benchmark corpus, in messages per second.
+
+The hierarchical JSON form (hl7validator.hl7json) is measured sliced only, and
+encoded as JSON and as MessagePack (when msgpack is installed), next to the
+CSV conversion it complements.
+
+    python benchmarks/bench_convert.py [--repeat N] [--output results.json]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_corpus, measure, report  # noqa: E402
+from hl7validator import hl7json  # noqa: E402
+from hl7validator.api import from_hl7_to_df  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    logging.getLogger("hl7validator").setLevel(logging.CRITICAL)
+
+    conversions = {
+        "json-document": hl7json.to_json,
+        "json": lambda msg: hl7json.encoder("json")(hl7json.to_json(msg)),
+    }
+    if hl7json.msgpack is not None:
+        conversions["msgpack"] = lambda msg: hl7json.encoder("msgpack")(hl7json.to_json(msg))
+    # the CSV file is written to the working directory
+    os.chdir(tempfile.mkdtemp())
+    conversions["csv"] = from_hl7_to_df
+
+    corpus = load_corpus()
+    results = {}
+    for name, convert in conversions.items():
+        results[name] = {}
+        for file, msg in corpus.items():
+            repeat = max(args.repeat // 20, 5) if name == "csv" else args.repeat
+            stats = measure(lambda: convert(msg), repeat)
+            stats["messages_per_s"] = round(1000 / stats["p50_ms"]) if stats["p50_ms"] else None
+            results[name][file] = stats
+    report(results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
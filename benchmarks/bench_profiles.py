@@ -0,0 +1,57 @@
+"""
+Latency of each validation profile over the benchmark corpus.
+
+Every profile has a p95 latency target per message; the script exits with a
+non-zero status when a target is missed so it can run in CI.
+
+    python benchmarks/bench_profiles.py [--repeat N] [--output results.json]
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_corpus, measure, report  # noqa: E402
+from hl7validator.api import hl7validatorapi, VALIDATION_PROFILES  # noqa: E402
+
+# p95 latency target per message, in milliseconds
+PROFILE_TARGETS_MS = {
+    "header": 1,
+    "parse-only": 100,
+    "structure": 250,
+    "full": 1000,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    logging.getLogger("hl7validator").setLevel(logging.CRITICAL)
+
+    corpus = load_corpus()
+    results = {}
+    missed = []
+    for profile in VALIDATION_PROFILES:
+        target = PROFILE_TARGETS_MS[profile]
+        results[profile] = {"target_p95_ms": target, "messages": {}}
+        for name, msg in corpus.items():
+            stats = measure(lambda: hl7validatorapi(msg, validation_profile=profile), args.repeat)
+            stats["within_target"] = stats["p95_ms"] <= target
+            results[profile]["messages"][name] = stats
+            if not stats["within_target"]:
+                missed.append(f"{profile}/{name}")
+    report(results, args.output)
+    if missed:
+        print("Latency targets missed: " + ", ".join(missed), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+"""Helpers shared by the benchmark scripts."""
+
+import glob
+import json
+import os
+import statistics
+import time
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def load_corpus(path=CORPUS_DIR):
+    """Return {name: message} for every .hl7 file in the corpus directory."""
+    corpus = {}
+    for file in sorted(glob.glob(os.path.join(path, "*.hl7"))):
+        with open(file, newline="") as f:
+            corpus[os.path.basename(file)] = f.read()
+    return corpus
+
+
+def measure(fn, repeat):
+    """Call fn() repeat times and return latency percentiles in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+def report(results, output=None):
+    """Print results as JSON and optionally write them to a file."""
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
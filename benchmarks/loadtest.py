@@ -0,0 +1,338 @@
+"""
+Capacity curve of a server configuration: throughput against latency at increasing concurrency.
+
+Starts docker/gunicorn.sh with the given GUNICORN_WORKERS / GUNICORN_THREADS (or
+targets a running instance with --url), waits for /readyz, then replays a corpus
+against /api/hl7/v1/validate/ with 1, 2, 4... closed-loop clients, each sending
+its next message as soon as it gets an answer. Every level reports throughput and
+latency percentiles; the saturation point is the last level before the p99
+latency degrades (over --p99-factor times the p99 of the first level) or the
+throughput stops growing (under --min-gain).
+
+    python benchmarks/loadtest.py --workers 2 --threads 2 --output capacity.json --chart capacity.svg
+    python benchmarks/loadtest.py --url http://staging:80 --corpus /archive/captured/ --duration 30
+
+Messages are replayed as they are: captured traffic gives realistic hit rates
+of the per-segment result cache, the bundled corpus (four messages) mostly hits.
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import CORPUS_DIR  # noqa: E402
+from hl7validator.profiler import read_messages  # noqa: E402
+
+VALIDATE_PATH = "/api/hl7/v1/validate/"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    """Run docker/gunicorn.sh on a free local port; logs go to a temporary directory."""
+    port = free_port()
+    env = dict(
+        os.environ,
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_BIND=f"127.0.0.1:{port}",
+        HL7VALIDATOR_SERVER_MODE=args.server_mode,
+        PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])),
+    )
+    workdir = tempfile.mkdtemp(prefix="hl7validator-loadtest-")
+    with open(os.path.join(workdir, "server.log"), "wb") as log:
+        process = subprocess.Popen(
+            ["sh", os.path.join(ROOT, "docker", "gunicorn.sh")],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+        )
+    return process, workdir, f"http://127.0.0.1:{port}"
+
+
+def server_log(workdir, lines=20):
+    """Last lines of the output and error log of a started server."""
+    text = ""
+    for name in ("server.log", os.path.join("logs", "message_validation.log")):
+        try:
+            with open(os.path.join(workdir, name), errors="replace") as f:
+                text += "".join(f.readlines()[-lines:])
+        except OSError:
+            pass
+    return text
+
+
+def stop_server(process, workdir):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def wait_ready(url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The server exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/readyz", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} was not ready within {timeout:g} s")
+
+
+class Client(threading.Thread):
+    """Closed-loop client: one request at a time over a kept-alive connection."""
+
+    def __init__(self, url, bodies, offset, stop):
+        super().__init__(daemon=True)
+        parts = urllib.parse.urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.bodies = bodies
+        self.offset = offset
+        self.stop = stop
+        self.latencies = []
+        self.errors = {}
+
+    def run(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        index = self.offset
+        while not self.stop.is_set():
+            body = self.bodies[index % len(self.bodies)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                connection.request(
+                    "POST", VALIDATE_PATH, body, {"Content-Type": "application/json"}
+                )
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException) as err:
+                status = type(err).__name__
+                connection.close()
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            elapsed = (time.perf_counter() - start) * 1000
+            if self.stop.is_set():
+                break
+            if status == 200:
+                self.latencies.append(elapsed)
+            else:
+                self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+        connection.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def run_level(url, bodies, concurrency, duration, warmup):
+    stop = threading.Event()
+    clients = [Client(url, bodies, i * 7919, stop) for i in range(concurrency)]
+    for client in clients:
+        client.start()
+    time.sleep(warmup)
+    for client in clients:
+        client.latencies.clear()
+        client.errors.clear()
+    start = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    errors = {}
+    for client in clients:
+        for status, count in client.errors.items():
+            errors[status] = errors.get(status, 0) + count
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "messages_per_s": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies), 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "max_ms": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def saturation_point(levels, p99_factor, min_gain):
+    """
+    Last level before the p99 latency degrades or the throughput stops growing.
+    :return: (level, reason), level None when the first level is already degraded
+    """
+    baseline = levels[0]["p99_ms"]
+    best = None
+    for level in levels:
+        if level["p99_ms"] is None or level["errors"]:
+            return best, f"errors at concurrency {level['concurrency']}"
+        if level["p99_ms"] > baseline * p99_factor:
+            return best, f"p99 over {p99_factor:g}x the baseline at concurrency {level['concurrency']}"
+        if best is not None and level["messages_per_s"] < best["messages_per_s"] * (1 + min_gain):
+            return best, (
+                f"throughput grew less than {min_gain:.0%} at concurrency {level['concurrency']}"
+            )
+        best = level
+    return best, "not reached: try higher concurrency levels"
+
+
+def chart(levels, saturation, title):
+    """SVG chart of p99 and p50 latency against throughput, one point per concurrency level."""
+    points = [level for level in levels if level["p99_ms"] is not None]
+    width, height, margin = 640, 400, 60
+    max_x = max([level["messages_per_s"] for level in points] + [1]) * 1.1
+    max_y = max([level["p99_ms"] for level in points] + [1]) * 1.1
+
+    def xy(level, key):
+        x = margin + level["messages_per_s"] / max_x * (width - 2 * margin)
+        y = height - margin - level[key] / max_y * (height - 2 * margin)
+        return x, y
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="sans-serif" font-size="11">',
+        f'<text x="{width / 2}" y="20" text-anchor="middle" font-size="14">{title}</text>',
+        f'<line x1="{margin}" y1="{height - margin}" x2="{width - margin}" y2="{height - margin}" stroke="black"/>',
+        f'<line x1="{margin}" y1="{margin}" x2="{margin}" y2="{height - margin}" stroke="black"/>',
+        f'<text x="{width / 2}" y="{height - 20}" text-anchor="middle">messages/s</text>',
+        f'<text x="15" y="{height / 2}" transform="rotate(-90 15 {height / 2})" '
+        f'text-anchor="middle">latency (ms)</text>',
+    ]
+    for tick in range(5):
+        x = margin + tick / 4 * (width - 2 * margin)
+        y = height - margin - tick / 4 * (height - 2 * margin)
+        parts.append(f'<text x="{x}" y="{height - margin + 15}" text-anchor="middle">{max_x * tick / 4:.0f}</text>')
+        parts.append(f'<text x="{margin - 5}" y="{y + 4}" text-anchor="end">{max_y * tick / 4:.0f}</text>')
+    for key, color in (("p99_ms", "#c0392b"), ("p50_ms", "#2471a3")):
+        line = " ".join(f"{x:.1f},{y:.1f}" for x, y in (xy(level, key) for level in points))
+        parts.append(f'<polyline points="{line}" fill="none" stroke="{color}" stroke-width="2"/>')
+        for level in points:
+            x, y = xy(level, key)
+            parts.append(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="3" fill="{color}"/>')
+            if key == "p99_ms":
+                parts.append(f'<text x="{x + 5:.1f}" y="{y - 5:.1f}">c={level["concurrency"]}</text>')
+        parts.append(
+            f'<text x="{width - margin}" y="{margin + (15 if key == "p50_ms" else 0)}" '
+            f'text-anchor="end" fill="{color}">{key[:3]}</text>'
+        )
+    if saturation is not None:
+        x, _ = xy(saturation, "p99_ms")
+        parts.append(
+            f'<line x1="{x:.1f}" y1="{margin}" x2="{x:.1f}" y2="{height - margin}" '
+            f'stroke="gray" stroke-dasharray="4"/>'
+        )
+        parts.append(f'<text x="{x + 4:.1f}" y="{margin + 30}" fill="gray">saturation</text>')
+    parts.append("</svg>")
+    return "\n".join(parts) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="running instance to test (default: start docker/gunicorn.sh)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("GUNICORN_WORKERS", "2")))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("GUNICORN_THREADS", "2")))
+    parser.add_argument(
+        "--server-mode", default=os.getenv("HL7VALIDATOR_SERVER_MODE", "wsgi"),
+        choices=("wsgi", "asgi"),
+    )
+    parser.add_argument(
+        "--corpus", nargs="+", default=[CORPUS_DIR],
+        help="message files or directories (captured traffic), default: the benchmark corpus",
+    )
+    parser.add_argument(
+        "--concurrency", default="1,2,4,8,16,32", help="comma separated client counts"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds measured per level")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds before each measure")
+    parser.add_argument("--p99-factor", type=float, default=2.0)
+    parser.add_argument("--min-gain", type=float, default=0.05)
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--output", help="JSON report file")
+    parser.add_argument("--chart", help="SVG chart file")
+    args = parser.parse_args()
+
+    bodies = [json.dumps({"data": msg}).encode("utf-8") for msg in read_messages(args.corpus)]
+    if not bodies:
+        parser.error("no messages in the corpus")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    process = workdir = None
+    url = args.url
+    if url is None:
+        process, workdir, url = start_server(args)
+    try:
+        try:
+            wait_ready(url, args.ready_timeout, process)
+        except RuntimeError:
+            if workdir is not None:
+                sys.stderr.write(server_log(workdir))
+            raise
+        results = []
+        for concurrency in levels:
+            result = run_level(url, bodies, concurrency, args.duration, args.warmup)
+            results.append(result)
+            print(
+                f"concurrency {concurrency:>4}  {result['messages_per_s']:>9.1f} msg/s  "
+                f"p50 {result['p50_ms'] or math.nan:>9.1f} ms  p99 {result['p99_ms'] or math.nan:>9.1f} ms  "
+                f"errors {sum(result['errors'].values())}",
+                file=sys.stderr,
+            )
+    finally:
+        if process is not None:
+            stop_server(process, workdir)
+
+    saturation, reason = saturation_point(results, args.p99_factor, args.min_gain)
+    report = {
+        "target": url if args.url else {
+            "GUNICORN_WORKERS": args.workers,
+            "GUNICORN_THREADS": args.threads,
+            "HL7VALIDATOR_SERVER_MODE": args.server_mode,
+        },
+        "messages": len(bodies),
+        "duration_s": args.duration,
+        "levels": results,
+        "saturation": dict(saturation or {}, reason=reason),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.chart:
+        title = (
+            f"{args.workers} workers x {args.threads} threads ({args.server_mode})"
+            if not args.url else args.url
+        )
+        with open(args.chart, "w") as f:
+            f.write(chart(results, saturation, title))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
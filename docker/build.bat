@@ -154,6 +154,17 @@ if not errorlevel 1 (
 )
 echo.
 
+REM Precompress the static files, shipped in the wheel next to them
+echo Compressing static files...
+python -m pip install --user --quiet brotli >nul 2>&1
+python -m hl7validator build-static >nul
+if errorlevel 1 (
+    echo [WARNING] Static files not compressed, they will be compressed per request
+) else (
+    echo [OK] Static files compressed
+)
+echo.
+
 REM Build wheel package
 echo Building wheel package...
 python --version >nul 2>&1
@@ -150,6 +150,16 @@ else
 fi
 echo ""
 
+# Precompress the static files, shipped in the wheel next to them
+echo -e "${GREEN}Compressing static files...${NC}"
+(cd "$PROJECT_ROOT" && python3 -m pip install --user --quiet brotli 2>/dev/null || true)
+if (cd "$PROJECT_ROOT" && python3 -m hl7validator build-static > /dev/null); then
+    echo -e "${GREEN}✓ Static files compressed${NC}"
+else
+    echo -e "${YELLOW}⚠ Static files not compressed, they will be compressed per request${NC}"
+fi
+echo ""
+
 # Build wheel package
 echo -e "${GREEN}Building wheel package...${NC}"
 if command -v python3 &> /dev/null; then
@@ -15,27 +15,27 @@ fi
 ACCESS_LOG="$LOG_DIR/access.log"
 ERROR_LOG="$LOG_DIR/message_validation.log"
 
-# Get number of workers from environment or default to 2
-WORKERS="${GUNICORN_WORKERS:-2}"
-THREADS="${GUNICORN_THREADS:-2}"
-BIND_ADDRESS="${GUNICORN_BIND:-0.0.0.0:80}"
-LOG_LEVEL="${GUNICORN_LOG_LEVEL:-info}"
+# Workers, threads, timeouts, worker recycling and the memory watchdog are set by
+# hl7validator/gunicorn_conf.py: sized from the CPUs and memory limit of the container,
+# each overridable with its GUNICORN_* variable (GUNICORN_WORKERS, GUNICORN_THREADS,
+# GUNICORN_BIND, GUNICORN_LOG_LEVEL, GUNICORN_MAX_REQUESTS, GUNICORN_MAX_WORKER_RSS...)
+# "wsgi" (default) runs threaded workers, "asgi" runs uvicorn workers with a process pool
+SERVER_MODE="${HL7VALIDATOR_SERVER_MODE:-wsgi}"
 
 echo "Starting HL7 V2 Validator..."
-echo "Workers: $WORKERS"
-echo "Threads per worker: $THREADS"
-echo "Binding to: $BIND_ADDRESS"
-echo "Log level: $LOG_LEVEL"
+echo "Server mode: $SERVER_MODE"
+python3 -m hl7validator.gunicorn_conf
 
-# Start gunicorn with configurable settings
+if [ "$SERVER_MODE" = "asgi" ]; then
+    # Event loop workers; validation runs on HL7VALIDATOR_POOL_WORKERS processes
+    APP_MODULE="hl7validator.asgi:app"
+else
+    APP_MODULE="hl7validator:app"
+fi
+
+# Start gunicorn with the settings of the configuration module
 # Use the installed package module instead of run.py
-exec gunicorn "hl7validator:app" \
-    --workers $WORKERS \
-    --threads $THREADS \
-    --bind $BIND_ADDRESS \
+exec gunicorn "$APP_MODULE" \
+    --config python:hl7validator.gunicorn_conf \
     --access-logfile $ACCESS_LOG \
-    --error-logfile $ERROR_LOG \
-    --log-level $LOG_LEVEL \
-    --timeout 120 \
-    --graceful-timeout 30 \
-    --keep-alive 5
+    --error-logfile $ERROR_LOG
@@ -1,29 +1,269 @@
 """Main entry point for hl7validator package."""
 
-from hl7validator import app
+import argparse
+import json
 import os
-import logging
-from logging.handlers import RotatingFileHandler
+import signal
+import sys
 
+from hl7validator.logs import configure_logging
+
+
+def serve(args):
+    """Run the web application."""
+    from hl7validator.webapp import app
 
-def main():
-    """Main entry point for the application."""
     if not app.debug:
-        if not os.path.exists("logs"):
-            os.mkdir("logs")
-        file_handler = RotatingFileHandler(
-            "logs/message_validation.log", maxBytes=1_000_000, backupCount=20
+        configure_logging(
+            path=os.getenv("HL7VALIDATOR_LOG_FILE", "logs/message_validation.log")
         )
-        file_handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
+
+    app.run()
+
+
+def spool(args):
+    """Validate the files dropped in a spool directory."""
+    from hl7validator.spool import Spool
+
+    configure_logging()
+    spooler = Spool(
+        args.directory,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        validation_level=args.validation_level,
+        validation_profile=args.validation_profile,
+        results=args.results,
+        settle=args.settle,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: spooler.stop())
+    try:
+        if args.once:
+            while spooler.run_once():
+                pass
+        else:
+            spooler.serve(poll_interval=args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spooler.close()
+
+
+def feed_profile(args):
+    """Profile how the fields of a feed are filled."""
+    from hl7validator.profiler import profile_feed, read_messages
+
+    profile = profile_feed(
+        read_messages(args.paths), workers=args.workers, batch_size=args.batch_size
+    )
+    report = profile.report(top_k=args.top)
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump(report, output, ensure_ascii=False, indent=2)
+            output.write("\n")
+            return
+        output.write(f"{report['messages']} messages, {report['unparsed']} unparsed\n")
+        for entry in report["elements"]:
+            top = ", ".join(f"{value} ({count})" for value, count in entry["top"])
+            output.write(
+                f"{entry['message_type']:<12} {entry['element']:<10} {entry['datatype'] or '-':<5} "
+                f"fill {entry['fill_rate']:>7.2%}  max {entry['max_length']:>5}  "
+                f"distinct ~{entry['distinct']:<8} invalid {entry['datatype_violations']}"
+                f"/{entry['table_violations']}  {top}\n"
             )
+    finally:
+        if args.output:
+            output.close()
+
+
+def conformance(args):
+    """Report which HL7 versions sample messages conform to."""
+    import logging
+
+    from hl7validator.matrix import conformance_feed
+    from hl7validator.profiler import read_messages
+
+    # findings go to the report, not to the log
+    log_level = os.getenv("HL7VALIDATOR_LOG_LEVEL", "CRITICAL").upper()
+    logging.getLogger("hl7validator").setLevel(log_level)
+    summary = conformance_feed(
+        read_messages(args.paths),
+        versions=args.versions,
+        validation_level=args.validation_level,
+        workers=args.workers,
+        log_level=log_level,
+    )
+    report = summary.report(top=args.top)
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump(report, output, ensure_ascii=False, indent=2)
+            output.write("\n")
+            return
+        declared = ", ".join(
+            f"{version} ({count})" for version, count in report["declared"].items()
         )
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-        app.logger.setLevel(logging.INFO)
+        output.write(f"{report['messages']} messages, declared versions: {declared}\n")
+        for entry in report["versions"]:
+            rate = entry["conformance_rate"]
+            first = entry["first_errors"][0][0] if entry["first_errors"] else ""
+            output.write(
+                f"{entry['version']:<6} conforming {entry['conforming']:>6} "
+                f"({rate or 0:>7.2%})  errors {entry['errors']:>7}  "
+                f"warnings {entry['warnings']:>7}  {first}\n"
+            )
+    finally:
+        if args.output:
+            output.close()
 
-    app.run()
+
+def convert_json(args):
+    """Convert messages to their hierarchical JSON (or MessagePack) form, one at a time."""
+    from hl7validator.hl7json import convert_stream
+    from hl7validator.profiler import read_messages
+
+    documents = convert_stream(read_messages(args.paths), args.format)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for document in documents:
+            output.write(document)
+    finally:
+        if args.output:
+            output.close()
+        else:
+            output.flush()
+
+
+def build_static(args):
+    """Write the precompressed copies of the static files."""
+    from hl7validator.compression import ENCODINGS, StaticAssets
+
+    directory = args.directory or os.path.join(os.path.dirname(__file__), "static")
+    assets = StaticAssets(directory)
+    written = assets.build()
+    for path in written:
+        print(path)
+    print(
+        f"{len(assets.names)} static files, {len(written)} compressed copies written "
+        f"({', '.join(ENCODINGS)})",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None):
+    """Main entry point for the application."""
+    parser = argparse.ArgumentParser(prog="hl7validator")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="run the web application (default)")
+
+    spool_parser = commands.add_parser(
+        "spool", help="validate the files dropped in a spool directory"
+    )
+    spool_parser.add_argument(
+        "directory",
+        nargs="?",
+        default=os.getenv("HL7VALIDATOR_SPOOL_DIR"),
+        help="spool directory with inbox/, work/, done/ and failed/ "
+        "(default: HL7VALIDATOR_SPOOL_DIR)",
+    )
+    spool_parser.add_argument(
+        "--workers", type=int, help="validation processes (default: HL7VALIDATOR_POOL_WORKERS)"
+    )
+    spool_parser.add_argument("--batch-size", type=int, help="files claimed at a time")
+    spool_parser.add_argument(
+        "--validation-level", default="tolerant", choices=("tolerant", "strict", "both")
+    )
+    spool_parser.add_argument("--validation-profile", help="validation profile")
+    spool_parser.add_argument(
+        "--results", help="directory for the result files, in its done/ and failed/"
+    )
+    spool_parser.add_argument(
+        "--settle", type=float, default=0.0,
+        help="seconds a file must be left unmodified before it is claimed",
+    )
+    spool_parser.add_argument(
+        "--poll-interval", type=float, default=1.0, help="seconds between inbox rescans"
+    )
+    spool_parser.add_argument(
+        "--once", action="store_true", help="process the files present and exit"
+    )
+
+    profile_parser = commands.add_parser(
+        "feed-profile", help="report how the fields of a feed are filled"
+    )
+    profile_parser.add_argument(
+        "paths", nargs="+", help="message files or directories, - for stdin"
+    )
+    profile_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="profiling processes"
+    )
+    profile_parser.add_argument(
+        "--batch-size", type=int, default=2000, help="messages per worker job"
+    )
+    profile_parser.add_argument("--top", type=int, default=10, help="top values per element")
+    profile_parser.add_argument("--format", default="json", choices=("json", "text"))
+    profile_parser.add_argument("-o", "--output", help="report file (default: stdout)")
+
+    conformance_parser = commands.add_parser(
+        "conformance", help="report which HL7 versions sample messages conform to"
+    )
+    conformance_parser.add_argument(
+        "paths", nargs="+", help="message files or directories, - for stdin"
+    )
+    conformance_parser.add_argument(
+        "--versions", help="comma separated HL7 versions to check (default: 2.1 to 2.8)"
+    )
+    conformance_parser.add_argument(
+        "--validation-level", default="tolerant", choices=("tolerant", "strict")
+    )
+    conformance_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="checking processes"
+    )
+    conformance_parser.add_argument(
+        "--top", type=int, default=5, help="most frequent first errors per version"
+    )
+    conformance_parser.add_argument("--format", default="text", choices=("json", "text"))
+    conformance_parser.add_argument("-o", "--output", help="report file (default: stdout)")
+
+    json_parser = commands.add_parser(
+        "convert-json", help="convert messages to hierarchical JSON, one document per message"
+    )
+    json_parser.add_argument(
+        "paths", nargs="+", help="message files or directories, - for stdin"
+    )
+    json_parser.add_argument(
+        "--format", default="json", choices=("json", "msgpack"),
+        help="JSON lines, or MessagePack objects (needs the msgpack package)",
+    )
+    json_parser.add_argument("-o", "--output", help="output file (default: stdout)")
+
+    static_parser = commands.add_parser(
+        "build-static", help="write gzip/brotli copies of the static files (at build time)"
+    )
+    static_parser.add_argument(
+        "--directory", help="static directory (default: the package's static files)"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "spool":
+        if not args.directory:
+            parser.error("spool needs a directory or HL7VALIDATOR_SPOOL_DIR")
+        return spool(args)
+    if args.command == "feed-profile":
+        return feed_profile(args)
+    if args.command == "convert-json":
+        try:
+            return convert_json(args)
+        except ValueError as err:
+            parser.error(str(err))
+    if args.command == "build-static":
+        return build_static(args)
+    if args.command == "conformance":
+        try:
+            return conformance(args)
+        except ValueError as err:
+            parser.error(str(err))
+    return serve(args)
 
 
 if __name__ == "__main__":
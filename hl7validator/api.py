@@ -1,16 +1,54 @@
 from hl7apy.parser import parse_message, parse_field, parse_segment
-from hl7apy import parser
+from hl7apy import parser, check_version, get_default_version
 from hl7apy.exceptions import UnsupportedVersion
 from hl7apy.core import Field
-from hl7apy.consts import VALIDATION_LEVEL
-from flask import abort
-from hl7validator import app
+from hl7apy.consts import DEFAULT_ENCODING_CHARS, VALIDATION_LEVEL
+from hl7validator.cache import LRUCache, content_key
+from hl7validator.constraints import load_constraints, segment_report, skeleton, validate_message
+from hl7validator.logs import log_message
+from hl7validator import tables, zsegments
+import logging
 import os
 import re
-import pandas as pd
+import tempfile
 from datetime import datetime
+from html import escape
 
-classes_list = {}
+logger = logging.getLogger("hl7validator")
+
+# Per-segment validation and rendering results, keyed by a digest of the segment text,
+# so that resubmitting an edited message only re-processes the segments that changed
+segment_cache = LRUCache(int(os.getenv("HL7VALIDATOR_SEGMENT_CACHE_SIZE", "4096")))
+
+# Findings about a segment or anything inside it, e.g. "PID.PID_3", "PID_13.XTN_1" or
+# "<Segment EVN>"; findings about messages and groups do not match
+SEGMENT_FINDING = re.compile(r"<Segment |\b[A-Z][A-Z0-9]{2}(_\d+)?\.")
+
+# Validation profiles: the stages each one runs, cheapest first.
+# - header: MSH sanity checks on the raw text, no hl7apy element tree
+# - parse: the whole message parses with hl7apy
+# - structure: message structure validation against the message definition
+# - segments: per-segment and per-field validation with hl7apy
+# - tables: coded values against the HL7 and site tables (see hl7validator.tables)
+# - fields: field level checks of the web view (datetime formats, Field.validate)
+VALIDATION_PROFILES = {
+    "header": ("header",),
+    "parse-only": ("header", "parse"),
+    "structure": ("header", "parse", "structure"),
+    "full": ("header", "parse", "structure", "segments", "tables", "fields"),
+}
+
+# Engines of the per-segment stage: compiled constraint tables or hl7apy's Validator
+VALIDATION_ENGINES = ("fast", "hl7apy")
+
+# Validation levels: hl7apy's parsing levels, or both reported by one call ("both"
+# parses strictly once and tolerantly again only when the strict parse fails)
+VALIDATION_LEVELS = ("tolerant", "strict", "both")
+BOTH_LEVELS = "both"
+
+# Deployment defaults, used when a call does not choose a profile or engine
+DEFAULT_VALIDATION_PROFILE = os.getenv("HL7VALIDATOR_VALIDATION_PROFILE", "full")
+DEFAULT_VALIDATION_ENGINE = os.getenv("HL7VALIDATOR_VALIDATION_ENGINE", "fast")
 
 
 # https://blog.miguelgrinberg.com/post/designing-a-restful-api-with-python-and-flask
@@ -57,7 +95,7 @@ def set_reference(setmsg, hl7version):
     # ACK is special: structure is "ACK" not "ACK_ACK"
     if "|ACK^ACK|" in setmsg and "|ACK^ACK^" not in setmsg:
         setmsg = setmsg.replace("|ACK^ACK|", "|ACK^ACK^ACK|", 1)
-        app.logger.info(f"Auto-added MSH-9.3 for ACK message: ACK^ACK -> ACK^ACK^ACK")
+        logger.info(f"Auto-added MSH-9.3 for ACK message: ACK^ACK -> ACK^ACK^ACK")
         return setmsg
 
     # Only auto-add MSH-9.3 for v2.3.1 and earlier (where it's optional per HL7 standard)
@@ -111,11 +149,11 @@ def set_reference(setmsg, hl7version):
             old_msh9 = f"|{message_code}^{trigger_event}|"
             new_msh9 = f"|{message_code}^{trigger_event}^{structure}|"
             setmsg = setmsg.replace(old_msh9, new_msh9, 1)
-            app.logger.info(f"Auto-added MSH-9.3: {message_code}^{trigger_event} -> {message_code}^{trigger_event}^{structure}")
+            logger.info(f"Auto-added MSH-9.3: {message_code}^{trigger_event} -> {message_code}^{trigger_event}^{structure}")
         # Otherwise, let hl7apy infer it automatically (no need to add MSH-9.3)
 
     except Exception as e:
-        app.logger.error(f"Error in set_reference: {e}")
+        logger.error(f"Error in set_reference: {e}")
 
     return setmsg
 
@@ -235,65 +273,249 @@ def set_message_to_validate(msg):
         return msg
 
 
+def new_report_file():
+    """
+    Create an empty, uniquely named report file for hl7apy's validate().
+    A shared name such as report.txt would be overwritten by concurrent
+    validations running in other threads or pool processes.
+    :return: path of the report file
+    """
+    fd, report = tempfile.mkstemp(prefix="hl7report-", suffix=".txt")
+    os.close(fd)
+    return report
+
+
 def read_report(report, details, error):
     with open(report, "r") as file:
         for line in file:
-            level, message_level = line.split(":", 1)
-            if level == "Error":
-                error = True
-            app.logger.debug(f"Validation {level}: {message_level.strip()}")
-            if {
-                "level": level,
-                "message": message_level,
-            } not in details:
-                details.append(
-                    {
-                        "level": level,
-                        "message": message_level,
-                    }
-                )
+            error = _add_finding(line, details, error)
     os.remove(report)
 
     return details, error
 
 
-def hl7validatorapi(msg, validation_level='tolerant'):
+def add_report(report, details, error):
+    """
+    Add the findings of a constraints.Report the way read_report() adds the
+    lines of an hl7apy report file.
+    """
+    for message in report.errors:
+        error = _add_finding(f"Error: {message}\n", details, error)
+    for message in report.warnings:
+        error = _add_finding(f"Warning: {message}\n", details, error)
+    return details, error
+
+
+def _add_finding(line, details, error):
+    level, message_level = line.split(":", 1)
+    if level == "Error":
+        error = True
+    logger.debug(f"Validation {level}: {message_level.strip()}")
+    if {
+        "level": level,
+        "message": message_level,
+    } not in details:
+        details.append(
+            {
+                "level": level,
+                "message": message_level,
+            }
+        )
+    return error
+
+
+def get_validation_profile(profile=None):
+    """
+    Resolve a validation profile name, falling back to the deployment default.
+    :return: tuple of the stages to run
+    :raises ValueError: for unknown profile names
+    """
+    profile = profile or DEFAULT_VALIDATION_PROFILE
+    if profile not in VALIDATION_PROFILES:
+        raise ValueError(
+            f"Unknown validation profile '{profile}', expected one of {', '.join(VALIDATION_PROFILES)}"
+        )
+    return VALIDATION_PROFILES[profile]
+
+
+def is_tolerant(validation_level):
+    """True for the tolerant level, the default for unknown level names."""
+    return not validation_level or validation_level.lower() not in ("strict", BOTH_LEVELS)
+
+
+def check_header(setmsg):
+    """
+    Check the MSH segment of a normalised message on its raw text, without
+    building hl7apy elements.
+    :return: (resultmessage dict, error) -- error is True when the checks failed
+    """
+    resultmessage = resultMessage()
+    resultmessage.hl7version = None
+    details = []
+    try:
+        # same MSH checks (encoding characters, version) hl7apy runs before parsing
+        encoding_chars, _, hl7version = parser.get_message_info(setmsg.lstrip())
+        hl7version = hl7version or get_default_version()
+        resultmessage.hl7version = hl7version
+        check_version(hl7version)
+    except Exception as err:
+        resultmessage.statusCode = "Failed"
+        resultmessage.message = "[Error parsing message] " + str(err)
+        return resultmessage.__dict__, True
+
+    msh = setmsg.lstrip().split("\r", 1)[0]
+    fields = msh.split(encoding_chars["FIELD"])
+    msh_9 = fields[8] if len(fields) > 8 else ""
+    msh_18 = fields[17] if len(fields) > 17 else ""
+    if not msh_9.strip(encoding_chars["COMPONENT"]):
+        resultmessage.statusCode = "Failed"
+        resultmessage.message = "[Error parsing message] No MSH9"
+        return resultmessage.__dict__, True
+    # Same as the full validation, the charset finding is reported but does not fail the message
+    if msh_18 == "ASCII" and not setmsg.isascii():
+        details.append({"level": "Error", "message": "Message is not ASCII encoded"})
+
+    resultmessage.statusCode = "Success"
+    resultmessage.message = "Valid"
+    resultmessage.details = details
+    return resultmessage.__dict__, False
+
+
+def hl7validatorapi(
+    msg, validation_level='tolerant', validation_profile=None, engine=None, cache=None,
+    profile=None,
+):
     """
     Validate an HL7 v2 message.
 
     :param msg: The HL7 message to validate
-    :param validation_level: Validation level - 'strict' or 'tolerant' (default)
+    :param validation_level: Validation level - 'strict', 'tolerant' (default) or 'both',
+        which gives the tolerant result with the strict-only findings added (see
+        _both_levels())
+    :param validation_profile: Name of the validation profile (see VALIDATION_PROFILES),
+        defaults to the deployment's VALIDATION_PROFILE
+    :param engine: Per-segment validation engine (see VALIDATION_ENGINES),
+        defaults to the deployment's VALIDATION_ENGINE
+    :param cache: LRUCache for per-segment results, defaults to segment_cache
+    :param profile: CompiledProfile of a site message profile checked on top of the
+        HL7 definitions (see hl7validator.message_profiles)
     :return: Dictionary with validation results
+    :raises ValueError: for an empty message
     """
-    app.logger.info("message received in hl7validatorapi: {}".format(msg))
-    app.logger.info(f"validation level: {validation_level}")
+    log_message(
+        logger, logging.INFO, "message received in hl7validatorapi", msg,
+        validation_level=validation_level, validation_profile=validation_profile,
+        message_length=len(msg or ""),
+    )
+    stages = get_validation_profile(validation_profile)
 
     # Convert validation level string to hl7apy constant
-    if validation_level and validation_level.lower() == 'strict':
-        val_level = VALIDATION_LEVEL.STRICT
-    else:
+    both = bool(validation_level) and validation_level.lower() == BOTH_LEVELS
+    if is_tolerant(validation_level):
         val_level = VALIDATION_LEVEL.TOLERANT
+    else:
+        val_level = VALIDATION_LEVEL.STRICT
+
+    if not msg:
+        raise ValueError("No Content")
+    if "parse" not in stages:
+        result = add_profile_findings(check_header(set_message_to_validate(msg))[0], msg, profile)
+        return _both_levels(result, None) if both else result
+    report_file = new_report_file()
+    strict_errors = [] if both else None
+    try:
+        result = _validate_message(
+            msg, val_level, report_file, stages,
+            engine or DEFAULT_VALIDATION_ENGINE,
+            segment_cache if cache is None else cache,
+            strict_errors,
+        )
+    finally:
+        if os.path.exists(report_file):
+            os.remove(report_file)
+    result = add_profile_findings(result, msg, profile)
+    if both:
+        return _both_levels(result, strict_errors[0] if strict_errors else None)
+    return result
+
+
+def add_profile_findings(result, msg, profile):
+    """
+    Message profile stage: add the findings of a compiled site message profile
+    to a result. Results of messages that did not parse are left as they are.
+    """
+    if profile is None or result["message"].startswith("[Error parsing message]"):
+        return result
+    setmsg = set_message_to_validate(msg).lstrip()
+    encoding_chars = parser.get_message_info(setmsg)[0]
+    details = result.get("details") or []
+    error = result["statusCode"] == "Failed"
+    for message in profile.check(setmsg, encoding_chars):
+        error = _add_finding(f"Error: {message}\n", details, error)
+    result["details"] = details
+    if error:
+        result["statusCode"] = "Failed"
+        result["message"] = "Not valid"
+    result["profile"] = {"id": profile.id, "hash": profile.hash}
+    return result
+
+
+def _both_levels(result, strict_error):
+    """
+    Result of a validation_level "both" call: the tolerant result plus the
+    strict parse error labelled "strict-only", and the verdict of each level
+    under "levels". The tolerant findings are labelled "common" when the
+    message parses strictly, and "tolerant-only" when it does not: strict
+    validation then stops at the parse error and reports none of them.
+    """
+    details = result.get("details") or []
+    for detail in details:
+        detail["scope"] = "common" if strict_error is None else "tolerant-only"
+    tolerant = {"statusCode": result["statusCode"], "message": result["message"]}
+    strict = dict(tolerant)
+    if strict_error is not None:
+        strict = {"statusCode": "Failed", "message": "[Error parsing message] " + strict_error}
+        if strict["message"] != result["message"]:
+            details.append(
+                {"level": "Error", "message": " " + strict_error, "scope": "strict-only"}
+            )
+    result["details"] = details
+    result["levels"] = {"tolerant": tolerant, "strict": strict}
+    return result
+
 
+def _validate_message(
+    msg, val_level, report_file, stages, engine="fast", cache=segment_cache, strict_errors=None
+):
+    """
+    :param strict_errors: list for validation_level "both" calls: the message is
+        parsed strictly and, when that fails, the error is added to the list and
+        the message parsed again tolerantly
+    """
     resultmessage = resultMessage()
-    custom_chars = define_custom_chars(msg)
     details = []
     warnings = []  # Collect validation warnings
-    status = "Success"
     msh_18 = "ASCII"
     hl7version = None
-    if not msg:
-        abort(404)
     error = False
     setmsg = set_message_to_validate(msg)
     try:
-        parsed_msg = parse_message(setmsg, validation_level=val_level)
+        try:
+            parsed_msg = parse_message(setmsg, validation_level=val_level)
+        except Exception as err:
+            if strict_errors is None:
+                raise
+            strict_errors.append(str(err))
+            parsed_msg = parse_message(setmsg, validation_level=VALIDATION_LEVEL.TOLERANT)
         hl7version = parsed_msg.version
         msh_9 = parsed_msg.msh.msh_9
 
         message = "Valid"
     except Exception as err:
-        app.logger.error(
-            "Not able to parse message: {} ----> ERROR {}".format(msg, err)
+        # hl7apy errors quote the values they reject, which may be PHI (a date of birth):
+        # only their type is logged, and the body is redacted
+        log_message(
+            logger, logging.ERROR, "Not able to parse message", msg, error_type=type(err).__name__
         )
         resultmessage.statusCode = "Failed"
         resultmessage.hl7version = hl7version
@@ -318,20 +540,32 @@ def hl7validatorapi(msg, validation_level='tolerant'):
                 }
             )
 
+    if "structure" not in stages:
+        return _result(resultmessage, details, warnings, hl7version, message)
+
+    if (
+        "segments" in stages
+        and engine == "fast"
+        and load_constraints(hl7version).consistent
+    ):
+        return _validate_content(
+            resultmessage, setmsg, hl7version, details, warnings, message, cache, stages=stages
+        )
+
     try:
         ### if i used parsed_msg returns error on report creation for some messages....dont know why
         parse_message(set_reference(setmsg, hl7version)).validate(
-            report_file="report.txt"
+            report_file=report_file
         )
 
     except Exception as err:
-        app.logger.error("Error Creating Report: {}".format(err))
+        logger.error("Error Creating Report: {}".format(err))
         if "reference" in str(err):
             # For v2.3 and earlier, skip structure validation if reference error
             if hl7version in ["2.1", "2.2", "2.3"]:
-                app.logger.info("Skipping structure validation for v2.3 message due to reference error")
+                logger.info("Skipping structure validation for v2.3 message due to reference error")
                 # Create empty report file so the rest of the code works
-                with open("report.txt", "w") as f:
+                with open(report_file, "w") as f:
                     pass
             else:
                 resultmessage.statusCode = "Failed"
@@ -339,29 +573,142 @@ def hl7validatorapi(msg, validation_level='tolerant'):
                 resultmessage.message = "[Error parsing message] Error on detecting message structure. Try changing MSH-9.3"
                 return resultmessage.__dict__
 
-    details, error = read_report("report.txt", details, error)
+    details, error = read_report(report_file, details, error)
+    if "segments" not in stages:
+        return _result(resultmessage, details, warnings, hl7version, message, error)
 
     for seg in parse_message(setmsg).children:
         try:
-            seg.validate(report_file="report.txt")
+            seg.validate(report_file=report_file)
 
         except Exception as e:
-            details, error = read_report("report.txt", details, error)
+            details, error = read_report(report_file, details, error)
         for child in seg.children:
             try:
-                child.validate(report_file="report.txt")
+                child.validate(report_file=report_file)
             except Exception as e:
                 error_msg = str(e)
                 # Log more descriptive error messages
                 if "reference" in error_msg:
                     warning_msg = f"Validation skipped for segment {seg.name} child: missing reference structure"
-                    app.logger.warning(warning_msg)
+                    logger.warning(warning_msg)
                     warnings.append(warning_msg)
                 else:
                     warning_msg = f"Error validating segment {seg.name} child: {error_msg}"
-                    app.logger.warning(warning_msg)
+                    logger.warning(warning_msg)
                     warnings.append(warning_msg)
-                    details, error = read_report("report.txt", details, error)
+                    details, error = read_report(report_file, details, error)
+    details, error = add_custom_segments(setmsg, hl7version, details, error)
+    if "tables" in stages:
+        add_table_findings(setmsg, hl7version, details)
+    return _result(resultmessage, details, warnings, hl7version, message, error)
+
+
+def add_custom_segments(setmsg, hl7version, details, error, report_for=segment_report):
+    """
+    Add the findings of the custom segments (see hl7validator.zsegments),
+    checked against their site definitions wherever they are in the message:
+    hl7apy drops the segments it cannot place in the message structure.
+    """
+    if not zsegments.registry.names():
+        return details, error
+    encoding_chars = parser.get_message_info(setmsg.lstrip())[0]
+    for seg_text in setmsg.split("\r"):
+        if seg_text[:3] in zsegments.registry:
+            report = report_for(seg_text.strip(), hl7version, encoding_chars)
+            details, error = add_report(report, details, error)
+    return details, error
+
+
+def add_table_findings(setmsg, hl7version, details):
+    """
+    Table stage: replace the findings of the engines about the tables the site
+    overrides, and add the findings of hl7validator.tables.
+    """
+    encoding_chars = parser.get_message_info(setmsg.lstrip())[0]
+    findings, overridden = tables.table_findings(setmsg, hl7version, encoding_chars)
+    if overridden:
+        details[:] = [
+            d for d in details
+            if not (
+                (match := tables.TABLE_FINDING.match(d["message"]))
+                and match.group(2) in overridden
+            )
+        ]
+    for message in findings:
+        _add_finding(f"Warning: {message}\n", details, False)
+
+
+def cached_segment_report(seg_text, hl7version, encoding_chars, cache=segment_cache):
+    key = tuple(sorted(encoding_chars.items()))
+    return cache.get_or_compute(
+        ("constraints", hl7version, key, zsegments.registry.generation, content_key(seg_text)),
+        lambda: segment_report(seg_text, hl7version, encoding_chars),
+    )
+
+
+def _validate_content(
+    resultmessage, setmsg, hl7version, details, warnings, message, cache=segment_cache,
+    reports=None, stages=VALIDATION_PROFILES["full"],
+):
+    """
+    Structure and per-segment stages of _validate_message() on the compiled
+    constraint tables: segments are checked on their raw text and only a
+    skeleton of the message is validated with hl7apy. Gives the same findings
+    as the hl7apy stages.
+    :param reports: SegmentReports already computed, by segment text
+    :param stages: stages of the validation profile, for the table stage
+    """
+    error = False
+    encoding_chars = parser.get_message_info(setmsg)[0]
+
+    def report_for(seg_text, version, encoding_chars):
+        if reports and seg_text in reports:
+            return reports[seg_text]
+        return cached_segment_report(seg_text, version, encoding_chars, cache=cache)
+
+    structure, segments = validate_message(
+        setmsg,
+        set_reference(setmsg, hl7version),
+        hl7version,
+        encoding_chars,
+        report_for=report_for,
+    )
+    if isinstance(structure, Exception):
+        logger.error("Error Creating Report: {}".format(structure))
+        if "reference" in str(structure):
+            if hl7version not in ["2.1", "2.2", "2.3"]:
+                resultmessage.statusCode = "Failed"
+                resultmessage.hl7version = hl7version
+                resultmessage.message = "[Error parsing message] Error on detecting message structure. Try changing MSH-9.3"
+                return resultmessage.__dict__
+            logger.info("Skipping structure validation for v2.3 message due to reference error")
+    else:
+        details, error = add_report(structure, details, error)
+
+    for name, report, children in segments:
+        if name in zsegments.registry:
+            continue
+        if report.errors:
+            details, error = add_report(report, details, error)
+        for child in children:
+            if child is None:
+                warning_msg = f"Validation skipped for segment {name} child: missing reference structure"
+                logger.warning(warning_msg)
+                warnings.append(warning_msg)
+            elif child.errors:
+                warning_msg = f"Error validating segment {name} child: {child.errors[0]}"
+                logger.warning(warning_msg)
+                warnings.append(warning_msg)
+                details, error = add_report(child, details, error)
+    details, error = add_custom_segments(setmsg, hl7version, details, error, report_for)
+    if "tables" in stages:
+        add_table_findings(setmsg, hl7version, details)
+    return _result(resultmessage, details, warnings, hl7version, message, error)
+
+
+def _result(resultmessage, details, warnings, hl7version, message, error=False):
+    status = "Success"
     if error:
         status = "Failed"
         message = "Not valid"
@@ -374,7 +721,144 @@ def hl7validatorapi(msg, validation_level='tolerant'):
     return resultmessage.__dict__
 
 
+def validate_segment(seg_text, hl7version, val_level, encoding_chars=None):
+    """
+    Parse and validate a single segment on its own.
+    :return: (parse_error, details, warnings) -- parse_error is None when the segment parsed
+    """
+    details = []
+    warnings = []
+    error = False
+    if seg_text[:3] in zsegments.registry:
+        # custom segments are checked against their compiled site definition
+        report = segment_report(seg_text, hl7version, encoding_chars or DEFAULT_ENCODING_CHARS)
+        details, _ = add_report(report, details, error)
+        return None, details, warnings
+    if seg_text.startswith("Z"):
+        # Z-segments have no definition to validate against outside their message
+        return None, details, warnings
+    try:
+        seg = parse_segment(
+            seg_text, version=hl7version, encoding_chars=encoding_chars, validation_level=val_level
+        )
+    except Exception as err:
+        return str(err), details, warnings
+    report_file = new_report_file()
+    try:
+        try:
+            seg.validate(report_file=report_file)
+        except Exception:
+            pass
+        details, error = read_report(report_file, details, error)
+        for child in seg.children:
+            try:
+                child.validate(report_file=report_file)
+            except Exception as e:
+                error_msg = str(e)
+                if "reference" in error_msg:
+                    warnings.append(f"Validation skipped for segment {seg.name} child: missing reference structure")
+                else:
+                    warnings.append(f"Error validating segment {seg.name} child: {error_msg}")
+                    details, error = read_report(report_file, details, error)
+    finally:
+        if os.path.exists(report_file):
+            os.remove(report_file)
+    return None, details, warnings
+
+
+def validate_structure(msh, segment_ids, hl7version):
+    """
+    Validate the segment sequence of a message against its message structure.
+    The message is reduced to its MSH plus the bare segment IDs, and only the
+    findings about the message and its groups are kept.
+    :return: (details, structure_error) -- structure_error is a failure message or None
+    """
+    skeleton = "\r".join([msh] + segment_ids) + "\r"
+    details = []
+    report_file = new_report_file()
+    try:
+        try:
+            parse_message(set_reference(skeleton, hl7version)).validate(report_file=report_file)
+        except Exception as err:
+            if "reference" in str(err):
+                if hl7version in ["2.1", "2.2", "2.3"]:
+                    return details, None
+                return details, "[Error parsing message] Error on detecting message structure. Try changing MSH-9.3"
+        details, _ = read_report(report_file, details, False)
+    finally:
+        if os.path.exists(report_file):
+            os.remove(report_file)
+    return [d for d in details if not SEGMENT_FINDING.search(d["message"])], None
+
+
+def hl7validatorapi_incremental(msg, validation_level='tolerant', cache=None):
+    """
+    Full validation of a message that reuses cached per-segment results.
+
+    Every segment is parsed and validated on its own and its findings are cached
+    by segment text, followed by a structure check over the sequence of segment
+    IDs (also cached). Resubmitting an edited message therefore only re-validates
+    the segments that changed. Meant for the interactive web editor: in tolerant
+    mode the findings match hl7validatorapi() up to their order, while strict
+    parse errors are reported per segment rather than for the whole message.
+    """
+    if validation_level and validation_level.lower() == 'strict':
+        val_level = VALIDATION_LEVEL.STRICT
+    else:
+        val_level = VALIDATION_LEVEL.TOLERANT
+    if not msg:
+        raise ValueError("No Content")
+    if cache is None:
+        cache = segment_cache
+
+    setmsg = set_message_to_validate(msg)
+    result, failed = check_header(setmsg)
+    if failed:
+        return result
+    hl7version = result["hl7version"]
+    details = []
+    warnings = []
+    # segments normalised as the full validation reads them (see constraints.skeleton)
+    segments = [seg for seg in skeleton(setmsg)[0] if seg]
+    encoding_chars = parser.get_message_info(segments[0])[0]
+
+    for seg_text in segments:
+        parse_error, seg_details, seg_warnings = cache.get_or_compute(
+            (
+                "validate", hl7version, val_level, zsegments.registry.generation,
+                content_key(segments[0][3:8]), content_key(seg_text),
+            ),
+            lambda: validate_segment(seg_text, hl7version, val_level, encoding_chars),
+        )
+        if parse_error:
+            result["statusCode"] = "Failed"
+            result["message"] = "[Error parsing message] " + parse_error
+            result["details"] = ""
+            return result
+        details += [d for d in seg_details if d not in details]
+        warnings += seg_warnings
+
+    segment_ids = [seg[:3] for seg in segments[1:]]
+    structure_details, structure_error = cache.get_or_compute(
+        ("structure", hl7version, content_key(segments[0]), tuple(segment_ids)),
+        lambda: validate_structure(segments[0], segment_ids, hl7version),
+    )
+    if structure_error:
+        result["statusCode"] = "Failed"
+        result["message"] = structure_error
+        result["details"] = ""
+        return result
+    details += [d for d in structure_details if d not in details]
+    add_table_findings(setmsg, hl7version, details)
+
+    error = any(d["level"] == "Error" for d in details)
+    return _result(resultMessage(), result["details"] + details, warnings, hl7version, "Valid", error)
+
+
 def from_hl7_to_df(msg):
+    # pandas is only needed for the CSV conversion, keep it out of validation-only imports
+    import pandas as pd
+
     result2 = {}
 
     def get_field(hl7, num):
@@ -402,12 +886,15 @@ def from_hl7_to_df(msg):
     return file
 
 
-def build_tree_structure(msg, validation):
+def build_tree_structure(msg, validation, cache=None):
     """
     Build a hierarchical tree structure of the HL7 message with segments, fields, components, and subcomponents.
     Returns HTML for a collapsible tree view.
+    :param cache: LRUCache for the HTML of each segment, defaults to segment_cache
     """
     hl7version = validation["hl7version"]
+    if cache is None:
+        cache = segment_cache
     setmsg = set_message_to_validate(msg)
 
     # Extract field locations with errors from validation details
@@ -448,13 +935,15 @@ def build_tree_structure(msg, validation):
     def process_segment(segment, segment_id, hl7version):
         """Process a single segment and return HTML"""
         segment_html = ''
+        long_name = zsegments.registry.long_name(segment_id)
+        segment_name = f'<span class="node-name">{escape(long_name)}</span>' if long_name else ''
 
         # This is an actual segment - render it
         segment_html += f'''
         <div class="tree-node segment-node">
             <div class="tree-toggle" onclick="toggleNode(this)">
                 <span class="toggle-icon">▶</span>
-                <span class="node-id">{segment_id}</span>
+                <span class="node-id">{segment_id}</span>{segment_name}
                 <a href="https://hl7-definition.caristix.com/v2/HL7v{hl7version}/Segments/{segment_id}"
                    target="_blank" class="spec-link" onclick="event.stopPropagation()">📖</a>
             </div>
@@ -488,7 +977,7 @@ def build_tree_structure(msg, validation):
 
             # Debug logging for first few fields
             if segment_id == 'PID' and actual_field_num <= 5:
-                app.logger.info(f"PID-{actual_field_num}: datatype={field_datatype}, field_name={field_name}")
+                logger.info(f"PID-{actual_field_num}: datatype={field_datatype}, field_name={field_name}")
 
             field_location = f"{segment_id}-{actual_field_num}"
             field_value = str(getattr(field, 'value', '')) if hasattr(field, 'value') else ''
@@ -621,11 +1110,22 @@ def build_tree_structure(msg, validation):
         segment_id = seg_line[0:3]
         if len(segment_id) < 3:
             continue
+        # the HTML of a segment depends on its text and on the findings about its fields
+        errors = tuple(sorted(e for e in error_fields if e.startswith(segment_id + "-")))
         try:
-            parsed_segment = parse_segment(seg_line, version=hl7version)
-            tree_html += process_segment(parsed_segment, segment_id, hl7version)
+            tree_html += cache.get_or_compute(
+                ("tree", hl7version, zsegments.registry.generation, errors, content_key(seg_line)),
+                lambda: process_segment(
+                    parse_segment(
+                        seg_line, version=hl7version,
+                        reference=zsegments.registry.reference(segment_id, hl7version),
+                    ),
+                    segment_id,
+                    hl7version,
+                ),
+            )
         except Exception as e:
-            app.logger.error(f"Error parsing segment {segment_id}: {e}")
+            logger.error(f"Error parsing segment {segment_id}: {type(e).__name__}")
             continue
 
     tree_html += '</div>'
@@ -633,136 +1133,170 @@ def build_tree_structure(msg, validation):
     return tree_html, validation
 
 
-def highlight_message(msg, validation):
+def highlight_message(msg, validation, checks=True, cache=None):
+    """
+    Render the message as HTML with every field annotated with its name.
+    :param checks: also run the field level checks (datetime formats and
+        Field.validate()), which only the "full" validation profile asks for
+    """
     hl7version = validation["hl7version"]
+    if cache is None:
+        cache = segment_cache
 
     setmsg = set_message_to_validate(msg)
     highligmsg = ""
     for seg in setmsg.split("\r"):
-        segment_id = seg[0:3]
-        if len(segment_id) < 3:
+        if len(seg[0:3]) < 3:
             continue
         try:
-            p = parse_segment(seg, version=hl7version)
-
+            # segments are rendered independently, so unchanged ones come from the cache
+            newseg, details, warnings = cache.get_or_compute(
+                ("highlight", hl7version, checks, zsegments.registry.generation, content_key(seg)),
+                lambda: highlight_segment(seg, hl7version, checks),
+            )
         except Exception as e:
             return "<p> [Error parsing message] </p>" + str(e), validation
+        validation["details"].extend(details)
+        if warnings:
+            validation.setdefault("warnings", []).extend(warnings)
+        highligmsg += newseg
+    return highligmsg, validation
+
+
+def _check_dates(datatype, value, segment_id, name, details):
+    """
+    Date format checks of a rendered field.
+    :return: True when the value is not a valid date
+    """
+    if value == "":
+        return False
+    if datatype in ("DTM", "TS"):
+        chk, _ = check_format(value)
+        message = "Invalid datetime format on field "
+    elif datatype == "DT":
+        chk, _ = check_simple_format(value)
+        message = "Invalid date format on field "
+    else:
+        return False
+    if not chk:
+        details.append({"level": "Error", "message": message + segment_id + "." + name})
+    return not chk
+
+
+def highlight_segment(seg, hl7version, checks=True):
+    """
+    Render a single segment for highlight_message().
+    :return: (html, details, warnings) found while rendering the segment
+    """
+    segment_id = seg[0:3]
+    details = []
+    warnings = []
+    custom = None
+    title = ""
+    if segment_id in zsegments.registry:
+        custom = load_constraints(hl7version).segment(segment_id)
+        long_name = zsegments.registry.long_name(segment_id)
+        if long_name:
+            title = f' title="{escape(long_name)}"'
+    if custom is not None:
+        # site definition: names and datatypes come from its compiled reference
+        max_field = len(custom.children)
+    else:
+        p = parse_segment(seg, version=hl7version)
         max_field = 0
         list_of_segments = []
         for s in p.children:
             if "Field of type None" not in str(s) and str(s) not in list_of_segments:
                 max_field += 1
                 list_of_segments.append(str(s))
-        newseg = (
-            '<span style="margin-right: 5px;"><b>'
-            + '<a href="https://hl7-definition.caristix.com/v2/HL7v'
-            + hl7version
-            + "/Segments/"
-            + segment_id
-            + '" target="_blank">'
-            + segment_id
-            + "</a></b></span>"
-        )
-        counter = 0
-        for idx, field in enumerate(seg.split("|")[1:]):
-            warningfield = False
-            field_name = "Unknown field"
-            if segment_id == "MSH":
-                add = 2
+    newseg = (
+        '<span style="margin-right: 5px;"><b>'
+        + '<a href="https://hl7-definition.caristix.com/v2/HL7v'
+        + hl7version
+        + "/Segments/"
+        + segment_id
+        + '" target="_blank"'
+        + title
+        + ">"
+        + segment_id
+        + "</a></b></span>"
+    )
+    counter = 0
+    for idx, field in enumerate(seg.split("|")[1:]):
+        warningfield = False
+        field_name = "Unknown field"
+        if segment_id == "MSH":
+            add = 2
+        else:
+            add = 1
+        try:
+            field_identifier = segment_id + "_" + str(idx + add)
+            if custom is not None:
+                node = custom.by_name.get(field_identifier)
+                if node is not None:
+                    if checks:
+                        warningfield = _check_dates(
+                            node.datatype, field, segment_id, field_identifier, details
+                        )
+                    field_name = node.long_name.replace("_", " ").lower().title()
             else:
-                add = 1
-            try:
-                field_identifier = segment_id + "_" + str(idx + add)
                 f = Field(field_identifier, version=hl7version)
                 f.value = field
-
-                if (
-                    f.datatype == "DTM" or f.datatype == "TS"
-                ) and f.value != "":  # check date format
-                    chk, _ = check_format(f.value)
-                    if not chk:
-                        warningfield = True
-
-                        validation["details"].append(
-                            {
-                                "level": "Error",
-                                "message": "Invalid datetime format on field "
-                                + segment_id
-                                + "."
-                                + f.name,
-                            }
-                        )
-
-                if f.datatype == "DT" and f.value != "":  # check date format
-                    chk, _ = check_simple_format(f.value)
-                    if not chk:
-                        warningfield = True
-                        validation["details"].append(
-                            {
-                                "level": "Error",
-                                "message": "Invalid date format on field "
-                                + segment_id
-                                + "."
-                                + f.name,
-                            }
-                        )
+                if checks:
+                    warningfield = _check_dates(f.datatype, f.value, segment_id, f.name, details)
                 field_name = f.long_name.replace("_", " ").lower().title()
-                f.validate()
-            except AttributeError as e:
-                # Field object is None or doesn't have expected attributes
-                warning_msg = f"Could not validate field {segment_id}-{idx + add}: field may not be defined in HL7 v{hl7version} specification or has unexpected structure"
-                app.logger.warning(warning_msg)
-                if "warnings" not in validation:
-                    validation["warnings"] = []
-                validation["warnings"].append(warning_msg)
-                warningfield = True
-                counter -= 1
-            except Exception as e:
-                # Other validation errors (invalid field name, etc.)
-                error_msg = str(e)
-                if "Invalid name" in error_msg or "not found" in error_msg.lower():
-                    warning_msg = f"Field {segment_id}-{idx + add} not found in HL7 v{hl7version} specification: {error_msg}"
-                else:
-                    warning_msg = f"Error validating field {segment_id}-{idx + add}: {error_msg}"
-                app.logger.warning(warning_msg)
-                if "warnings" not in validation:
-                    validation["warnings"] = []
-                validation["warnings"].append(warning_msg)
-                warningfield = True
-                counter -= 1
-
-            class_ = "note"
-            if field != "":
-                counter += 1
-
-                if counter > max_field or warningfield:
-                    class_ = "note error"
-            if segment_id == "MSH" and idx == 0:
-                newseg += (
-                    '<span class="span-group"><span class="tooltiptext">'
-                    + "Field Separator"
-                    + '</span><span  class="'
-                    + class_
-                    + '">'
-                    + segment_id
-                    + "-"
-                    + "1"
-                    + '</span><span class="field main-content">'
-                    + "|"
-                    + "</span></span>"
-                )
+                if checks:
+                    f.validate()
+        except AttributeError as e:
+            # Field object is None or doesn't have expected attributes
+            warning_msg = f"Could not validate field {segment_id}-{idx + add}: field may not be defined in HL7 v{hl7version} specification or has unexpected structure"
+            logger.warning(warning_msg)
+            warnings.append(warning_msg)
+            warningfield = True
+            counter -= 1
+        except Exception as e:
+            # Other validation errors (invalid field name, etc.)
+            error_msg = str(e)
+            if "Invalid name" in error_msg or "not found" in error_msg.lower():
+                warning_msg = f"Field {segment_id}-{idx + add} not found in HL7 v{hl7version} specification: {error_msg}"
+            else:
+                warning_msg = f"Error validating field {segment_id}-{idx + add}: {error_msg}"
+            logger.warning(warning_msg)
+            warnings.append(warning_msg)
+            warningfield = True
+            counter -= 1
+
+        class_ = "note"
+        if field != "":
+            counter += 1
+
+            if counter > max_field or warningfield:
+                class_ = "note error"
+        if segment_id == "MSH" and idx == 0:
             newseg += (
                 '<span class="span-group"><span class="tooltiptext">'
-                + field_name
-                + '</span><span class="'
+                + "Field Separator"
+                + '</span><span  class="'
                 + class_
                 + '">'
                 + segment_id
                 + "-"
-                + str(idx + add)
+                + "1"
                 + '</span><span class="field main-content">'
-                + field
+                + "|"
                 + "</span></span>"
             )
-        highligmsg += '<p class="segment ' + segment_id + '">' + newseg + "</p>"
-    return highligmsg, validation
+        newseg += (
+            '<span class="span-group"><span class="tooltiptext">'
+            + field_name
+            + '</span><span class="'
+            + class_
+            + '">'
+            + segment_id
+            + "-"
+            + str(idx + add)
+            + '</span><span class="field main-content">'
+            + field
+            + "</span></span>"
+        )
+    return '<p class="segment ' + segment_id + '">' + newseg + "</p>", details, warnings
@@ -0,0 +1,330 @@
+"""
+ASGI entry point for HL7 Validator.
+
+Requests are accepted on an event loop and the CPU-bound validation and
+conversion work of the API endpoints is sent to a shared, bounded process
+pool. When the pool queue is full the request is answered straight away with
+503 and a Retry-After header instead of waiting for a worker slot. Jobs over
+the time budget have their process killed and get a "Budget exceeded" answer.
+
+Every other route (web form, Swagger docs, static files) is served by the
+Flask application on a thread.
+
+Run with any ASGI server, e.g.::
+
+    gunicorn hl7validator.asgi:app -k uvicorn.workers.UvicornWorker
+"""
+
+import asyncio
+import io
+import os
+import sys
+from urllib.parse import parse_qsl
+
+from hl7validator import compression, health
+from hl7validator.api import hl7validatorapi
+from hl7validator.budget import BUDGET_EXCEEDED, budget_result
+from hl7validator.codec import decode_er7, dumps, is_er7, loads, parse_content_type
+from hl7validator.core import validate_job, convert_job, warm_up
+from hl7validator.pool import JobTimeout, ValidationPool, PoolSaturated
+from hl7validator.webapp import app as flask_app, limiter, readiness, validator
+from hl7validator.ratelimit import BULK, client_id
+
+VALIDATE_PATH = "/api/hl7/v1/validate/"
+CONVERT_PATH = "/api/hl7/v1/convert/"
+
+RETRY_AFTER = os.getenv("HL7VALIDATOR_RETRY_AFTER", "1")
+
+pool = ValidationPool.from_env(initializer=warm_up, initargs=(validator.versions,))
+# one set of processes per worker: the validator (health checks, Flask pages) runs on the pool's
+validator.use_workers(pool.workers)
+readiness.pools.pop("validation", None)
+# looked up on each check, the pool being replaceable
+readiness.pools["asgi"] = lambda: pool.stats()
+if "hl7validator.diagnostics" in flask_app.extensions:
+    flask_app.extensions["hl7validator.diagnostics"].pop("validation", None)
+    flask_app.extensions["hl7validator.diagnostics"]["asgi"] = pool
+
+
+async def read_body(receive, max_length):
+    body = bytearray()
+    while True:
+        event = await receive()
+        if event["type"] == "http.disconnect":
+            return None
+        body += event.get("body", b"")
+        if len(body) > max_length:
+            raise ValueError("Request body too large")
+        if not event.get("more_body", False):
+            return bytes(body)
+
+
+async def send_response(send, status, body, content_type, headers=()):
+    raw_headers = [
+        (b"content-type", content_type.encode("latin-1")),
+        (b"content-length", str(len(body)).encode("latin-1")),
+    ]
+    raw_headers += [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, payload, headers=()):
+    body = dumps(payload)
+    await send_response(send, status, body, "application/json", headers)
+
+
+def compressing(send, scope):
+    """
+    Wrap an ASGI send to compress the (single body) API responses the client
+    accepts compressed; see hl7validator.compression.
+    """
+    if not flask_app.config["COMPRESSION"]:
+        return send
+    accept_encoding = dict(scope.get("headers", [])).get(b"accept-encoding", b"").decode("latin-1")
+    encoding = compression.negotiate(accept_encoding)
+    start = {}
+
+    async def compressing_send(event):
+        if event["type"] == "http.response.start":
+            start.update(event)
+            return
+        body = event.get("body", b"")
+        headers = [(k, v) for k, v in start["headers"] if k != b"content-length"]
+        content_type = dict(headers).get(b"content-type", b"").decode("latin-1")
+        if compression.compressible(content_type.partition(";")[0].strip()):
+            headers.append((b"vary", b"Accept-Encoding"))
+            if (
+                encoding and start["status"] == 200
+                and len(body) >= flask_app.config["COMPRESSION_MIN_SIZE"]
+            ):
+                body = await asyncio.to_thread(compression.compress, body, encoding)
+                headers.append((b"content-encoding", encoding.encode("latin-1")))
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({**start, "headers": headers})
+        await send({**event, "body": body})
+
+    return compressing_send
+
+
+async def handle_api(scope, receive, send):
+    send = compressing(send, scope)
+    headers = dict(scope.get("headers", []))
+    api_key = headers.get(b"x-api-key", b"").decode("latin-1")
+    client = client_id(api_key, (scope.get("client") or (None, 0))[0], limiter.overrides)
+    # the SQLite backend blocks on its file lock: off the event loop
+    admitted, reason, retry_after = await asyncio.to_thread(limiter.admit, client, BULK)
+    if not admitted:
+        flask_app.logger.warning(f"Rejected bulk request from {client}: {reason}")
+        return await send_json(
+            send, 429,
+            {"statusCode": "Failed", "message": "Too many requests", "reason": reason},
+            headers=[("retry-after", str(max(1, int(retry_after + 0.999))))],
+        )
+    try:
+        await run_api(scope, receive, send)
+    finally:
+        limiter.release(BULK)
+
+
+async def run_api(scope, receive, send):
+    try:
+        body = await read_body(receive, flask_app.config["MAX_CONTENT_LENGTH"])
+    except ValueError:
+        return await send_json(send, 413, {"message": "Request body too large"})
+    if body is None:
+        return
+    headers = dict(scope.get("headers", []))
+    content_type, params = parse_content_type(headers.get(b"content-type", b"").decode("latin-1"))
+    if is_er7(content_type):
+        # raw message, options in the query string
+        data = decode_er7(body, params.get("charset"))
+        payload = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    else:
+        try:
+            payload = loads(body)
+            data = payload["data"]
+        except (ValueError, TypeError, KeyError):
+            return await send_json(send, 400, {"message": "Expected a JSON body with a 'data' field"})
+    if not data:
+        return await send_json(send, 404, {"message": "No Content"})
+    validation_profile = payload.get("validation_profile")
+    try:
+        validator.stages(validation_profile)
+        profile = validator.profiles.get(payload.get("profile"))
+    except ValueError as err:
+        return await send_json(send, 400, {"statusCode": "Failed", "message": str(err)})
+
+    # feed traffic: sampled and checked for duplicates like Validator.validate_sampled()
+    feed = scope["path"] == VALIDATE_PATH and validation_profile is None and profile is None
+
+    reason = validator.limits.check(data)
+    if reason and scope["path"] == VALIDATE_PATH:
+        result = budget_result(data, reason)
+        if feed:
+            result = await asyncio.to_thread(validator.check_duplicate, data, result)
+        return await send_json(send, 200, result)
+    if reason:
+        return await send_json(
+            send, 422, {"statusCode": "Failed", "message": f"{BUDGET_EXCEEDED}: {reason}"}
+        )
+
+    sampled = group = None
+    if feed and validator.sampling:
+        # only the configured sample goes to the pool
+        sampled, group = validator.sampling.decide(data)
+        if not sampled:
+            result = await asyncio.to_thread(
+                hl7validatorapi,
+                data,
+                validation_level=payload.get("validation_level", "tolerant"),
+                validation_profile="header",
+            )
+            result["sampled"] = False
+            validator.sampling.record(group, False, result)
+            result = await asyncio.to_thread(validator.check_duplicate, data, result)
+            return await send_json(send, 200, result)
+
+    try:
+        if scope["path"] == VALIDATE_PATH:
+            future = pool.submit(
+                validate_job,
+                data,
+                payload.get("validation_level", "tolerant"),
+                validation_profile,
+                profile,
+            )
+        else:
+            future = pool.submit(convert_job, data)
+    except PoolSaturated as err:
+        flask_app.logger.warning(f"Shedding request to {scope['path']}: {err}")
+        return await send_json(
+            send, 503, {"message": "Validator is busy, retry later"},
+            headers=[("retry-after", RETRY_AFTER)],
+        )
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except JobTimeout:
+        reason = f"did not finish within {pool.time_budget:g} s"
+        flask_app.logger.warning(f"Killed job for {scope['path']}: {reason}")
+        if scope["path"] == VALIDATE_PATH:
+            result = budget_result(data, f"validation {reason}")
+            if feed:
+                result = await asyncio.to_thread(validator.check_duplicate, data, result)
+            return await send_json(send, 200, result)
+        return await send_json(
+            send, 422, {"statusCode": "Failed", "message": f"{BUDGET_EXCEEDED}: conversion {reason}"}
+        )
+    except Exception as err:
+        flask_app.logger.error(f"Error running job for {scope['path']}: {err}")
+        return await send_json(send, 500, {"message": "Internal error"})
+
+    if scope["path"] == VALIDATE_PATH:
+        if sampled:
+            result["sampled"] = True
+            validator.sampling.record(group, True, result)
+        if feed:
+            # the duplicate store is a file mapped by the workers, locked while checked
+            result = await asyncio.to_thread(validator.check_duplicate, data, result)
+        return await send_json(send, 200, result)
+    file, content = result
+    await send_response(
+        send, 200, content, "text/csv; charset=utf-8",
+        headers=[("content-disposition", f"attachment; filename={file}")],
+    )
+
+
+def build_environ(scope, body):
+    """
+    Build a WSGI environ for the Flask application from an ASGI HTTP scope.
+    """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    chunks = flask_app.wsgi_app(environ, start_response)
+    try:
+        body = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return response["status"], response["headers"], body
+
+
+async def handle_wsgi(scope, receive, send):
+    try:
+        body = await read_body(receive, flask_app.config["MAX_CONTENT_LENGTH"])
+    except ValueError:
+        return await send_json(send, 413, {"message": "Request body too large"})
+    if body is None:
+        return
+    status, headers, content = await asyncio.to_thread(call_wsgi, build_environ(scope, body))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            # processes started in the serving process, warmed before the first requests
+            pool.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            pool.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await handle_lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    if scope["method"] == "POST" and scope["path"] in (VALIDATE_PATH, CONVERT_PATH):
+        return await handle_api(scope, receive, send)
+    if scope["method"] == "GET" and scope["path"] == health.HEALTH_PATH:
+        # answered on the event loop, even when the threads serving Flask are all busy
+        return await send_json(send, 200, health.liveness())
+    if scope["method"] == "GET" and scope["path"] == health.READY_PATH:
+        ready, report = await asyncio.to_thread(readiness.check)
+        return await send_json(send, 200 if ready else 503, report)
+    return await handle_wsgi(scope, receive, send)
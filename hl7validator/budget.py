@@ -0,0 +1,104 @@
+"""
+Per-message budgets.
+
+Size limits (segments, field length, repetitions) are checked on the raw
+text before any parsing, and a wall-clock budget is enforced by running the
+validation in a worker process that is killed when it overruns (see
+:class:`hl7validator.pool.WorkerPool`). A message over budget gets a partial
+result: the header checks, which are cheap and bounded, plus a
+"Budget exceeded" finding.
+"""
+
+import os
+import re
+
+from hl7validator import api
+
+BUDGET_EXCEEDED = "Budget exceeded"
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+
+class BudgetExceeded(Exception):
+    """Raised by operations that have no partial result to return, e.g. conversion."""
+
+
+class Limits:
+    """
+    Per-message limits, 0 disabling a limit.
+
+    :param max_segments: segments in the message
+    :param max_field_length: characters in a single field
+    :param max_repetitions: repetitions of a single field
+    :param time_budget: seconds of wall-clock time for the validation
+    """
+
+    def __init__(self, max_segments=0, max_field_length=0, max_repetitions=0, time_budget=0):
+        self.max_segments = max_segments
+        self.max_field_length = max_field_length
+        self.max_repetitions = max_repetitions
+        self.time_budget = time_budget
+
+    @classmethod
+    def from_env(cls, time_budget="0"):
+        """
+        Build limits from the HL7VALIDATOR_MAX_* and HL7VALIDATOR_TIME_BUDGET
+        environment variables; time_budget is the default of the latter.
+        """
+        return cls(
+            max_segments=int(os.getenv("HL7VALIDATOR_MAX_SEGMENTS", "5000")),
+            max_field_length=int(os.getenv("HL7VALIDATOR_MAX_FIELD_LENGTH", "1000000")),
+            max_repetitions=int(os.getenv("HL7VALIDATOR_MAX_REPETITIONS", "1000")),
+            time_budget=float(os.getenv("HL7VALIDATOR_TIME_BUDGET", time_budget)),
+        )
+
+    def check(self, msg):
+        """
+        Check the size limits on the raw message text.
+        :return: description of the first exceeded limit, or None
+        """
+        if not msg:
+            return None
+        segments = [seg for seg in _SEGMENT_SEPARATORS.split(msg) if seg]
+        if self.max_segments and len(segments) > self.max_segments:
+            return f"message has {len(segments)} segments, the limit is {self.max_segments}"
+        if not (self.max_field_length or self.max_repetitions):
+            return None
+        text = msg.lstrip()
+        field_sep = text[3] if text.startswith("MSH") and len(text) > 3 else "|"
+        repetition_sep = text[5] if text.startswith("MSH") and len(text) > 5 else "~"
+        for seg in segments:
+            if self.max_field_length and len(seg) > self.max_field_length:
+                longest = max(len(field) for field in seg.split(field_sep))
+                if longest > self.max_field_length:
+                    return (
+                        f"segment {seg[:3]} has a field of {longest} characters, "
+                        f"the limit is {self.max_field_length}"
+                    )
+            if self.max_repetitions and seg.count(repetition_sep) > self.max_repetitions:
+                repetitions = max(
+                    field.count(repetition_sep) + 1 for field in seg.split(field_sep)
+                )
+                if repetitions > self.max_repetitions:
+                    return (
+                        f"segment {seg[:3]} has a field with {repetitions} repetitions, "
+                        f"the limit is {self.max_repetitions}"
+                    )
+        return None
+
+
+def budget_result(msg, reason):
+    """
+    Partial result for a message over budget: the outcome of the header
+    checks plus a "Budget exceeded" error finding.
+    """
+    result, _ = api.check_header(api.set_message_to_validate(msg))
+    details = result.get("details") or []
+    details.append({"level": "Error", "message": f"{BUDGET_EXCEEDED}: {reason}"})
+    result.update(
+        statusCode="Failed",
+        message=BUDGET_EXCEEDED,
+        details=details,
+        warnings=[],
+    )
+    return result
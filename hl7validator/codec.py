@@ -0,0 +1,140 @@
+"""
+Request and response encodings of the HTTP API.
+
+Besides JSON documents (``{"data": "MSH|..."}``) the endpoints accept the
+message itself as the request body with an HL7 v2 ER7 media type. Such
+bodies are decoded with the charset of the Content-Type header or, when
+there is none, with the charset declared in MSH-18.
+
+JSON is encoded and decoded with orjson when it is installed (``fast``
+extra) and with the standard library otherwise.
+"""
+
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ER7_MEDIA_TYPES = ("x-application/hl7-v2+er7", "application/hl7-v2")
+
+# HL7 table 0211 (alternate character sets) to Python codecs
+HL7_CHARSETS = {
+    "ASCII": "ascii",
+    "ISO IR6": "ascii",
+    "8859/1": "latin-1",
+    "ISO IR100": "latin-1",
+    "8859/2": "iso8859-2",
+    "ISO IR101": "iso8859-2",
+    "8859/3": "iso8859-3",
+    "ISO IR109": "iso8859-3",
+    "8859/4": "iso8859-4",
+    "ISO IR110": "iso8859-4",
+    "8859/5": "iso8859-5",
+    "ISO IR144": "iso8859-5",
+    "8859/6": "iso8859-6",
+    "ISO IR127": "iso8859-6",
+    "8859/7": "iso8859-7",
+    "ISO IR126": "iso8859-7",
+    "8859/8": "iso8859-8",
+    "ISO IR138": "iso8859-8",
+    "8859/9": "iso8859-9",
+    "ISO IR148": "iso8859-9",
+    "8859/15": "iso8859-15",
+    "UNICODE": "utf-8",
+    "UNICODE UTF-8": "utf-8",
+    "ISO IR192": "utf-8",
+    "UNICODE UTF-16": "utf-16",
+    "UNICODE UTF-32": "utf-32",
+    "BIG-5": "big5",
+    "CNS 11643-1992": "big5",
+    "GB 18030-2000": "gb18030",
+    "ISO IR87": "iso2022_jp",
+    "ISO IR159": "iso2022_jp_2",
+    "KS X 1001": "euc_kr",
+}
+
+
+def is_er7(mimetype):
+    return mimetype in ER7_MEDIA_TYPES
+
+
+def parse_content_type(value):
+    """
+    Split a Content-Type header value.
+    :return: (lower-cased media type, dict of parameters)
+    """
+    mimetype, _, rest = value.partition(";")
+    params = {}
+    for item in rest.split(";"):
+        key, _, param = item.partition("=")
+        if key.strip():
+            params[key.strip().lower()] = param.strip().strip('"')
+    return mimetype.strip().lower(), params
+
+
+def declared_charset(body):
+    """
+    Python codec for the charset declared in MSH-18 of a raw message, read
+    on the bytes before decoding (MSH-1 to MSH-18 are ASCII).
+    :return: codec name, or None when MSH-18 is empty or unknown
+    """
+    start = body.find(b"MSH")
+    if start < 0 or len(body) < start + 4:
+        return None
+    separator = body[start + 3:start + 4]
+    msh = body[start:].split(b"\r", 1)[0].split(b"\n", 1)[0]
+    fields = msh.split(separator)
+    if len(fields) <= 17:
+        return None
+    # first repetition only; further ones are alternate character sets
+    charset = fields[17].split(b"~", 1)[0].strip().decode("ascii", "replace").upper()
+    return HL7_CHARSETS.get(charset)
+
+
+def decode_er7(body, charset=None):
+    """
+    Decode a raw ER7 request body.
+
+    The charset comes from the Content-Type header, a byte order mark or
+    MSH-18, in that order. Without any of them the body is read as UTF-8,
+    a superset of HL7's default ASCII. Bytes that are invalid in that
+    charset are decoded as Latin-1 rather than rejected, so the validator
+    can still report the encoding problem.
+    """
+    if charset is None:
+        for bom, name in (
+            (codecs.BOM_UTF8, "utf-8-sig"),
+            (codecs.BOM_UTF32_LE, "utf-32"),
+            (codecs.BOM_UTF32_BE, "utf-32"),
+            (codecs.BOM_UTF16_LE, "utf-16"),
+            (codecs.BOM_UTF16_BE, "utf-16"),
+        ):
+            if body.startswith(bom):
+                charset = name
+                break
+        else:
+            charset = declared_charset(body) or "utf-8"
+    if charset == "ascii":
+        # a message declaring ASCII may still carry other bytes; keep them visible
+        charset = "utf-8"
+    try:
+        return body.decode(charset)
+    except (UnicodeDecodeError, LookupError):
+        return body.decode("latin-1")
+
+
+def dumps(obj, default=None):
+    """Encode obj as JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default, ensure_ascii=False).encode("utf-8")
+
+
+def loads(data):
+    """Decode a JSON document from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
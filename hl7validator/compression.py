@@ -0,0 +1,228 @@
+"""
+Response compression and cache headers.
+
+Dynamic responses (the web form with its highlighted message and tree, API
+JSON, CSV exports) of a compressible type and over a size threshold are
+compressed with the best coding the client accepts: brotli when the optional
+``brotli`` package is installed, gzip otherwise.
+
+Static files are linked under content-hashed names (``mystyle.3f2a1b9c0d.css``,
+see ``static_url`` in the templates) and served with a one year, immutable
+Cache-Control: a new release changes the names, so browsers never revalidate
+them. ``hl7validator build-static`` writes gzip and brotli copies of the
+hashed files at build time (``docker/build.sh`` runs it before the wheel is
+built); without them the files are compressed on each request.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+# Preferred first when the client accepts several with the same weight
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+COMPRESSIBLE = frozenset([
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+])
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE)
+
+
+def negotiate(accept_encoding, available=ENCODINGS):
+    """
+    Content coding to use for an Accept-Encoding header.
+    :return: one of available, or None for the identity
+    """
+    weights = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding] = weight
+    best, best_weight = None, 0.0
+    for coding in available:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compress(data, encoding, static=False):
+    """
+    :param static: best (slow) compression, for files compressed once at build time
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+
+def compress_response(response, accept_encoding, min_size):
+    """Compress a Flask response in place when it is worth it and the client accepts it."""
+    if (
+        response.status_code != 200
+        or "Content-Encoding" in response.headers
+        or "Content-Range" in response.headers
+        or not compressible(response.mimetype)
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(accept_encoding)
+    if encoding is None:
+        return response
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        # generated as it is sent (converted batches): buffering it would defeat the streaming
+        return response
+    # file responses (CSV exports, static files) are read to compress them
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+class StaticAssets:
+    """
+    Content-hashed names of the files of a static directory, and their
+    precompressed copies.
+
+    :param directory: the static directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = {}  # file name -> hashed name
+        self.files = {}  # hashed name -> file name
+        self.scan()
+
+    def scan(self):
+        self.names, self.files = {}, {}
+        if not os.path.isdir(self.directory):
+            return
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith((".gz", ".br")):
+                    continue
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:10]
+                stem, ext = os.path.splitext(name)
+                hashed = f"{stem}.{digest}{ext}"
+                self.names[name] = hashed
+                self.files[hashed] = name
+
+    def url(self, filename):
+        return "/static/" + self.names.get(filename, filename)
+
+    def precompressed(self, hashed):
+        """Codings of the build-time copies of a hashed file."""
+        return tuple(
+            encoding for encoding in ENCODINGS
+            if os.path.isfile(os.path.join(self.directory, hashed + SUFFIXES[encoding]))
+        )
+
+    def build(self):
+        """
+        Write the gzip (and brotli) copies of the compressible files, and
+        remove the copies of older contents.
+        :return: paths of the files written
+        """
+        written, keep = [], set()
+        for name, hashed in sorted(self.names.items()):
+            if not compressible(mimetypes.guess_type(name)[0]):
+                continue
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+            for encoding in ENCODINGS:
+                path = os.path.join(self.directory, hashed + SUFFIXES[encoding])
+                keep.add(os.path.normpath(path))
+                if os.path.isfile(path):
+                    continue
+                content = compress(data, encoding, static=True)
+                if len(content) >= len(data):
+                    continue
+                with open(path, "wb") as f:
+                    f.write(content)
+                written.append(path)
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.normpath(os.path.join(root, file))
+                if file.endswith((".gz", ".br")) and path not in keep:
+                    os.remove(path)
+        return written
+
+
+def init_app(app):
+    """
+    Register the response compression hook, the hashed static file route and
+    the static_url() template function on a Flask app. Dynamic responses are
+    compressed when app.config["COMPRESSION"] is set, from
+    app.config["COMPRESSION_MIN_SIZE"] bytes.
+    """
+    from flask import request, send_from_directory
+
+    assets = StaticAssets(app.static_folder)
+    send_static_file = app.view_functions["static"]
+
+    def static(filename):
+        name = assets.files.get(filename)
+        if name is None:
+            return send_static_file(filename=filename)
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        encoding = negotiate(request.headers.get("Accept-Encoding"), assets.precompressed(filename))
+        response = send_from_directory(
+            assets.directory,
+            filename + SUFFIXES[encoding] if encoding else name,
+            mimetype=mimetype,
+            max_age=31536000,
+        )
+        response.headers["Cache-Control"] = IMMUTABLE
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if compressible(mimetype):
+            response.vary.add("Accept-Encoding")
+        return response
+
+    app.view_functions["static"] = static
+    app.add_template_global(assets.url, "static_url")
+
+    @app.after_request
+    def compress_dynamic(response):
+        if not app.config.get("COMPRESSION"):
+            return response
+        return compress_response(
+            response, request.headers.get("Accept-Encoding"),
+            app.config.get("COMPRESSION_MIN_SIZE", 1024),
+        )
+
+    app.extensions["hl7validator.static_assets"] = assets
+    return assets
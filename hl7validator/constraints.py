@@ -0,0 +1,489 @@
+"""
+Constraint tables compiled from the hl7apy reference data, and a validator
+that checks raw segment text against them.
+
+For every HL7 version the segment, field and datatype references are compiled
+once into ``Node`` trees (field list with datatype, cardinality, max length and
+table per segment; component layout per datatype) plus frozensets of the HL7
+table values. ``check_segment`` then slices the ER7 text of a segment on the
+encoding characters and reports the same findings hl7apy's ``Validator`` gives
+for the parsed segment (unknown children, cardinality of fields, components and
+subcomponents, datatype changes of base fields, table values), without building
+hl7apy elements. Z-segments and other custom segments are compiled from the
+site definitions of ``hl7validator.zsegments``. Segments the tables do not
+model (undefined Z-segments, escape sequences, fields outside the segment
+definition) are validated with hl7apy.
+
+``validate_message`` combines the segment checks with the message structure of
+a skeleton message (MSH plus bare segment IDs) to give the findings of the
+structure and per-segment stages of ``hl7validatorapi``.
+"""
+
+import functools
+import os
+import tempfile
+from collections import namedtuple
+
+from hl7apy import load_library
+from hl7apy.core import is_base_datatype
+from hl7apy.parser import parse_message, parse_segment
+from hl7apy.validation import Validator
+
+from hl7validator import zsegments
+
+# Findings of a validated element, in the order hl7apy reports them
+Report = namedtuple("Report", "errors warnings")
+
+# Findings of a segment: the segment as a whole and each field repetition on its
+# own (None for unknown fields, which hl7apy cannot validate on their own)
+SegmentReport = namedtuple("SegmentReport", "errors warnings fields")
+
+
+class Unsupported(Exception):
+    """The segment uses a construct the constraint tables do not model."""
+
+
+class Node:
+    """Compiled reference of a segment, field, component or subcomponent."""
+
+    __slots__ = ("datatype", "long_name", "table", "max_length", "base", "children", "by_name")
+
+    def __init__(self, datatype, long_name, table, max_length, base, children):
+        self.datatype = datatype
+        self.long_name = long_name
+        self.table = table
+        self.max_length = max_length
+        self.base = base
+        # tuple of (name, Node, min, max) in reference order, None for leaves
+        self.children = children
+        self.by_name = {c[0]: c[1] for c in children} if children is not None else None
+
+
+class VersionConstraints:
+    """Constraint tables of one HL7 version."""
+
+    def __init__(self, version):
+        lib = load_library(version)
+        self.version = version
+        self.tables = {name: frozenset(ref[1]) for name, ref in getattr(lib, "TABLES", {}).items()}
+        self.field_names = frozenset(lib.FIELDS)
+        self.component_names = frozenset(lib.DATATYPES)
+        self._base = {}
+        self._custom = {}
+        self._custom_generation = None
+        self.segments = {}
+        for name, ref in lib.SEGMENTS.items():
+            # withdrawn segments have no fields and pseudo segments such as
+            # ANYHL7SEGMENT no field references; hl7apy validates those
+            if len(ref) > 1 and all(field[1] is not None for field in ref[1]):
+                self.segments[name] = self._compile(("sequence", ref[1], None, None, None, -1))
+        # Segments whose last field is of type varies accept any number of fields
+        self.infinite = frozenset(
+            name for name, node in self.segments.items()
+            if node.children and node.children[-1][1].datatype == "varies"
+        )
+        # Segments inside message structures must use the same references as the
+        # segment definitions, so that segments can be checked outside their message
+        self.consistent = all(
+            lib.SEGMENTS.get(name, ref) == ref
+            for name, ref in _segment_refs(list(lib.MESSAGES.values()) + list(lib.GROUPS.values()))
+        )
+
+    def segment(self, name):
+        """
+        Compiled reference of a segment: the HL7 definition, or the site
+        definition of a custom segment, compiled once per registry change.
+        :return: Node, or None for segments without a definition
+        """
+        node = self.segments.get(name)
+        if node is not None or name not in zsegments.registry:
+            return node
+        registry = zsegments.registry
+        if self._custom_generation != registry.generation:
+            self._custom = {}
+            self._custom_generation = registry.generation
+        try:
+            return self._custom[name]
+        except KeyError:
+            reference = registry.reference(name, self.version)
+            node = None
+            if reference is not None:
+                node = self._compile(("sequence", reference[1], None, None, None, -1))
+            self._custom[name] = node
+            return node
+
+    def is_base(self, datatype):
+        try:
+            return self._base[datatype]
+        except KeyError:
+            base = self._base[datatype] = is_base_datatype(datatype, self.version)
+            return base
+
+    def _compile(self, ref):
+        children = None
+        # a sequence without children (missing datatype structure) compiles to a
+        # non-base leaf, which check_segment() leaves to hl7apy
+        if ref[0] in ("sequence", "choice") and ref[1] is not None:
+            children = tuple(
+                (name, self._compile(child_ref), cardinality[0], cardinality[1])
+                for name, child_ref, cardinality, _ in ref[1]
+            )
+        datatype = ref[2]
+        return Node(datatype, ref[3], ref[4], ref[5], self.is_base(datatype), children)
+
+
+def _segment_refs(refs):
+    for ref in refs:
+        for name, child_ref, _, cls in ref[1]:
+            if cls == "SEG":
+                yield name, child_ref
+            elif child_ref[0] in ("sequence", "choice"):
+                yield from _segment_refs([child_ref])
+
+
+# Versions whose tables were built in this process
+_compiled = set()
+
+
+@functools.lru_cache(maxsize=None)
+def load_constraints(version):
+    """Compiled constraint tables of a version, built on first use."""
+    constraints = VersionConstraints(version)
+    _compiled.add(version)
+    return constraints
+
+
+def compiled_versions():
+    """Versions whose constraint tables (and hl7apy definitions) are loaded in this process."""
+    return sorted(_compiled)
+
+
+def _check_repetitions(parent, child, count, minimum, maximum, errors):
+    if count < minimum:
+        errors.append(f"Missing required child {parent}.{child}")
+    elif maximum != -1 and count > maximum:
+        errors.append(f"Child limit exceeded {parent}.{child}")
+
+
+def _check_leaf(vc, node, datatype, value, parent, name, errors, warnings):
+    if node.table is not None:
+        values = vc.tables.get(node.table)
+        if values is not None and value not in values:
+            warnings.append(f"Value {value} not in table {node.table} in element {parent}.{name}")
+    if node.max_length is not None and -1 < node.max_length < len(value):
+        warnings.append(f"Exceeded max length ({node.max_length}) of {parent}.{name}")
+    if datatype == "varies":
+        return
+    if datatype != node.datatype:
+        # hl7apy reports the (empty) children of the leaf reference as the expected type
+        errors.append(f"Datatype {datatype} is not correct for {parent}.{name} (it must be None)")
+
+
+def _check_children(node, present, element, errors):
+    names = {name for name, _ in present}
+    invalid = names - node.by_name.keys()
+    if invalid:
+        errors.append(f"Invalid children detected for {element}: {list(invalid)}")
+
+
+def _check_subcomponents(vc, node, name, text, enc, errors, warnings):
+    present = []
+    for index, value in enumerate(text.split(enc["SUBCOMPONENT"]), 1):
+        sub_name = f"{node.datatype}_{index}"
+        if sub_name not in node.by_name:
+            # hl7apy keeps unknown subcomponents, even empty ones, as ST
+            present.append(("ST", value))
+        elif value.strip():
+            present.append((sub_name, value))
+    _check_children(node, present, f"<Component {name} ({node.long_name}) of type {node.datatype}>", errors)
+    for sub_name, sub_node, minimum, maximum in node.children:
+        values = [value for n, value in present if n == sub_name]
+        _check_repetitions(name, sub_name, len(values), minimum, maximum, errors)
+        for value in values:
+            if sub_node.children is not None or not sub_node.base:
+                raise Unsupported(f"subcomponent {sub_name} of type {sub_node.datatype}")
+            _check_leaf(vc, sub_node, sub_node.datatype, value, name, sub_name, errors, warnings)
+
+
+def _check_components(vc, node, name, text, enc, errors, warnings):
+    present = []
+    for index, value in enumerate(text.split(enc["COMPONENT"]), 1):
+        if not value.strip():
+            continue
+        component_name = f"{node.datatype}_{index}"
+        if component_name in node.by_name:
+            present.append((component_name, value))
+        elif component_name in vc.component_names:
+            raise Unsupported(f"component {component_name} outside the {node.datatype} structure")
+        else:
+            present.append((None, value))
+    _check_children(node, present, f"<Field {name} ({node.long_name}) of type {node.datatype}>", errors)
+    for component_name, component_node, minimum, maximum in node.children:
+        values = [value for n, value in present if n == component_name]
+        _check_repetitions(name, component_name, len(values), minimum, maximum, errors)
+        for value in values:
+            if component_node.children is not None:
+                _check_subcomponents(vc, component_node, component_name, value, enc, errors, warnings)
+            elif component_node.base:
+                datatype = component_node.datatype
+                if len(value.split(enc["SUBCOMPONENT"])) > 1:
+                    datatype = None
+                _check_leaf(vc, component_node, datatype, value, name, component_name, errors, warnings)
+            else:
+                raise Unsupported(f"component {component_name} of type {component_node.datatype}")
+
+
+def _check_field(vc, segment, node, name, text, enc):
+    errors = []
+    warnings = []
+    if node.children is not None:
+        _check_components(vc, node, name, text, enc, errors, warnings)
+    elif node.datatype == "varies":
+        _check_leaf(vc, node, "varies", text.rstrip(enc["COMPONENT"]), segment, name, errors, warnings)
+    elif node.base:
+        datatype = node.datatype
+        if name not in ("MSH_1", "MSH_2") and len(text.split(enc["COMPONENT"])) > 1:
+            # hl7apy (tolerant) drops the datatype of a base field holding components
+            datatype = None
+        _check_leaf(vc, node, datatype, text, segment, name, errors, warnings)
+    else:
+        raise Unsupported(f"field {name} of type {node.datatype}")
+    return Report(errors, warnings)
+
+
+def _split_fields(text, enc):
+    """(field name, repetition text) pairs of a segment, as hl7apy parses them."""
+    segment = text[:3]
+    if segment == "MSH":
+        values = text[3:].split(enc["FIELD"])
+        values[0] = enc["FIELD"]
+    else:
+        values = text[4:].split(enc["FIELD"])
+    fields = []
+    for index, value in enumerate(values, 1):
+        name = f"{segment}_{index}"
+        if name == "MSH_1" or (name == "MSH_2" and value.strip()):
+            fields.append((name, value))
+        elif value.strip():
+            fields.extend((name, rep) for rep in value.split(enc["REPETITION"]))
+    return fields
+
+
+def check_segment(text, version, encoding_chars):
+    """
+    Validate the ER7 text of a segment against the constraint tables.
+    :raises Unsupported: when the segment needs hl7apy to be validated
+    :return: SegmentReport
+    """
+    vc = load_constraints(version)
+    text = text.strip()
+    name = text[:3]
+    segment = vc.segment(name)
+    if segment is None:
+        raise Unsupported(f"segment {name}")
+    escaped = text[8:] if name == "MSH" else text
+    if encoding_chars["ESCAPE"] in escaped:
+        raise Unsupported("escape sequences")
+
+    errors = []
+    warnings = []
+    fields = []
+    present = []
+    for field_name, value in _split_fields(text, encoding_chars):
+        node = segment.by_name.get(field_name)
+        if node is None:
+            if field_name in vc.field_names or name in vc.infinite:
+                raise Unsupported(f"field {field_name} outside the {name} definition")
+            present.append((None, value))
+            fields.append(None)
+        else:
+            report = _check_field(vc, name, node, field_name, value, encoding_chars)
+            present.append((field_name, report))
+            fields.append(report)
+
+    _check_children(segment, present, f"<Segment {name}>", errors)
+    for field_name, _, minimum, maximum in segment.children:
+        reports = [report for n, report in present if n == field_name]
+        _check_repetitions(name, field_name, len(reports), minimum, maximum, errors)
+        for report in reports:
+            errors.extend(report.errors)
+            warnings.extend(report.warnings)
+    return SegmentReport(errors, warnings, fields)
+
+
+def _read_report(report_file):
+    errors = []
+    warnings = []
+    with open(report_file) as f:
+        for line in f:
+            level, message = line.rstrip("\n").split(": ", 1)
+            (errors if level == "Error" else warnings).append(message)
+    return Report(errors, warnings)
+
+
+def _hl7apy_validate(element, report_file):
+    if os.path.exists(report_file):
+        os.remove(report_file)
+    try:
+        Validator.validate(element, reference=element.reference, report_file=report_file)
+    except Exception:
+        if not os.path.exists(report_file):
+            raise
+    return _read_report(report_file)
+
+
+def hl7apy_segment(text, version, encoding_chars):
+    """
+    Validate a segment with hl7apy, for the segments check_segment() does not model.
+    :return: SegmentReport
+    """
+    text = text.strip()
+    segment = parse_segment(
+        text, version=version, encoding_chars=encoding_chars,
+        reference=zsegments.registry.reference(text[:3], version),
+    )
+    fd, report_file = tempfile.mkstemp(prefix="hl7report-", suffix=".txt")
+    os.close(fd)
+    try:
+        report = _hl7apy_validate(segment, report_file)
+        fields = []
+        for child in segment.children:
+            try:
+                child.reference
+            except AttributeError:
+                fields.append(None)
+            else:
+                fields.append(_hl7apy_validate(child, report_file))
+    finally:
+        if os.path.exists(report_file):
+            os.remove(report_file)
+    return SegmentReport(report.errors, report.warnings, fields)
+
+
+def segment_report(text, version, encoding_chars):
+    """Findings of a segment: from the constraint tables when possible, from hl7apy otherwise."""
+    try:
+        return check_segment(text, version, encoding_chars)
+    except Unsupported:
+        return hl7apy_segment(text, version, encoding_chars)
+
+
+def _skeleton_segments(element):
+    for child in element.children:
+        if child.classname == "Segment":
+            yield child
+        else:
+            yield from _skeleton_segments(child)
+
+
+class _Walker:
+    """
+    Validate the groups of a skeleton message like hl7apy's Validator, taking the
+    findings of each segment from its SegmentReport.
+    """
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def validate(self, element, reference):
+        errors = []
+        warnings = []
+        self._is_valid(element, reference, errors, warnings)
+        return Report(errors, warnings)
+
+    def _is_valid(self, element, reference, errors, warnings):
+        if element.classname == "Segment":
+            report = self.reports[id(element)]
+            errors.extend(report.errors)
+            warnings.extend(report.warnings)
+            return
+        if element.is_unknown():
+            errors.append(f"Unknown element found: {element.parent}.{element}")
+            return
+        names = {c.name for c in element.children if not c.is_z_element()}
+        valid = {c[0] for c in reference[1]}
+        if not names <= valid:
+            errors.append(f"Invalid children detected for {element}: {list(names - valid)}")
+        for child_name, child_ref, cardinality, _ in reference[1]:
+            try:
+                children = element.children.get(child_name)
+            except Exception:
+                continue
+            _check_repetitions(element.name, child_name, len(children), *cardinality, errors)
+            for child in children:
+                self._is_valid(child, child_ref, errors, warnings)
+        for child in element.children:
+            if child.is_z_element():
+                self._is_valid(child, None, errors, warnings)
+
+
+def skeleton(text):
+    """
+    The segments of a message and its skeleton: the full MSH followed by the
+    bare IDs of the other segments, which hl7apy parses into the same groups.
+    :return: (list of segment texts, skeleton text)
+    """
+    segments = [s.strip() for s in text.split("\r") if s]
+    return segments, "\r".join(segments[:1] + [s[:3] for s in segments[1:]])
+
+
+def placed_segments(segments, message):
+    """
+    Pair the segment elements of a parsed skeleton with the segment texts
+    they stand for. hl7apy drops segments it cannot place in the message
+    structure, and never parses them.
+    :return: iterator of (segment element, segment text)
+    """
+    position = 0
+    for element in _skeleton_segments(message):
+        while segments[position][:3] != element.name:
+            position += 1
+        yield element, segments[position]
+        position += 1
+
+
+def _message_reports(text, version, encoding_chars, report_for):
+    """
+    Parse the skeleton of a message and pair its segment elements with the
+    reports of the segments in the text.
+    :return: (skeleton message, {id(segment element): SegmentReport})
+    """
+    segments, skeleton_text = skeleton(text)
+    message = parse_message(skeleton_text)
+    reports = {
+        id(element): report_for(segment, version, encoding_chars)
+        for element, segment in placed_segments(segments, message)
+    }
+    return message, reports
+
+
+def validate_message(text, reference_text, version, encoding_chars, report_for=segment_report):
+    """
+    Findings of the structure and per-segment stages of a message.
+
+    :param text: the message, segments separated by carriage returns
+    :param reference_text: the message with its MSH-9 completed for structure detection
+    :param report_for: function giving the SegmentReport of a segment text, e.g. a cached
+        segment_report()
+    :return: (structure, segments) -- structure is the Report of the whole message, or the
+        exception hl7apy raises when the message has no structure reference; segments is a
+        list, per top-level child of the message, of (name, Report, [child Report or None])
+    """
+    message, reports = _message_reports(reference_text, version, encoding_chars, report_for)
+    try:
+        structure = _Walker(reports).validate(message, message.reference)
+    except Exception as err:
+        structure = err
+
+    if reference_text != text:
+        message, reports = _message_reports(text, version, encoding_chars, report_for)
+    walker = _Walker(reports)
+    segments = []
+    for element in message.children:
+        if element.classname == "Segment":
+            report = reports[id(element)]
+            segments.append((element.name, Report(report.errors, report.warnings), report.fields))
+        else:
+            children = [walker.validate(child, child.reference) for child in element.children]
+            segments.append((element.name, walker.validate(element, element.reference), children))
+    return structure, segments
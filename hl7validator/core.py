@@ -0,0 +1,406 @@
+"""
+Flask-free validation core.
+
+:class:`Validator` holds the settings a batch script, CLI or worker process
+would otherwise repeat on every call (validation level, profile, engine,
+preloaded HL7 versions and the per-segment result cache). Importing this
+module does not build the web application, Babel or the Swagger spec::
+
+    from hl7validator.core import Validator
+
+    validator = Validator(validation_level="strict", versions=["2.5", "2.5.1"])
+    result = validator.validate(msg)
+
+Messages over the size limits or the time budget (see ``hl7validator.budget``)
+get a partial "Budget exceeded" result instead of tying up the caller. Very
+large messages can have their segments validated in parallel by the worker
+processes (see ``hl7validator.parallel``), and the conformance of a message
+to several HL7 versions checked by them at once (see ``hl7validator.matrix``).
+Site message profiles (see ``hl7validator.message_profiles``) are checked on
+top of the HL7 definitions when a request names one, and feed messages can be
+checked for duplicates of earlier ones (see ``hl7validator.duplicates``).
+
+Logging goes to the standard ``hl7validator`` logger.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hl7validator import api, health, matrix, message_profiles, parallel
+from hl7validator.budget import BudgetExceeded, Limits, budget_result
+from hl7validator.cache import LRUCache
+from hl7validator.constraints import load_constraints
+from hl7validator.duplicates import DuplicateDetector
+from hl7validator.pool import JobTimeout, WorkerPool, default_workers
+from hl7validator.sampling import SamplingPolicy
+
+
+class Validator:
+    """
+    Validate, render and convert HL7 v2 messages with fixed settings.
+
+    The settings are read-only after construction and the result cache is
+    thread-safe, so a single instance can be shared by any number of threads.
+
+    :param validation_level: 'tolerant' (default), 'strict' or 'both'
+    :param validation_profile: default profile (see api.VALIDATION_PROFILES),
+        defaults to HL7VALIDATOR_VALIDATION_PROFILE
+    :param engine: per-segment engine (see api.VALIDATION_ENGINES), defaults to
+        HL7VALIDATOR_VALIDATION_ENGINE
+    :param versions: HL7 versions whose definitions are loaded and compiled
+        up front instead of on the first message of that version
+    :param cache_size: size of a cache private to this validator; by default
+        the process-wide segment cache is shared
+    :param limits: per-message budgets, defaults to Limits.from_env(). With a
+        time budget, validation and conversion run in worker processes (which
+        keep caches of their own) that are killed when a message overruns
+    :param workers: number of those worker processes, defaults to
+        HL7VALIDATOR_BUDGET_WORKERS, or the CPUs shared by the server workers
+        (see pool.default_workers()); each loads the preloaded versions when it
+        starts (see start())
+    :param parallel_threshold: messages with more segments than this are
+        split into chunks of parallel_chunk_size segments validated by the
+        worker processes at once (tolerant level and fast engine only);
+        defaults to HL7VALIDATOR_PARALLEL_THRESHOLD (1000), 0 disables
+    :param parallel_chunk_size: defaults to HL7VALIDATOR_PARALLEL_CHUNK_SIZE (250)
+    :param sampling: SamplingPolicy of validate_sampled(), defaults to
+        SamplingPolicy.from_env() (None: every message is fully validated)
+    :param profiles: ProfileRegistry of the site message profiles, defaults to
+        the one of HL7VALIDATOR_PROFILES_DIR
+    :param duplicates: DuplicateDetector of validate_sampled(), defaults to
+        DuplicateDetector.from_env() (None: duplicates are not looked for)
+    :raises ValueError: for an unknown profile or engine
+    """
+
+    def __init__(
+        self,
+        validation_level="tolerant",
+        validation_profile=None,
+        engine=None,
+        versions=(),
+        cache_size=None,
+        limits=None,
+        workers=None,
+        parallel_threshold=None,
+        parallel_chunk_size=None,
+        sampling=None,
+        profiles=None,
+        duplicates=None,
+    ):
+        self.validation_level = validation_level
+        self.validation_profile = validation_profile or api.DEFAULT_VALIDATION_PROFILE
+        api.get_validation_profile(self.validation_profile)
+        self.engine = engine or api.DEFAULT_VALIDATION_ENGINE
+        if self.engine not in api.VALIDATION_ENGINES:
+            raise ValueError(
+                f"Unknown validation engine '{self.engine}', expected one of "
+                f"{', '.join(api.VALIDATION_ENGINES)}"
+            )
+        self.cache = api.segment_cache if cache_size is None else LRUCache(cache_size)
+        self.versions = tuple(versions)
+        for version in self.versions:
+            load_constraints(version)
+        self.limits = Limits.from_env() if limits is None else limits
+        self.sampling = SamplingPolicy.from_env() if sampling is None else sampling
+        self.duplicates = DuplicateDetector.from_env() if duplicates is None else duplicates
+        self.profiles = message_profiles.registry if profiles is None else profiles
+        if parallel_threshold is None:
+            parallel_threshold = os.getenv("HL7VALIDATOR_PARALLEL_THRESHOLD", "1000")
+        self.parallel_threshold = int(parallel_threshold)
+        self.parallel_chunk_size = int(
+            parallel_chunk_size or os.getenv("HL7VALIDATOR_PARALLEL_CHUNK_SIZE", "250")
+        )
+        self.workers = None
+        self._executor = None
+        if self.limits.time_budget or self.parallel_threshold:
+            self.workers = WorkerPool(
+                workers or int(os.getenv("HL7VALIDATOR_BUDGET_WORKERS") or default_workers()),
+                initializer=warm_up,
+                initargs=(self.versions,),
+            )
+            # one thread per worker process, each blocking on its process
+            self._executor = ThreadPoolExecutor(
+                self.workers.size, thread_name_prefix="validation-jobs"
+            )
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a validator from the HL7VALIDATOR_* environment variables.
+        HL7VALIDATOR_PRELOAD_VERSIONS is a comma separated list of versions.
+        """
+        versions = os.getenv("HL7VALIDATOR_PRELOAD_VERSIONS", "")
+        return cls(versions=[v.strip() for v in versions.split(",") if v.strip()])
+
+    def stages(self, validation_profile=None):
+        """
+        Stages run by a profile, or by this validator's default profile.
+        :raises ValueError: for unknown profile names
+        """
+        return api.get_validation_profile(validation_profile or self.validation_profile)
+
+    @property
+    def _isolated(self):
+        # whole messages run in the worker processes only to enforce the time budget
+        return bool(self.limits.time_budget)
+
+    def _run(self, fn, *args, **kwargs):
+        if not self._isolated:
+            return fn(*args, **kwargs)
+        return self.workers.run(self.limits.time_budget, fn, *args, **kwargs)
+
+    def _deadline(self):
+        return time.monotonic() + self.limits.time_budget if self._isolated else None
+
+    def _run_until(self, deadline, fn, *args, **kwargs):
+        """_run() for one of several jobs sharing a _deadline(), _run() without one."""
+        if deadline is None:
+            return self._run(fn, *args, **kwargs)
+        return self.workers.run_until(deadline, fn, *args, **kwargs)
+
+    def _run_many(self, fn, jobs, deadline=None):
+        """
+        Run independent jobs (argument tuples of fn) on the worker processes
+        at once, all within one time budget; in this process without workers.
+        :param deadline: of the time budget when it started earlier, see _deadline()
+        :return: the results in job order
+        """
+        if self.workers is None:
+            return [fn(*job) for job in jobs]
+        if deadline is None:
+            deadline = self._deadline()
+
+        def run(job):
+            if deadline is None:
+                return self.workers.run(None, fn, *job)
+            return self.workers.run_until(deadline, fn, *job)
+
+        return list(self._executor.map(run, jobs))
+
+    def validate(self, msg, validation_level=None, validation_profile=None, profile=None):
+        """
+        Validate a message; see api.hl7validatorapi() for the result.
+        :param profile: ID of a site message profile to check as well, or a CompiledProfile
+        :raises ValueError: for an empty message, an unknown validation profile or an
+            unknown message profile
+        """
+        profile = self.profiles.get(profile)
+        reason = self.limits.check(msg)
+        if reason:
+            return budget_result(msg, reason)
+        validation_level = validation_level or self.validation_level
+        validation_profile = validation_profile or self.validation_profile
+        deadline = None
+        try:
+            if parallel.applies(
+                msg, self.parallel_threshold, validation_level,
+                self.stages(validation_profile), self.engine,
+            ):
+                # the stages of a parallel validation and its serial fallback share one budget
+                deadline = self._deadline()
+                result = parallel.validate(
+                    msg,
+                    lambda jobs: self._run_many(parallel.validate_chunk, jobs, deadline),
+                    self.parallel_chunk_size,
+                    validation_profile,
+                    profile,
+                    run=lambda fn, *args: self._run_until(deadline, fn, *args),
+                )
+                if result is not None:
+                    return result
+            return self._run_until(
+                deadline,
+                api.hl7validatorapi,
+                msg,
+                validation_level=validation_level,
+                validation_profile=validation_profile,
+                engine=self.engine,
+                cache=None if self._isolated else self.cache,
+                profile=profile,
+            )
+        except JobTimeout:
+            return budget_result(
+                msg, f"validation did not finish within {self.limits.time_budget:g} s"
+            )
+
+    def validate_sampled(self, msg, validation_level=None):
+        """
+        Validate a message of a high-volume feed under the sampling policy:
+        messages in the sample get the full validation with the default
+        profile, the others only the header checks. The result tells which
+        in its "sampled" key, and is counted in sampling.stats. Resent
+        messages get a duplicate finding.
+        """
+        if self.sampling is None:
+            return self.check_duplicate(msg, self.validate(msg, validation_level))
+        sampled, group = self.sampling.decide(msg)
+        if sampled:
+            result = self.validate(msg, validation_level)
+        else:
+            result = api.hl7validatorapi(
+                msg, validation_level=validation_level, validation_profile="header"
+            )
+        result["sampled"] = sampled
+        self.sampling.record(group, sampled, result)
+        return self.check_duplicate(msg, result)
+
+    def check_duplicate(self, msg, result):
+        """
+        Remember a feed message and add a warning to its validation result when
+        an earlier one had the same sender, facility and control ID.
+        """
+        if self.duplicates is None:
+            return result
+        finding = self.duplicates.finding(msg)
+        if finding:
+            result["details"] = (result.get("details") or []) + [finding]
+        return result
+
+    def conformance_matrix(self, msg, versions=None, validation_level=None):
+        """
+        Check a message against several HL7 versions, whatever its MSH-12
+        says; see matrix.conformance_matrix() for the result. The versions
+        are checked by the worker processes at once when there are any.
+        :raises ValueError: for an empty message or unsupported versions
+        :raises BudgetExceeded: when the message is over the limits or the time budget
+        """
+        reason = self.limits.check(msg)
+        if reason:
+            raise BudgetExceeded(reason)
+        try:
+            return matrix.conformance_matrix(
+                msg, versions, validation_level or self.validation_level, run=self._run_many
+            )
+        except JobTimeout:
+            raise BudgetExceeded(
+                f"conformance check did not finish within {self.limits.time_budget:g} s"
+            ) from None
+
+    def validate_incremental(self, msg, validation_level=None):
+        """
+        Full validation reusing cached per-segment results, for editors that
+        resubmit the same message with small changes.
+        """
+        reason = self.limits.check(msg)
+        if reason:
+            return budget_result(msg, reason)
+        try:
+            return self._run(
+                api.hl7validatorapi_incremental,
+                msg,
+                validation_level=validation_level or self.validation_level,
+                cache=None if self._isolated else self.cache,
+            )
+        except JobTimeout:
+            return budget_result(
+                msg, f"validation did not finish within {self.limits.time_budget:g} s"
+            )
+
+    def highlight(self, msg, validation, checks=True):
+        """
+        Render a validated message as HTML.
+        :return: (html, validation) -- findings made while rendering are added to validation
+        :raises BudgetExceeded: when rendering did not finish within the time budget
+        """
+        try:
+            return self._run(
+                api.highlight_message, msg, validation, checks=checks,
+                cache=None if self._isolated else self.cache,
+            )
+        except JobTimeout:
+            raise BudgetExceeded(
+                f"rendering did not finish within {self.limits.time_budget:g} s"
+            ) from None
+
+    def tree(self, msg, validation):
+        """
+        Render a validated message as a collapsible HTML tree.
+        :return: (html, validation)
+        :raises BudgetExceeded: when rendering did not finish within the time budget
+        """
+        try:
+            return self._run(api.build_tree_structure, msg, validation)
+        except JobTimeout:
+            raise BudgetExceeded(
+                f"rendering did not finish within {self.limits.time_budget:g} s"
+            ) from None
+
+    def convert(self, msg):
+        """
+        Write the message fields to a CSV file named after MSH-10.
+        :return: the file name
+        :raises BudgetExceeded: when the message is over the limits or the time budget
+        """
+        reason = self.limits.check(msg)
+        if reason:
+            raise BudgetExceeded(reason)
+        try:
+            return self._run(api.from_hl7_to_df, msg)
+        except JobTimeout:
+            raise BudgetExceeded(
+                f"conversion did not finish within {self.limits.time_budget:g} s"
+            ) from None
+
+    def stats(self):
+        return self.cache.stats()
+
+    def start(self):
+        """
+        Start the worker processes now instead of on the first messages, so
+        they have loaded the preloaded versions by then. Call it in the
+        process that serves the requests, e.g. a gunicorn worker after the fork.
+        """
+        if self.workers is not None:
+            self.workers.start()
+
+    def use_workers(self, workers):
+        """
+        Run the jobs on the processes of another WorkerPool, e.g. those of a
+        ValidationPool, instead of processes of its own. Call it before start();
+        a validator without worker processes is left as is.
+        """
+        if self.workers is None:
+            return
+        self.close()
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(workers.size, thread_name_prefix="validation-jobs")
+
+    def close(self):
+        """Stop the worker processes, if any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self.workers is not None:
+            self.workers.shutdown()
+
+
+def warm_up(versions):
+    """
+    Worker process initializer: load and compile the definitions of the
+    preloaded HL7 versions and validate a message of each, so the first jobs
+    of the process do not pay for it.
+    """
+    for version in versions:
+        load_constraints(version)
+        api.hl7validatorapi(health.SELF_TEST_MESSAGE.replace("|P|2.5\r", f"|P|{version}\r"))
+
+
+def validate_job(data, validation_level, validation_profile=None, profile=None):
+    """
+    Process pool job: validate a message and return the result dict. The
+    pool enforces the time budget and the caller the size limits.
+    :param profile: CompiledProfile of a site message profile
+    """
+    return api.hl7validatorapi(
+        data, validation_level=validation_level, validation_profile=validation_profile,
+        profile=profile,
+    )
+
+
+def convert_job(data):
+    """Process pool job: convert a message to CSV and return (filename, content)."""
+    file = api.from_hl7_to_df(data)
+    with open(file, "rb") as f:
+        content = f.read()
+    os.remove(file)
+    return file, content
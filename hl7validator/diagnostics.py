@@ -0,0 +1,324 @@
+"""
+Memory diagnostics of a running worker, for finding leaks without a debugger.
+
+The endpoints are only registered when HL7VALIDATOR_ADMIN_TOKEN is set, and
+answer requests with an ``Authorization: Bearer <token>`` header:
+
+- ``GET /admin/memory``: RSS of this worker, its validation processes and the
+  other gunicorn workers, live hl7apy elements by class (``?collect=true``
+  runs the garbage collector first, to tell garbage from leaks), cache sizes
+  and the tracemalloc state;
+- ``POST /admin/memory/tracemalloc/start`` (``{"frames": 1}``) and ``.../stop``;
+- ``POST /admin/memory/tracemalloc/snapshot``: top allocation sites
+  (``?limit=20&group_by=lineno|filename|traceback``) and, from the second
+  snapshot on, what changed since the previous one.
+
+The census, tracing and snapshots also run in each started validation
+process, where messages are parsed, and are reported per pool under
+``"pools"``, one entry per process PID.
+
+Each request is answered by one worker, whose PID is in the report: snapshots
+are per process, so compare those of the same PID. Tracing slows allocations
+down; stop it when done.
+"""
+
+import gc
+import hmac
+import os
+import threading
+import tracemalloc
+from collections import Counter
+
+ADMIN_PREFIX = "/admin/memory"
+GROUP_BY = ("lineno", "filename", "traceback")
+# seconds a validation process may take to answer, once idle
+POOL_TIMEOUT = 60
+
+# last snapshot of this process, for the next diff
+_snapshot = None
+_lock = threading.Lock()
+
+
+def rss(pid):
+    """Resident memory of a process in bytes, None when unknown (not Linux, process gone)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _stat(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def children(pid):
+    """PIDs of the child processes of a process (Linux)."""
+    found = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return found
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = _stat(entry)
+        # the command name, in parentheses, may contain spaces
+        if stat and int(stat.rpartition(")")[2].split()[1]) == pid:
+            found.append(int(entry))
+    return found
+
+
+def tree_rss(pid):
+    """Resident memory of a process and its children (the validation processes)."""
+    total = rss(pid)
+    if total is None:
+        return None
+    for child in children(pid):
+        total += rss(child) or 0
+    return total
+
+
+def _is_gunicorn(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return b"gunicorn" in f.read()
+    except OSError:
+        return False
+
+
+def processes():
+    """
+    RSS of this process, its validation processes and, under gunicorn, the
+    other workers of the same master.
+    """
+    pid = os.getpid()
+    report = {
+        "pid": pid,
+        "rss": rss(pid),
+        "validation_processes": [{"pid": child, "rss": rss(child)} for child in children(pid)],
+    }
+    master = os.getppid()
+    if _is_gunicorn(master):
+        report["workers"] = [
+            {"pid": worker, "rss": rss(worker), "total_rss": tree_rss(worker)}
+            for worker in sorted(children(master))
+        ]
+    return report
+
+
+def element_census(collect=False):
+    """
+    Live hl7apy elements of this process by class.
+    :param collect: run the garbage collector first; what is left is referenced
+    """
+    from hl7apy.core import Element
+
+    if collect:
+        gc.collect()
+    counts = Counter(
+        type(obj).__name__ for obj in gc.get_objects() if isinstance(obj, Element)
+    )
+    return {"total": sum(counts.values()), "by_class": dict(counts.most_common())}
+
+
+def _frames(stat):
+    return [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+
+
+def _top(stats, limit):
+    top = []
+    for stat in stats[:limit]:
+        item = {"site": _frames(stat)[0], "size": stat.size, "count": stat.count}
+        if hasattr(stat, "size_diff"):
+            item.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+        if len(stat.traceback) > 1:
+            item["traceback"] = _frames(stat)
+        top.append(item)
+    return top
+
+
+def tracing():
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": tracemalloc.is_tracing(),
+        "frames": tracemalloc.get_traceback_limit(),
+        "traced": current,
+        "peak": peak,
+        "snapshot": _snapshot is not None,
+    }
+
+
+def start_tracing(frames=1):
+    """
+    :raises ValueError: for a frame count under 1
+    """
+    if frames < 1:
+        raise ValueError("frames must be at least 1")
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+    return tracing()
+
+
+def stop_tracing():
+    global _snapshot
+    with _lock:
+        _snapshot = None
+    tracemalloc.stop()
+    return tracing()
+
+
+def snapshot(limit=20, group_by="lineno"):
+    """
+    Take a snapshot of the traced allocations.
+    :return: the top allocation sites, and the top changes since the previous
+        snapshot of this process when there is one
+    :raises ValueError: when tracemalloc is not tracing, or for an unknown group_by
+    """
+    global _snapshot
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Unknown group_by '{group_by}', expected one of {', '.join(GROUP_BY)}")
+    if not tracemalloc.is_tracing():
+        raise ValueError("tracemalloc is not tracing, start it first")
+    current = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ])
+    with _lock:
+        previous, _snapshot = _snapshot, current
+    report = {"pid": os.getpid(), "top": _top(current.statistics(group_by), limit)}
+    if previous is not None:
+        report["diff"] = _top(current.compare_to(previous, group_by), limit)
+    return report
+
+
+def _caches():
+    from hl7validator import api, tables
+
+    return {
+        "segments": api.segment_cache.stats(),
+        "table_findings": tables.finding_cache.stats(),
+    }
+
+
+def process_report(collect=False):
+    """Memory report of a validation process, run in each one by the pools."""
+    pid = os.getpid()
+    return {
+        "pid": pid,
+        "rss": rss(pid),
+        "elements": element_census(collect),
+        "caches": _caches(),
+        "gc": {"counts": gc.get_count(), "uncollectable": len(gc.garbage)},
+        "tracemalloc": tracing(),
+    }
+
+
+def in_pools(pools, fn, *args):
+    """
+    Run fn(*args) in every started process of the pools.
+    :param pools: dict of name to a pool with run_each (see pool.WorkerPool)
+    :return: dict of pool name to the results with the PID of their process
+    """
+    return {
+        name: [
+            dict(result, pid=pid)
+            for pid, result in pool.run_each(POOL_TIMEOUT, _with_pid, fn, *args)
+        ]
+        for name, pool in pools.items()
+    }
+
+
+def _with_pid(fn, *args):
+    return os.getpid(), fn(*args)
+
+
+def memory_report(collect=False, pools=None):
+    """
+    :param pools: dict of name to a validation pool whose processes are reported too
+    """
+    report = {
+        "processes": processes(),
+        "elements": element_census(collect),
+        "caches": _caches(),
+        "gc": {"counts": gc.get_count(), "uncollectable": len(gc.garbage)},
+        "tracemalloc": tracing(),
+    }
+    if pools:
+        report["pools"] = in_pools(pools, process_report, collect)
+    return report
+
+
+def unauthorized(token):
+    """
+    The 401 response to the current Flask request, or None when it has the
+    admin token in an ``Authorization: Bearer`` header.
+    """
+    from flask import jsonify, request
+
+    scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+    if (
+        token
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(given.encode(), token.encode())
+    ):
+        return None
+    response = jsonify({"statusCode": "Failed", "message": "Unauthorized"})
+    response.status_code = 401
+    response.headers["WWW-Authenticate"] = "Bearer"
+    return response
+
+
+def init_app(app, pools=None):
+    """
+    Register the memory diagnostics endpoints on a Flask app, when
+    app.config["ADMIN_TOKEN"] is set.
+    :param pools: dict of name to a validation pool (with run_each) whose
+        processes are inspected as well; kept in
+        app.extensions["hl7validator.diagnostics"] for more to be added
+    """
+    from flask import jsonify, request
+
+    token = app.config.get("ADMIN_TOKEN")
+    if not token:
+        return False
+    pools = app.extensions["hl7validator.diagnostics"] = dict(pools or {})
+
+    @app.route(ADMIN_PREFIX, methods=["GET"])
+    def admin_memory():
+        denied = unauthorized(token)
+        if denied:
+            return denied
+        collect = request.args.get("collect", "false").lower() == "true"
+        return jsonify(memory_report(collect, pools))
+
+    @app.route(ADMIN_PREFIX + "/tracemalloc/<any(start, stop, snapshot):action>", methods=["POST"])
+    def admin_tracemalloc(action):
+        denied = unauthorized(token)
+        if denied:
+            return denied
+        options = request.get_json(silent=True) or {}
+        try:
+            if action == "start":
+                job = (start_tracing, int(options.get("frames", 1)))
+            elif action == "stop":
+                job = (stop_tracing,)
+            else:
+                job = (
+                    snapshot,
+                    int(request.args.get("limit", options.get("limit", 20))),
+                    request.args.get("group_by", options.get("group_by", "lineno")),
+                )
+            report = dict(job[0](*job[1:]), pid=os.getpid())
+            if pools:
+                report["pools"] = in_pools(pools, *job)
+            return jsonify(report)
+        except ValueError as err:
+            return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+
+    return True
@@ -0,0 +1,301 @@
+"""
+Detection of resent and duplicated messages.
+
+A message is identified by its sender, facility and control ID (MSH-3, MSH-4,
+MSH-10), read on the raw text without parsing. The detector remembers the
+identifiers and a hash of the content of the messages of the last
+HL7VALIDATOR_DUPLICATE_WINDOW seconds, and reports a message whose identifier
+was already seen: with the same content (a duplicate), or with another
+content (a reused control ID).
+
+Messages are remembered in rotating Bloom filters: the window is split in
+slices, each with a filter of its own that is cleared when its slice comes
+round again. Memory is fixed whatever the traffic (sized for
+HL7VALIDATOR_DUPLICATE_CAPACITY messages per window) and a lookup costs a
+few hashes per slice. A Bloom filter never misses a message it holds, but
+may report one it does not hold with a probability of about
+HL7VALIDATOR_DUPLICATE_ERROR_RATE when the traffic is within the capacity.
+
+The filters live in memory, per process, or in a file (HL7VALIDATOR_DUPLICATE_STORE)
+mapped by all the workers of the host, so that a message resent to another
+worker is recognized.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from hl7validator.sampling import msh_fields
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of a process are serialized
+    fcntl = None
+
+DUPLICATE = "duplicate"
+REUSED_CONTROL_ID = "reused control ID"
+
+_MAGIC = b"HL7DUPBF"
+_HEADER = struct.Struct("<8sIIQd")  # magic, slices, hashes, bits per slice, slice seconds
+_HEADER_SIZE = 64
+_EPOCH = struct.Struct("<q")
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class RotatingBloomFilter:
+    """
+    Set of the keys added within the last ``window`` seconds, with false
+    positives at about ``error_rate`` for up to ``capacity`` keys per window.
+
+    :param slices: the window is split in this many slices; keys are kept
+        between window and window * (1 + 1 / slices) seconds
+    :param path: file shared by the processes that map it, in memory when None
+    """
+
+    def __init__(self, window, capacity, error_rate=0.001, slices=4, path=None):
+        if window <= 0 or capacity <= 0 or not 0 < error_rate < 1 or slices < 1:
+            raise ValueError(
+                "The duplicate window, capacity and slices must be positive and the "
+                "error rate between 0 and 1"
+            )
+        self.window = window
+        self.slices = slices + 1  # the current slice, being filled, and the full ones
+        self.slice_seconds = window / slices
+        # the keys of a slice, each false positive chance adding up over the slices
+        keys = max(1, math.ceil(capacity / slices))
+        rate = error_rate / self.slices
+        self.bits = max(64, math.ceil(-keys * math.log(rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / keys * math.log(2)))
+        self.slice_bytes = (self.bits + 7) // 8
+        self.size = _HEADER_SIZE + self.slices * (_EPOCH.size + self.slice_bytes)
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._data = None
+
+    def _open(self):
+        # after a fork, the file is opened again: locks are held per open file
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if self.path is None:
+            if self._data is None:
+                self._data = bytearray(self.size)
+            return
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+        self._file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        with self._locked():
+            header = _HEADER.pack(
+                _MAGIC, self.slices, self.hashes, self.bits, self.slice_seconds
+            )
+            self._file.seek(0)
+            if self._file.read(_HEADER.size) != header or os.path.getsize(self.path) != self.size:
+                # new file, or one sized for other settings
+                self._file.truncate(0)
+                self._file.write(header.ljust(_HEADER_SIZE, b"\0"))
+                self._file.truncate(self.size)
+                self._file.flush()
+            self._data = mmap.mmap(self._file.fileno(), self.size)
+
+    def _locked(self):
+        return _FileLock(self._file)
+
+    def _epoch_offset(self, index):
+        return _HEADER_SIZE + index * _EPOCH.size
+
+    def _slice_offset(self, index):
+        return _HEADER_SIZE + self.slices * _EPOCH.size + index * self.slice_bytes
+
+    def _positions(self, key):
+        digest = _digest(key)
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.bits for i in range(self.hashes)]
+
+    def _contains(self, positions, now_epoch):
+        data = self._data
+        for index in range(self.slices):
+            (epoch,) = _EPOCH.unpack_from(data, self._epoch_offset(index))
+            if now_epoch - epoch >= self.slices:
+                continue  # cleared when its slice comes round again
+            base = self._slice_offset(index)
+            if all(data[base + (p >> 3)] & (1 << (p & 7)) for p in positions):
+                return True
+        return False
+
+    def _add(self, positions, now_epoch):
+        data = self._data
+        index = now_epoch % self.slices
+        offset = self._epoch_offset(index)
+        base = self._slice_offset(index)
+        if _EPOCH.unpack_from(data, offset)[0] != now_epoch:
+            data[base:base + self.slice_bytes] = bytes(self.slice_bytes)
+            _EPOCH.pack_into(data, offset, now_epoch)
+        for p in positions:
+            data[base + (p >> 3)] |= 1 << (p & 7)
+
+    def add(self, *keys, now=None):
+        """
+        Add keys, telling which were already there.
+        :return: list of booleans, True for the keys seen within the window
+        """
+        now_epoch = int((time.time() if now is None else now) // self.slice_seconds)
+        with self._lock:
+            self._open()
+            with self._locked():
+                seen = []
+                for key in keys:
+                    positions = self._positions(key)
+                    seen.append(self._contains(positions, now_epoch))
+                    self._add(positions, now_epoch)
+                return seen
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._data, mmap.mmap):
+                self._data.close()
+            if self._file is not None:
+                self._file.close()
+            self._data = self._file = self._pid = None
+
+
+class _FileLock:
+    """Exclusive lock of a file shared by several processes, a no-op without one."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        if self.file is not None and fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        if self.file is not None and fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+
+def message_keys(msg):
+    """
+    Keys of the identifier (MSH-3, MSH-4, MSH-10) and of the content of a message.
+    :return: (identifier key, content key, fields), None when it has no MSH-10
+    """
+    fields, _ = msh_fields(msg)
+    if not fields.get(10):
+        return None
+    identifier = "\x1f".join((fields[3], fields[4], fields[10])).encode("utf-8", "surrogatepass")
+    # the same message with other line endings or trailing blanks is the same content
+    content = "\r".join(
+        segment.rstrip() for segment in _SEGMENT_SEPARATORS.split(msg.strip()) if segment.strip()
+    )
+    return (
+        b"id\0" + identifier,
+        b"msg\0" + identifier + _digest(content.encode("utf-8", "surrogatepass")),
+        fields,
+    )
+
+
+class DuplicateDetector:
+    """
+    Reports the messages whose sender, facility and control ID were seen
+    within the window, with the same content or not.
+
+    :param window: seconds a message is remembered
+    :param capacity: messages per window the filters are sized for
+    :param error_rate: chance of reporting a message that was not seen
+    :param path: file shared by the workers of the host, in memory when None
+    """
+
+    def __init__(self, window=86400, capacity=1000000, error_rate=0.001, path=None):
+        # two keys per message: its identifier and its content
+        self.filter = RotatingBloomFilter(window, 2 * capacity, error_rate, path=path)
+        self.window = window
+        self.counts = {"checked": 0, DUPLICATE: 0, REUSED_CONTROL_ID: 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a detector from the HL7VALIDATOR_DUPLICATE_* environment variables.
+        :return: None when HL7VALIDATOR_DUPLICATE_WINDOW is 0 or unset
+        """
+        window = float(os.getenv("HL7VALIDATOR_DUPLICATE_WINDOW", "0"))
+        if window <= 0:
+            return None
+        return cls(
+            window=window,
+            capacity=int(os.getenv("HL7VALIDATOR_DUPLICATE_CAPACITY", "1000000")),
+            error_rate=float(os.getenv("HL7VALIDATOR_DUPLICATE_ERROR_RATE", "0.001")),
+            path=os.getenv("HL7VALIDATOR_DUPLICATE_STORE") or None,
+        )
+
+    def check(self, msg, now=None):
+        """
+        Remember a message and tell whether an earlier one had its identifier.
+        :return: (outcome, MSH fields), outcome being DUPLICATE, REUSED_CONTROL_ID
+            or None; (None, {}) for a message without a control ID (MSH-10),
+            which is neither checked nor remembered
+        """
+        keys = message_keys(msg)
+        if keys is None:
+            return None, {}
+        identifier, content, fields = keys
+        seen_identifier, seen_content = self.filter.add(identifier, content, now=now)
+        outcome = None
+        if seen_content:
+            outcome = DUPLICATE
+        elif seen_identifier:
+            outcome = REUSED_CONTROL_ID
+        with self._lock:
+            self.counts["checked"] += 1
+            if outcome:
+                self.counts[outcome] += 1
+        return outcome, fields
+
+    def finding(self, msg, now=None):
+        """
+        :return: the Warning finding of a duplicate or a reused control ID, or None
+        """
+        outcome, fields = self.check(msg, now)
+        if outcome is None:
+            return None
+        sender = f"MSH-10 '{fields[10]}' from '{fields[3]}' at '{fields[4]}'"
+        if outcome == DUPLICATE:
+            message = (
+                f"Duplicate of an earlier message: {sender} was received with the same "
+                f"content within the last {self.window:g} s"
+            )
+        else:
+            message = (
+                f"Control ID reused: {sender} was received with a different content "
+                f"within the last {self.window:g} s"
+            )
+        return {"level": "Warning", "message": message}
+
+    def metrics(self):
+        """Render the duplicate counters in Prometheus text format."""
+        with self._lock:
+            counts = dict(self.counts)
+        return (
+            "# TYPE hl7validator_duplicates_checked_total counter\n"
+            f"hl7validator_duplicates_checked_total {counts['checked']}\n"
+            "# TYPE hl7validator_duplicates_total counter\n"
+            f'hl7validator_duplicates_total{{kind="duplicate"}} {counts[DUPLICATE]}\n'
+            f'hl7validator_duplicates_total{{kind="reused_control_id"}} '
+            f"{counts[REUSED_CONTROL_ID]}\n"
+        )
+
+    def close(self):
+        self.filter.close()
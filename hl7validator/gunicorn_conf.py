@@ -0,0 +1,240 @@
+"""
+Gunicorn configuration sized from the host, with worker recycling.
+
+``docker/gunicorn.sh`` runs gunicorn with ``-c python:hl7validator.gunicorn_conf``.
+Every setting can be overridden with the GUNICORN_* environment variables;
+the others are derived from the CPUs and memory the process may use (cgroup
+v1/v2 quotas in containers):
+
+- workers: one per usable CPU (at least 2, in ASGI mode 2 since each worker
+  has its own validation pool), no more than fit in the memory limit at
+  GUNICORN_WORKER_MEMORY each plus GUNICORN_PROCESS_MEMORY per validation
+  process, one worker share being kept for the master;
+- the validation processes of each worker default to its share of the
+  usable CPUs: the worker count is passed to the application as
+  HL7VALIDATOR_SERVER_WORKERS (see pool.default_workers);
+- the application is preloaded in the master, so the web stack (Flask,
+  templates, Swagger spec) is shared copy-on-write by the workers; the
+  validation processes of each worker are spawned, not forked, and load
+  the preloaded HL7 versions themselves when the worker starts them;
+- workers are restarted after GUNICORN_MAX_REQUESTS requests, plus a random
+  jitter so they do not all restart at once: hl7apy object churn makes the
+  memory of long-lived workers creep up;
+- a watchdog thread in each worker restarts it gracefully (it finishes its
+  requests) when the RSS of the worker and its validation processes goes over
+  GUNICORN_MAX_WORKER_RSS, by default their share of the memory limit and
+  never less than their expected size.
+
+``python -m hl7validator.gunicorn_conf`` prints the settings this host gets;
+gunicorn logs them at startup.
+"""
+
+import gc
+import os
+import signal
+import sys
+import threading
+
+from hl7validator.diagnostics import rss, tree_rss
+from hl7validator.pool import cpu_count
+
+MIB = 1024 * 1024
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def memory_limit(cgroup_root="/sys/fs/cgroup"):
+    """Bytes of memory this process may use: the cgroup limit or the physical memory."""
+    limits = []
+    for path in (
+        os.path.join(cgroup_root, "memory.max"),  # v2
+        os.path.join(cgroup_root, "memory", "memory.limit_in_bytes"),  # v1
+    ):
+        value = _read(path)
+        if value and value.isdigit():
+            limits.append(int(value))
+    try:
+        limits.append(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+    except (AttributeError, OSError, ValueError):
+        pass
+    # v1 reports "no limit" as a huge number, hence the minimum with the physical memory
+    return min(limits) if limits else None
+
+
+def _int(env, name, default):
+    value = env.get(name, "").strip()
+    return int(value) if value else default
+
+
+def settings(env=None, cpus=None, memory=None):
+    """
+    Gunicorn settings for this host.
+    :param env: environment variables, defaults to os.environ
+    :param cpus: usable CPUs, detected when None
+    :param memory: memory limit in bytes, detected when None
+    :return: dict of gunicorn setting names to values, plus "max_worker_rss"
+        (bytes, 0 disables the watchdog), "watchdog_interval",
+        "validation_processes" per worker and "sizing", how the number of
+        workers was chosen
+    """
+    env = os.environ if env is None else env
+    cpus = cpu_count() if cpus is None else cpus
+    memory = memory_limit() if memory is None else memory
+    asgi = env.get("HL7VALIDATOR_SERVER_MODE", "wsgi") == "asgi"
+    worker_memory = _int(env, "GUNICORN_WORKER_MEMORY", 256) * MIB
+    process_memory = _int(env, "GUNICORN_PROCESS_MEMORY", 48) * MIB
+    processes_setting = "HL7VALIDATOR_POOL_WORKERS" if asgi else "HL7VALIDATOR_BUDGET_WORKERS"
+
+    def processes(workers):
+        # validation processes started by each worker, as pool.default_workers() counts them
+        return _int(env, processes_setting, 0) or max(1, cpus // workers)
+
+    def tree_memory(workers):
+        return worker_memory + processes(workers) * process_memory
+
+    workers = _int(env, "GUNICORN_WORKERS", 0)
+    if workers:
+        sizing = "GUNICORN_WORKERS"
+    else:
+        workers = 2 if asgi else max(2, cpus)
+        sizing = f"{cpus} CPUs"
+        if memory:
+            # the workers with their validation processes, one worker share kept for the master
+            while workers > 1 and workers * tree_memory(workers) + worker_memory > memory:
+                workers -= 1
+            sizing += (
+                f", {memory // MIB} MiB for {worker_memory // MIB} MiB workers with "
+                f"{process_memory // MIB} MiB validation processes"
+            )
+
+    max_requests = _int(env, "GUNICORN_MAX_REQUESTS", 1000)
+    max_worker_rss = _int(env, "GUNICORN_MAX_WORKER_RSS", -1)
+    if max_worker_rss < 0:
+        # compared with the worker and its validation processes: their share of the memory
+        # limit, or 4 times their expected size
+        if memory:
+            max_worker_rss = max(tree_memory(workers), (memory - worker_memory) // workers)
+        else:
+            max_worker_rss = 4 * tree_memory(workers)
+    else:
+        max_worker_rss *= MIB
+
+    config = {
+        "bind": env.get("GUNICORN_BIND", "0.0.0.0:80"),
+        "workers": workers,
+        "loglevel": env.get("GUNICORN_LOG_LEVEL", "info"),
+        "preload_app": env.get("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes"),
+        "max_requests": max_requests,
+        "max_requests_jitter": _int(env, "GUNICORN_MAX_REQUESTS_JITTER", max_requests // 10),
+        "timeout": _int(env, "GUNICORN_TIMEOUT", 120),
+        "graceful_timeout": _int(env, "GUNICORN_GRACEFUL_TIMEOUT", 30),
+        "keepalive": _int(env, "GUNICORN_KEEPALIVE", 5),
+    }
+    if asgi:
+        config["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        config["threads"] = _int(env, "GUNICORN_THREADS", 2)
+    config["max_worker_rss"] = max_worker_rss
+    config["watchdog_interval"] = float(env.get("GUNICORN_WATCHDOG_INTERVAL", "10"))
+    config["validation_processes"] = processes(workers)
+    config["sizing"] = sizing
+    return config
+
+
+def describe(config):
+    """One line per setting, as logged at startup."""
+    lines = []
+    for name, value in config.items():
+        if name == "sizing":
+            continue
+        if name == "workers":
+            value = f"{value} ({config['sizing']})"
+        elif name == "max_worker_rss":
+            value = f"{value // MIB} MiB" if value else "off"
+        elif name == "validation_processes":
+            value = f"{value} per worker"
+        lines.append(f"{name}: {value}")
+    return lines
+
+
+class MemoryWatchdog(threading.Thread):
+    """
+    Restarts a gunicorn worker gracefully when its RSS, with its validation
+    processes, goes over a limit: the worker is sent SIGTERM, finishes its
+    requests within the graceful timeout and the master starts a new one.
+    """
+
+    def __init__(self, worker, limit, interval=10):
+        super().__init__(name="memory-watchdog", daemon=True)
+        self.worker = worker
+        self.limit = limit
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def check(self):
+        """
+        :return: True when the worker was asked to restart
+        """
+        used = tree_rss(self.worker.pid)
+        if used is None or used <= self.limit:
+            return False
+        self.worker.log.warning(
+            f"Worker {self.worker.pid} uses {used // MIB} MiB, over the "
+            f"{self.limit // MIB} MiB limit: restarting it"
+        )
+        os.kill(self.worker.pid, signal.SIGTERM)
+        return True
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            if self.check():
+                return
+
+    def stop(self):
+        self.stopping.set()
+
+
+# settings of this module that are not gunicorn's
+_OWN_SETTINGS = ("max_worker_rss", "watchdog_interval", "validation_processes", "sizing")
+
+_settings = settings()
+globals().update({k: v for k, v in _settings.items() if k not in _OWN_SETTINGS})
+if "gunicorn" in sys.modules:
+    # loaded by gunicorn, before the application: the validation processes of each worker
+    # default to its share of the CPUs (see pool.default_workers)
+    os.environ["HL7VALIDATOR_SERVER_WORKERS"] = str(_settings["workers"])
+
+
+def on_starting(server):
+    for line in describe(_settings):
+        server.log.info(line)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # objects loaded by the master stay out of the collector, so the workers do not
+        # copy the pages holding them when it runs
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    from hl7validator.webapp import validator
+
+    # validation processes of this worker, loading the preloaded versions before any request
+    validator.start()
+    if not _settings["max_worker_rss"]:
+        return
+    if rss(worker.pid) is None:
+        worker.log.info("Memory watchdog disabled: the RSS of processes cannot be read here")
+        return
+    MemoryWatchdog(worker, _settings["max_worker_rss"], _settings["watchdog_interval"]).start()
+
+
+if __name__ == "__main__":
+    print("\n".join(describe(_settings)))
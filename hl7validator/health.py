@@ -0,0 +1,138 @@
+"""
+Liveness and readiness checks for container health checks and load balancers.
+
+``/healthz`` answers as soon as the process serves requests: no template is
+rendered and nothing is validated. ``/readyz`` tells whether the instance can
+validate quickly, and answers 503 with the same report when it cannot, so
+that load balancers route away from it before its latency climbs:
+
+- the HL7 versions preloaded at startup (HL7VALIDATOR_PRELOAD_VERSIONS) have
+  their definitions loaded and compiled;
+- a self-test message validates as expected where validations run (the
+  validation processes when there is a time budget); the result is kept
+  for HL7VALIDATOR_READY_CACHE seconds, so probes do not add validation
+  load, and the last one is reused while a pool is saturated;
+- no validation pool is at HL7VALIDATOR_READY_MAX_SATURATION (see the pools'
+  ``stats()``: 1 means every process is busy, or the queue full).
+"""
+
+import os
+import threading
+import time
+
+from hl7validator import api
+from hl7validator.constraints import compiled_versions
+
+HEALTH_PATH = "/healthz"
+READY_PATH = "/readyz"
+
+SELF_TEST_MESSAGE = (
+    "MSH|^~\\&|HL7VALIDATOR|SELFTEST|||20240101000000||ADT^A01^ADT_A01|SELFTEST|P|2.5\r"
+    "EVN|A01|20240101000000\r"
+    "PID|1||1^^^SELFTEST^MR||Test^Patient\r"
+    "PV1|1|I\r"
+)
+
+
+def liveness():
+    return {"status": "ok"}
+
+
+class Readiness:
+    """
+    Readiness report of this process.
+
+    :param versions: HL7 versions expected to be warm
+    :param pools: dict of pool name to a function returning its stats() snapshot
+    :param max_saturation: not ready from this saturation of any pool, defaults to
+        HL7VALIDATOR_READY_MAX_SATURATION (1)
+    :param cache_seconds: self-test results are reused for this long, defaults to
+        HL7VALIDATOR_READY_CACHE (10)
+    :param run: runs the self-test as run(fn, *args), e.g. Validator._run to go
+        through the validation processes; defaults to a call in this process
+    """
+
+    def __init__(
+        self, versions=(), pools=None, max_saturation=None, cache_seconds=None, run=None,
+    ):
+        self.versions = tuple(versions)
+        self.run = run or (lambda fn, *args: fn(*args))
+        self.pools = dict(pools or {})
+        if max_saturation is None:
+            max_saturation = os.getenv("HL7VALIDATOR_READY_MAX_SATURATION", "1")
+        self.max_saturation = float(max_saturation)
+        if cache_seconds is None:
+            cache_seconds = os.getenv("HL7VALIDATOR_READY_CACHE", "10")
+        self.cache_seconds = float(cache_seconds)
+        self._self_test = None
+        self._tested = None
+        self._lock = threading.Lock()
+
+    def self_test(self, refresh=True):
+        """
+        Validate the self-test message, at most once per cache_seconds.
+        :param refresh: False reuses the last result, if any, whatever its age
+        """
+        with self._lock:
+            now = time.monotonic()
+            expired = self._tested is None or now - self._tested >= self.cache_seconds
+            if self._tested is None or (expired and refresh):
+                start = time.perf_counter()
+                try:
+                    result = self.run(api.hl7validatorapi, SELF_TEST_MESSAGE)
+                    passed = result["statusCode"] == "Success"
+                    message = result["message"]
+                except Exception as err:  # reported, never raised to the prober
+                    passed, message = False, f"{type(err).__name__}: {err}"
+                self._self_test = {
+                    "passed": passed,
+                    "message": message,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                }
+                self._tested = now
+            return dict(self._self_test, age_s=round(now - self._tested, 3))
+
+    def check(self):
+        """
+        :return: (ready, report)
+        """
+        pools = {name: stats() for name, stats in self.pools.items()}
+        saturated = sorted(
+            name for name, stats in pools.items() if stats["saturation"] >= self.max_saturation
+        )
+        # a saturated pool would keep the probe waiting for a process
+        self_test = self.self_test(refresh=not saturated)
+        compiled = compiled_versions()
+        cold = [version for version in self.versions if version not in compiled]
+        reasons = []
+        if cold:
+            reasons.append(f"HL7 versions not loaded: {', '.join(cold)}")
+        if not self_test["passed"]:
+            reasons.append(f"self-test failed: {self_test['message']}")
+        if saturated:
+            reasons.append(f"saturated: {', '.join(saturated)}")
+        report = {
+            "status": "not ready" if reasons else "ready",
+            "reasons": reasons,
+            "versions": {"preloaded": list(self.versions), "loaded": compiled},
+            "self_test": self_test,
+            "pools": pools,
+        }
+        return not reasons, report
+
+
+def init_app(app, readiness):
+    """Register the /healthz and /readyz endpoints on a Flask app."""
+    from flask import jsonify
+
+    @app.route(HEALTH_PATH, methods=["GET"])
+    def healthz():
+        return jsonify(liveness())
+
+    @app.route(READY_PATH, methods=["GET"])
+    def readyz():
+        ready, report = readiness.check()
+        return jsonify(report), 200 if ready else 503
+
+    app.extensions["hl7validator.readiness"] = readiness
+    return readiness
@@ -0,0 +1,157 @@
+"""
+Hierarchical JSON form of HL7 v2 messages.
+
+The CSV conversion flattens a message into one row per field and loses the
+repetitions, components and subcomponents. This form keeps them::
+
+    {
+        "hl7version": "2.5",
+        "segments": [
+            {"id": "MSH", "fields": [[["|"]], [["^~\\\\&"]], [["EPIC"]], ...]},
+            {"id": "PID", "fields": [[["1"]], [], [["111987", "", "", "LAMH", "MR"]], ...]}
+        ]
+    }
+
+A field is a list of repetitions (empty when the field is), a repetition a
+list of components, and a component a string or, when it has several, a list
+of subcomponents. Values are kept as sent, escape sequences included, so
+``to_er7`` gives the message back.
+
+Messages are sliced on their encoding characters like the feed profiler does
+(no hl7apy elements are built), and a batch is converted one message at a
+time (``convert_stream``): as JSON lines, or as a sequence of MessagePack
+objects when the optional ``msgpack`` package is installed.
+"""
+
+import re
+
+from hl7validator.budget import BUDGET_EXCEEDED
+from hl7validator.codec import dumps
+from hl7validator.spool import iter_messages
+
+try:
+    import msgpack
+except ImportError:  # optional, JSON only
+    msgpack = None
+
+FORMATS = ("json", "msgpack")
+
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+
+def _field(value, component_sep, repetition_sep, subcomponent_sep):
+    if not value:
+        return []
+    repetitions = []
+    for repetition in value.split(repetition_sep):
+        components = []
+        for component in repetition.split(component_sep):
+            if subcomponent_sep in component:
+                components.append(component.split(subcomponent_sep))
+            else:
+                components.append(component)
+        repetitions.append(components)
+    return repetitions
+
+
+def to_json(msg):
+    """
+    Hierarchical form of a message, ready to be encoded as JSON or MessagePack.
+    :raises ValueError: when the message does not start with an MSH segment
+    """
+    text = msg.lstrip()
+    if not text.startswith("MSH") or len(text) < 8:
+        raise ValueError("The message does not start with an MSH segment")
+    field_sep = text[3]
+    component_sep, repetition_sep, _, subcomponent_sep = (text[4:8] + "  ")[:4]
+    segments = []
+    for segment in _SEGMENT_SEPARATORS.split(text):
+        if not segment.strip():
+            continue
+        values = segment[4:].split(field_sep) if len(segment) > 3 else []
+        if segment[:3] == "MSH":
+            # MSH-1 is the field separator itself and MSH-2 the encoding characters
+            fields = [[[field_sep]], [[values[0]]]] + [
+                _field(value, component_sep, repetition_sep, subcomponent_sep)
+                for value in values[1:]
+            ]
+        else:
+            fields = [
+                _field(value, component_sep, repetition_sep, subcomponent_sep) for value in values
+            ]
+        segments.append({"id": segment[:3], "fields": fields})
+    msh = segments[0]["fields"]
+    version = msh[11][0][0] if len(msh) > 11 and msh[11] else ""
+    return {
+        "hl7version": version if isinstance(version, str) else version[0],
+        "segments": segments,
+    }
+
+
+def to_er7(document):
+    """The ER7 text of the hierarchical form of a message, segments separated by \\r."""
+    msh = document["segments"][0]["fields"]
+    field_sep = msh[0][0][0]
+    encoding = msh[1][0][0]
+    component_sep, repetition_sep, _, subcomponent_sep = (encoding + "   ")[:4]
+    lines = []
+    for segment in document["segments"]:
+        fields = segment["fields"][2:] if segment["id"] == "MSH" else segment["fields"]
+        values = [
+            repetition_sep.join(
+                component_sep.join(
+                    c if isinstance(c, str) else subcomponent_sep.join(c) for c in repetition
+                )
+                for repetition in field
+            )
+            for field in fields
+        ]
+        if segment["id"] == "MSH":
+            values.insert(0, encoding)
+        lines.append(field_sep.join([segment["id"]] + values))
+    return "\r".join(lines)
+
+
+def encoder(fmt="json"):
+    """
+    :return: function encoding one document as bytes, JSON documents followed by a newline
+    :raises ValueError: for an unknown format, or MessagePack without the msgpack package
+    """
+    if fmt == "json":
+        return lambda document: dumps(document) + b"\n"
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("MessagePack output needs the msgpack package (msgpack extra)")
+        return msgpack.packb
+    raise ValueError(f"Unknown output format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+
+def convert_stream(messages, fmt="json", limits=None):
+    """
+    Convert messages one at a time.
+    :param messages: iterable of messages, or the text of a batch
+    :param limits: budget.Limits checked on every message
+    :return: iterator of encoded documents; messages that cannot be converted
+        give {"error": reason} instead
+    :raises ValueError: for an unknown format
+    """
+    encode = encoder(fmt)
+    if isinstance(messages, str):
+        messages = iter_messages([messages])
+    return _convert(messages, encode, limits)
+
+
+def _convert(messages, encode, limits):
+    for msg in messages:
+        reason = limits.check(msg) if limits is not None else None
+        if reason:
+            yield encode({"error": f"{BUDGET_EXCEEDED}: {reason}"})
+            continue
+        try:
+            yield encode(to_json(msg))
+        except ValueError as err:
+            yield encode({"error": str(err)})
@@ -0,0 +1,288 @@
+"""
+Logging for the validator: structured JSON lines written by a background
+thread, with sampled and redacted message bodies.
+
+Request threads only put records on an in-memory queue (``QueueHandler``);
+a ``QueueListener`` thread formats them and does the file or stream I/O.
+Message bodies are attached to a record only for a configurable sample of
+calls (see :func:`log_message`), and the formatter blanks out the
+configured PHI fields (PID-5, PID-7, ...) before anything is written.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOGGER_NAME = "hl7validator"
+
+# Fields with patient identifying data: identifiers, names, dates of birth,
+# addresses, phone numbers and account / SSN / licence numbers
+DEFAULT_REDACT_FIELDS = (
+    "PID-2,PID-3,PID-4,PID-5,PID-6,PID-7,PID-9,PID-11,PID-13,PID-14,PID-18,PID-19,PID-20,"
+    "MRG-1,MRG-2,MRG-3,MRG-4,MRG-7,NK1-2,NK1-4,NK1-5,NK1-6,"
+    "GT1-3,GT1-5,GT1-6,GT1-7,GT1-8,GT1-12,IN1-16,IN1-18,IN1-19,IN1-36"
+)
+REDACTED = "***"
+
+# Record attribute holding the message body of a sampled record
+MESSAGE_ATTRIBUTE = "hl7_message"
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()
+) | {"message", "asctime", "taskName"}
+
+
+def parse_redact_fields(value):
+    """
+    Parse a comma separated list of fields to redact, e.g. "PID-5,PID-7,ZPD-*".
+    A "*" field redacts every field of the segment.
+    :return: dict of segment name to a set of field numbers, or None for all fields
+    """
+    fields = {}
+    for item in value.split(","):
+        segment, _, number = item.strip().upper().partition("-")
+        if not segment:
+            continue
+        if number == "*":
+            fields[segment] = None
+        elif fields.get(segment, set()) is not None:
+            fields.setdefault(segment, set()).add(int(number))
+    return fields
+
+
+def redact_message(msg, fields):
+    """
+    Copy of an ER7 message with the given fields replaced by "***".
+
+    The message is split into segments and fields with its own field
+    separator (MSH-1), so a field is redacted whole, with all its
+    repetitions and components. Text that does not start with an MSH
+    segment cannot be split reliably and is redacted entirely.
+    :param fields: mapping as returned by parse_redact_fields()
+    """
+    text = msg.replace("\r\n", "\r").replace("\n", "\r").lstrip()
+    if not text.startswith("MSH") or len(text) < 4:
+        return REDACTED
+    separator = text[3]
+    segments = []
+    for segment in text.split("\r"):
+        values = segment.split(separator)
+        name = values[0]
+        if name in fields:
+            numbers = fields[name]
+            # MSH-1 is the separator itself, so MSH-n is the (n-1)th value
+            offset = 1 if name == "MSH" else 0
+            for index in range(1, len(values)):
+                if values[index] and (numbers is None or index + offset in numbers):
+                    values[index] = REDACTED
+        segments.append(separator.join(values))
+    return "\r".join(segments)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line. Values passed through
+    ``extra`` become top-level keys; a message body is redacted first.
+    """
+
+    def __init__(self, redact_fields=None):
+        super().__init__()
+        self.redact_fields = parse_redact_fields(
+            DEFAULT_REDACT_FIELDS if redact_fields is None else redact_fields
+        )
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if MESSAGE_ATTRIBUTE in entry:
+            entry[MESSAGE_ATTRIBUTE] = redact_message(
+                str(entry[MESSAGE_ATTRIBUTE]), self.redact_fields
+            )
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class Sampler:
+    """Decide which calls get their message body logged."""
+
+    def __init__(self, rate=0.0):
+        self.rate = rate
+
+    def __call__(self):
+        return self.rate > 0 and (self.rate >= 1 or random.random() < self.rate)
+
+
+sampler = Sampler(float(os.getenv("HL7VALIDATOR_LOG_SAMPLE_RATE", "0")))
+
+
+def log_message(logger, level, text, msg, **fields):
+    """
+    Log text with structured fields, attaching the message body only when
+    the call is sampled. The body is redacted by JSONFormatter on the
+    listener thread; other formatters never print it.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sampler():
+        fields[MESSAGE_ATTRIBUTE] = msg
+    logger.log(level, text, extra=fields, stacklevel=2)
+
+
+class _Prepared(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread: only the
+    message arguments are merged, so records stay cheap to enqueue.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Forwarded(_Prepared):
+    """Prepared records handed to a function instead of a queue."""
+
+    def __init__(self, send):
+        super().__init__(None)
+        self.send = send
+
+    def enqueue(self, record):
+        self.send(record)
+
+
+class _Stderr(logging.StreamHandler):
+    """Stream handler writing to whatever sys.stderr is when a record is emitted."""
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+_listener = None
+
+
+def configure_logging(path=None, level=None, fmt=None, redact_fields=None):
+    """
+    Send the "hl7validator" logger through a queue to a background writer.
+
+    :param path: log file (rotated); defaults to HL7VALIDATOR_LOG_FILE, or
+        stderr when neither is set
+    :param level: defaults to HL7VALIDATOR_LOG_LEVEL (INFO)
+    :param fmt: "json" (default, HL7VALIDATOR_LOG_FORMAT) or "text"
+    :param redact_fields: see parse_redact_fields(), defaults to
+        HL7VALIDATOR_LOG_REDACT_FIELDS or DEFAULT_REDACT_FIELDS
+    :return: the QueueListener; calling again replaces the previous setup
+    """
+    global _listener
+    path = path or os.getenv("HL7VALIDATOR_LOG_FILE")
+    level = level or os.getenv("HL7VALIDATOR_LOG_LEVEL", "INFO").upper()
+    fmt = fmt or os.getenv("HL7VALIDATOR_LOG_FORMAT", "json")
+    if redact_fields is None:
+        redact_fields = os.getenv("HL7VALIDATOR_LOG_REDACT_FIELDS", DEFAULT_REDACT_FIELDS)
+
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=int(os.getenv("HL7VALIDATOR_LOG_MAX_BYTES", str(50 * 1024 * 1024))),
+            backupCount=int(os.getenv("HL7VALIDATOR_LOG_BACKUP_COUNT", "10")),
+            encoding="utf-8",
+        )
+    else:
+        handler = _Stderr()
+    if fmt == "json":
+        handler.setFormatter(JSONFormatter(redact_fields))
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s: %(message)s [in %(module)s]")
+        )
+
+    stop_logging()
+    logger = logging.getLogger(LOGGER_NAME)
+    queue_handler = _Prepared(queue.SimpleQueue())
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    _listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.queue_handler = queue_handler
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Flush pending records and stop the background writer, if running."""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    logging.getLogger(LOGGER_NAME).removeHandler(listener.queue_handler)
+    if listener._thread is not None:
+        listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def forward_logging(send, level, sample_rate):
+    """
+    Hand the records of the "hl7validator" logger to send() instead of writing
+    them. Worker processes (see pool.WorkerPool) send them back to the parent
+    process, whose handlers format, redact and write them with its own.
+
+    :param level: level of the parent's "hl7validator" logger
+    :param sample_rate: message body sampling rate of the parent (see sampler)
+    """
+    stop_logging()
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(_Forwarded(send))
+    logger.setLevel(level)
+    logger.propagate = False
+    sampler.rate = sample_rate
+
+
+def _restart_in_child():
+    # A forked process (gunicorn worker, validation pool) inherits the queue
+    # handler but not the listener thread: give it a queue and thread of its own
+    if _listener is None:
+        return
+    queue_handler = _listener.queue_handler
+    queue_handler.queue = queue.SimpleQueue()
+    _listener.queue = queue_handler.queue
+    _listener._thread = None
+    _listener.start()
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,261 @@
+"""
+Multi-version conformance matrix: which HL7 versions a message conforms to,
+whatever its MSH-12 claims.
+
+The message is normalised and split once; for each version only the MSH
+segment is rewritten (MSH-12.1 set to the version) and the message is
+validated against that version's compiled constraint tables, parsing a
+skeleton of the message and each distinct segment once (see
+``hl7validator.parallel``). The versions are independent jobs, so a
+Validator spreads them over its worker processes.
+
+The result is a small matrix of versions by error counts and first errors::
+
+    matrix = conformance_matrix(msg, versions=["2.4", "2.5"])
+    matrix["conforms"]  # ["2.5"]
+"""
+
+import itertools
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from hl7apy import SUPPORTED_LIBRARIES
+
+from hl7validator import api, parallel
+
+# Versions checked when a request does not list any
+MATRIX_VERSIONS = ("2.1", "2.2", "2.3", "2.3.1", "2.4", "2.5", "2.5.1", "2.6", "2.7", "2.8")
+
+# First errors kept per version in a ConformanceSummary report
+TOP_ERRORS = 5
+
+
+def resolve_versions(versions=None):
+    """
+    Versions to check, in the order given.
+    :param versions: list of versions or a comma separated string, defaults to MATRIX_VERSIONS
+    :raises ValueError: for versions hl7apy does not support
+    """
+    if isinstance(versions, str):
+        versions = [v.strip() for v in versions.split(",") if v.strip()]
+    versions = tuple(dict.fromkeys(versions or MATRIX_VERSIONS))
+    unknown = [v for v in versions if v not in SUPPORTED_LIBRARIES]
+    if unknown:
+        raise ValueError(
+            f"Unsupported HL7 version(s) {', '.join(unknown)}, expected some of "
+            f"{', '.join(sorted(SUPPORTED_LIBRARIES, key=_version_key))}"
+        )
+    return versions
+
+
+def _version_key(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+def lex(msg):
+    """
+    The version-independent part of the work: normalised message split into
+    its MSH fields and the remaining segments.
+    :return: (declared version, MSH fields, field and component separators, rest of
+        the message),
+        or None when the message does not start with an MSH segment
+    """
+    setmsg = api.set_message_to_validate(msg).lstrip()
+    msh, _, rest = setmsg.partition("\r")
+    if not msh.startswith("MSH") or len(msh) < 8:
+        return None
+    fields = msh.split(msh[3])
+    fields += [""] * (12 - len(fields))
+    # fields[0] is "MSH" and MSH-1 the separator itself, so MSH-12 is fields[11]
+    declared = fields[11].split(msh[4])[0]
+    return declared, fields, msh[3:5], rest
+
+
+def with_version(lexed, version):
+    """The message text with MSH-12.1 set to version."""
+    _, fields, (field_sep, component_sep), rest = lexed
+    fields = list(fields)
+    components = fields[11].split(component_sep)
+    components[0] = version
+    fields[11] = component_sep.join(components)
+    return field_sep.join(fields) + "\r" + rest
+
+
+def _run_chunks(jobs):
+    return [parallel.validate_chunk(*job) for job in jobs]
+
+
+def version_job(text, version, validation_level="tolerant"):
+    """
+    Pool job: validate a message whose MSH-12 names the version checked.
+    :return: the matrix row of the version
+    """
+    result = None
+    if api.is_tolerant(validation_level):
+        # the skeleton path of the parallel validation, with the chunks run inline
+        result = parallel.validate(text, _run_chunks, validation_profile="full")
+    if result is None:
+        result = api.hl7validatorapi(
+            text, validation_level=validation_level, validation_profile="full"
+        )
+    return version_row(version, result)
+
+
+def version_row(version, result):
+    """Summarize a validation result into a matrix row."""
+    details = result.get("details") or []
+    errors = [d["message"].strip() for d in details if d["level"] == "Error"]
+    warnings = sum(1 for d in details if d["level"] != "Error") + len(result.get("warnings") or [])
+    if result["statusCode"] != "Success" and not errors:
+        # the message did not parse for this version
+        errors = [result["message"]]
+    return {
+        "version": version,
+        "statusCode": result["statusCode"],
+        "errors": len(errors),
+        "warnings": warnings,
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def conformance_jobs(msg, versions=None, validation_level="tolerant"):
+    """
+    version_job() argument tuples of a message, one per version.
+    :return: (declared version or None, list of jobs)
+    :raises ValueError: for an empty message or unsupported versions
+    """
+    versions = resolve_versions(versions)
+    if not msg:
+        raise ValueError("No Content")
+    lexed = lex(msg)
+    if lexed is None:
+        # not even an MSH: every version fails the same way
+        return None, [(msg, version, validation_level) for version in versions]
+    return lexed[0] or None, [
+        (with_version(lexed, version), version, validation_level) for version in versions
+    ]
+
+
+def build_matrix(declared, rows):
+    return {
+        "declared": declared,
+        "conforms": [row["version"] for row in rows if row["statusCode"] == "Success"],
+        "versions": rows,
+    }
+
+
+def conformance_matrix(msg, versions=None, validation_level="tolerant", run=None):
+    """
+    Check a message against several HL7 versions.
+
+    :param versions: versions to check, defaults to MATRIX_VERSIONS
+    :param run: function taking version_job and a list of its argument tuples
+        and returning the rows in the same order, e.g. over a process pool;
+        runs the jobs one after the other by default
+    :return: dict with the declared MSH-12 version, the versions the message
+        conforms to and one row per version (statusCode, error and warning
+        counts, first error)
+    :raises ValueError: for an empty message or unsupported versions
+    """
+    declared, jobs = conformance_jobs(msg, versions, validation_level)
+    if run is None:
+        rows = [version_job(*job) for job in jobs]
+    else:
+        rows = run(version_job, jobs)
+    return build_matrix(declared, rows)
+
+
+def matrix_batch(messages, versions=None, validation_level="tolerant"):
+    """Process pool job: the conformance matrices of a batch of messages."""
+    return [
+        conformance_matrix(msg, versions, validation_level) for msg in messages if msg.strip()
+    ]
+
+
+def _set_log_level(level):
+    logging.getLogger("hl7validator").setLevel(level)
+
+
+def conformance_feed(
+    messages, versions=None, validation_level="tolerant", workers=1, batch_size=50,
+    log_level=None,
+):
+    """
+    Conformance matrices of a stream of sample messages, aggregated per
+    version; batches of messages are checked by worker processes.
+    :param log_level: level of the "hl7validator" logger in the worker processes
+    :return: ConformanceSummary
+    :raises ValueError: for unsupported versions
+    """
+    versions = resolve_versions(versions)
+    summary = ConformanceSummary(versions)
+    messages = iter(messages)
+    batches = iter(lambda: list(itertools.islice(messages, batch_size)), [])
+    if workers <= 1:
+        for batch in batches:
+            for matrix in matrix_batch(batch, versions, validation_level):
+                summary.add(matrix)
+        return summary
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_set_log_level if log_level else None,
+        initargs=(log_level,) if log_level else (),
+    ) as executor:
+        pending = []
+        for batch in batches:
+            if len(pending) >= workers * 2:
+                # results are added in message order
+                for matrix in pending.pop(0).result():
+                    summary.add(matrix)
+            pending.append(executor.submit(matrix_batch, batch, versions, validation_level))
+        for future in pending:
+            for matrix in future.result():
+                summary.add(matrix)
+    return summary
+
+
+class ConformanceSummary:
+    """Conformance matrices of many sample messages, aggregated per version."""
+
+    def __init__(self, versions):
+        self.versions = tuple(versions)
+        self.messages = 0
+        self.declared = Counter()
+        self.conforming = Counter()
+        self.errors = Counter()
+        self.warnings = Counter()
+        self.first_errors = {version: Counter() for version in self.versions}
+
+    def add(self, matrix):
+        self.messages += 1
+        self.declared[matrix["declared"] or "-"] += 1
+        for row in matrix["versions"]:
+            version = row["version"]
+            self.conforming[version] += row["statusCode"] == "Success"
+            self.errors[version] += row["errors"]
+            self.warnings[version] += row["warnings"]
+            if row["first_error"]:
+                self.first_errors[version][row["first_error"]] += 1
+
+    def report(self, top=TOP_ERRORS):
+        return {
+            "messages": self.messages,
+            "declared": dict(self.declared.most_common()),
+            "versions": [
+                {
+                    "version": version,
+                    "conforming": self.conforming[version],
+                    "conformance_rate": (
+                        round(self.conforming[version] / self.messages, 4)
+                        if self.messages else None
+                    ),
+                    "errors": self.errors[version],
+                    "warnings": self.warnings[version],
+                    "first_errors": self.first_errors[version].most_common(top),
+                }
+                for version in self.versions
+            ],
+        }
@@ -0,0 +1,532 @@
+"""
+Site message profiles: the rules of trading-partner agreements on top of the
+base HL7 definitions (required and unsupported segments and fields,
+cardinality, lengths, fixed and allowed values).
+
+A profile is a JSON or YAML document, or an HL7 v2 XML conformance profile
+(``HL7v2xConformanceProfile``). JSON and YAML profiles list their rules by
+location::
+
+    {
+        "id": "acme-adt",
+        "hl7_version": "2.5",
+        "message_type": "ADT^A08",
+        "segments": {"PV1": {"usage": "R"}, "ZPI": {"usage": "X"}},
+        "fields": {
+            "PID-3": {"usage": "R", "max": 1, "max_length": 20},
+            "PID-3.4": {"value": "LAMH"},
+            "PID-8": {"usage": "R", "values": ["F", "M", "U"]}
+        }
+    }
+
+Usage ``R`` is required and ``X`` not supported; any other usage (``RE``,
+``O``, ``C``, ...) only applies the other rules. Component and subcomponent
+rules apply to the field repetitions that are present.
+
+A profile is compiled once into a flat rule table: per segment ID, the
+occurrence limits and the field rules, so that validating a message is a
+single pass over its segments. Compiled profiles are cached by ID and by the
+hash of their content; the same document uploaded again is not compiled
+again. With HL7VALIDATOR_PROFILES_DIR, uploaded profiles are saved to that
+directory, and the profiles there are loaded on first use, so every worker
+process and restart sees them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import Counter, namedtuple
+
+from hl7validator.cache import LRUCache
+
+logger = logging.getLogger("hl7validator")
+
+PROFILE_FORMATS = ("json", "yaml", "xml")
+
+# Profile IDs name the files of the profile directory
+_PROFILE_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]{0,63}\Z")
+
+_LOCATION = re.compile(r"([A-Z][A-Z0-9]{2})-(\d+)(?:\.(\d+))?(?:\.(\d+))?\Z")
+
+_EXTENSIONS = {".json": "json", ".yaml": "yaml", ".yml": "yaml", ".xml": "xml"}
+
+# Profile formats of the media types accepted by the upload endpoint
+MEDIA_TYPES = {
+    "application/json": "json",
+    "application/yaml": "yaml",
+    "application/x-yaml": "yaml",
+    "text/yaml": "yaml",
+    "application/xml": "xml",
+    "text/xml": "xml",
+}
+
+# Rule of a field, component or subcomponent; component and subcomponent are
+# None for field rules, max and max_length None when unbounded
+FieldRule = namedtuple(
+    "FieldRule",
+    "location field component subcomponent required forbidden min max max_length values",
+)
+
+# Occurrence limits of a segment; None when not checked
+SegmentRule = namedtuple("SegmentRule", "min max")
+
+
+class CompiledProfile:
+    """A message profile compiled into its rule table."""
+
+    def __init__(self, profile_id, digest, hl7_version, message_type, segments, fields):
+        self.id = profile_id
+        self.hash = digest
+        self.hl7_version = hl7_version
+        # MSH-9 components the message type must start with
+        self.message_type = message_type
+        # segment ID: SegmentRule
+        self.segments = segments
+        # segment ID: tuple of FieldRule
+        self.fields = fields
+
+    @property
+    def rule_count(self):
+        return len(self.segments) + sum(len(rules) for rules in self.fields.values())
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "hash": self.hash,
+            "hl7_version": self.hl7_version,
+            "message_type": "^".join(self.message_type) or None,
+            "segments": len(self.segments),
+            "rules": self.rule_count,
+        }
+
+    def check(self, setmsg, encoding_chars):
+        """
+        Check a message against the profile in one pass over its segments.
+        :param setmsg: message text with segments separated by carriage returns
+        :return: list of error messages
+        """
+        findings = []
+        counts = Counter()
+        for seg_text in setmsg.split("\r"):
+            seg_text = seg_text.strip()
+            if not seg_text:
+                continue
+            name = seg_text[:3]
+            counts[name] += 1
+            if name == "MSH" and counts[name] == 1:
+                self._check_header(seg_text, encoding_chars, findings)
+            rules = self.fields.get(name)
+            if rules:
+                _check_fields(rules, seg_text, encoding_chars, counts[name], findings)
+        for name, rule in self.segments.items():
+            count = counts[name]
+            if rule.max == 0 and count:
+                findings.append(f"Segment {name} is not supported by the profile")
+            elif rule.min and count < rule.min:
+                findings.append(f"Segment {name} is required by the profile")
+            elif rule.max is not None and count > rule.max:
+                findings.append(
+                    f"Segment {name} occurs {count} times, the profile allows {rule.max}"
+                )
+        return findings
+
+    def _check_header(self, msh, encoding_chars, findings):
+        fields = msh.split(encoding_chars["FIELD"])
+        fields += [""] * (12 - len(fields))
+        # MSH-1 is the field separator itself, so MSH-n is fields[n - 1]
+        message_type = fields[8].split(encoding_chars["COMPONENT"])
+        if self.message_type and message_type[: len(self.message_type)] != list(
+            self.message_type
+        ):
+            findings.append(
+                f"Message type {fields[8]} does not match the profile's "
+                f"{'^'.join(self.message_type)}"
+            )
+        version = fields[11].split(encoding_chars["COMPONENT"])[0]
+        if self.hl7_version and version != self.hl7_version:
+            findings.append(
+                f"HL7 version {version} does not match the profile's {self.hl7_version}"
+            )
+
+
+def _check_fields(rules, seg_text, enc, occurrence, findings):
+    name = seg_text[:3]
+    if name == "MSH":
+        values = [enc["FIELD"]] + seg_text[4:].split(enc["FIELD"])
+    else:
+        values = seg_text[4:].split(enc["FIELD"])
+    where = f" in {name} #{occurrence}" if occurrence > 1 else ""
+    for rule in rules:
+        value = values[rule.field - 1] if rule.field <= len(values) else ""
+        if name == "MSH" and rule.field <= 2:
+            repetitions = [value] if value else []
+        else:
+            repetitions = [rep for rep in value.split(enc["REPETITION"]) if rep] if value else []
+        if rule.component is None:
+            _check_values(rule, repetitions, where, findings)
+            if rule.min and len(repetitions) < rule.min and repetitions:
+                findings.append(
+                    f"{rule.location} has {len(repetitions)} repetitions, "
+                    f"the profile requires {rule.min}{where}"
+                )
+            if rule.max is not None and len(repetitions) > rule.max and not rule.forbidden:
+                findings.append(
+                    f"{rule.location} has {len(repetitions)} repetitions, "
+                    f"the profile allows {rule.max}{where}"
+                )
+            continue
+        for repetition in repetitions:
+            parts = repetition.split(enc["COMPONENT"])
+            part = parts[rule.component - 1] if rule.component <= len(parts) else ""
+            if rule.subcomponent is not None:
+                parts = part.split(enc["SUBCOMPONENT"])
+                part = parts[rule.subcomponent - 1] if rule.subcomponent <= len(parts) else ""
+            _check_values(rule, [part] if part else [], where, findings)
+
+
+def _check_values(rule, values, where, findings):
+    if not values:
+        if rule.required:
+            findings.append(f"{rule.location} is required by the profile{where}")
+        return
+    if rule.forbidden:
+        findings.append(f"{rule.location} is not supported by the profile{where}")
+        return
+    for value in values:
+        if rule.max_length is not None and len(value) > rule.max_length:
+            findings.append(
+                f"{rule.location} is {len(value)} characters long, "
+                f"the profile allows {rule.max_length}{where}"
+            )
+        if rule.values is not None and value not in rule.values:
+            if len(rule.values) == 1:
+                expected = f"the profile requires {next(iter(rule.values))}"
+            else:
+                expected = f"expected one of {', '.join(sorted(rule.values))}"
+            findings.append(f"{rule.location} value {value} is not allowed, {expected}{where}")
+
+
+def _count(value, location, key):
+    if value is None or value == "*":
+        return None
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {key} '{value}' for {location}") from None
+    if count < 0:
+        raise ValueError(f"Invalid {key} '{value}' for {location}")
+    return count
+
+
+def _usage(spec, location):
+    usage = str(spec.get("usage") or "O").upper()
+    if usage not in ("R", "RE", "O", "C", "CE", "X", "B", "W"):
+        raise ValueError(f"Invalid usage '{usage}' for {location}")
+    return usage
+
+
+def compile_profile(document, digest=""):
+    """
+    Compile a profile document (see load_profile()) into its rule table.
+    :raises ValueError: for malformed profiles
+    """
+    if not isinstance(document, dict):
+        raise ValueError("A message profile must be a mapping")
+    profile_id = str(document.get("id") or "")
+    if not _PROFILE_ID.match(profile_id):
+        raise ValueError(
+            f"Invalid profile id '{profile_id}': letters, digits, '.', '_' and '-', "
+            "at most 64 characters"
+        )
+    segments = {}
+    for name, spec in (document.get("segments") or {}).items():
+        location = f"segment {name}"
+        spec = spec or {}
+        usage = _usage(spec, location)
+        minimum = _count(spec.get("min"), location, "min")
+        maximum = _count(spec.get("max"), location, "max")
+        if usage == "R":
+            minimum = max(minimum or 0, 1)
+        if usage == "X":
+            minimum, maximum = 0, 0
+        if minimum or maximum is not None:
+            segments[name] = SegmentRule(minimum or 0, maximum)
+
+    fields = {}
+    for location, spec in (document.get("fields") or {}).items():
+        match = _LOCATION.match(location)
+        if not match:
+            raise ValueError(
+                f"Invalid field location '{location}', expected e.g. PID-3, PID-3.4 or PID-3.4.1"
+            )
+        spec = spec or {}
+        usage = _usage(spec, location)
+        values = spec.get("values")
+        if "value" in spec:
+            values = [spec["value"]]
+        component = int(match.group(3)) if match.group(3) else None
+        minimum = _count(spec.get("min"), location, "min")
+        maximum = _count(spec.get("max"), location, "max")
+        if component is not None and (minimum or maximum is not None):
+            raise ValueError(f"Repetitions apply to fields only, not to {location}")
+        rule = FieldRule(
+            location,
+            int(match.group(2)),
+            component,
+            int(match.group(4)) if match.group(4) else None,
+            usage == "R" or bool(minimum),
+            usage == "X" or maximum == 0,
+            minimum,
+            maximum,
+            _count(spec.get("max_length"), location, "max_length"),
+            frozenset(str(v) for v in values) if values is not None else None,
+        )
+        if int(match.group(2)) < 1 or 0 in (component, rule.subcomponent):
+            raise ValueError(f"Invalid field location '{location}', positions start at 1")
+        if rule.required or rule.forbidden or rule.max is not None or rule[-2:] != (None, None):
+            fields.setdefault(match.group(1), []).append(rule)
+
+    message_type = document.get("message_type") or ""
+    return CompiledProfile(
+        profile_id,
+        digest,
+        str(document["hl7_version"]) if document.get("hl7_version") else None,
+        tuple(c for c in str(message_type).split("^") if c),
+        segments,
+        {name: tuple(rules) for name, rules in fields.items()},
+    )
+
+
+def load_profile(content, fmt=None):
+    """
+    Read a profile document.
+    :param content: text of the profile
+    :param fmt: 'json', 'yaml' or 'xml'; guessed from the content by default
+    :return: dict with the id, hl7_version, message_type, segments and fields keys
+    :raises ValueError: for unreadable documents
+    """
+    if fmt is None:
+        stripped = content.lstrip()
+        fmt = "xml" if stripped.startswith("<") else "json" if stripped.startswith("{") else "yaml"
+    if fmt == "json":
+        return json.loads(content)
+    if fmt == "yaml":
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML message profiles need PyYAML installed") from None
+        try:
+            return yaml.safe_load(content)
+        except yaml.YAMLError as err:
+            raise ValueError(f"Not a valid YAML profile: {err}") from None
+    if fmt == "xml":
+        return _from_xml(content)
+    raise ValueError(f"Unknown profile format '{fmt}', expected one of {', '.join(PROFILE_FORMATS)}")
+
+
+def _from_xml(content):
+    """Profile document of an HL7 v2 XML conformance profile."""
+    if "<!DOCTYPE" in content or "<!ENTITY" in content:
+        raise ValueError("XML profiles with a DOCTYPE are not accepted")
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as err:
+        raise ValueError(f"Not a valid XML profile: {err}") from None
+    if root.tag != "HL7v2xConformanceProfile":
+        raise ValueError(f"Expected an HL7v2xConformanceProfile document, found {root.tag}")
+    static = root.find("HL7v2xStaticDef")
+    if static is None:
+        raise ValueError("The XML profile has no HL7v2xStaticDef")
+    metadata = root.find("MetaData")
+    profile_id = root.get("ID") or (metadata.get("Name") if metadata is not None else None)
+    document = {
+        "id": profile_id.strip().replace(" ", "-") if profile_id else None,
+        "hl7_version": root.get("HL7Version"),
+        "message_type": "^".join(
+            t for t in (static.get("MsgType"), static.get("EventType")) if t
+        ),
+        "segments": {},
+        "fields": {},
+    }
+    seen = Counter(segment.get("Name") for segment in static.iter("Segment"))
+    _xml_children(static, document, seen, set(), required=True, single=True)
+    return document
+
+
+def _xml_children(element, document, seen, defined, required, single):
+    for child in element:
+        usage = (child.get("Usage") or "O").upper()
+        maximum = child.get("Max")
+        if child.tag == "SegGroup":
+            _xml_children(
+                child, document, seen, defined,
+                required and usage == "R",
+                single and maximum == "1",
+            )
+        elif child.tag == "Segment":
+            name = child.get("Name")
+            if seen[name] == 1:
+                # occurrences are only checked for segments outside repeating or
+                # optional groups, defined once
+                document["segments"][name] = {
+                    "usage": usage if required or usage == "X" else "O",
+                    "max": maximum if single else None,
+                }
+            if name not in defined:
+                # the fields of the first definition of a segment
+                defined.add(name)
+                _xml_elements(child, "Field", name + "-", document["fields"])
+
+
+def _xml_elements(element, tag, prefix, fields):
+    nested = {"Field": "Component", "Component": "SubComponent"}
+    separator = "." if tag != "Field" else ""
+    for position, child in enumerate(element.findall(tag), 1):
+        location = f"{prefix}{separator}{position}"
+        spec = {"usage": (child.get("Usage") or "O").upper()}
+        if tag == "Field":
+            spec["min"] = child.get("Min") if spec["usage"] == "R" else None
+            spec["max"] = child.get("Max")
+        length = child.get("Length") or child.get("MaxLength")
+        if length and length.isdigit():
+            spec["max_length"] = int(length)
+        if child.get("ConstantValue"):
+            spec["value"] = child.get("ConstantValue")
+        fields[location] = spec
+        if tag in nested:
+            _xml_elements(child, nested[tag], location, fields)
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ProfileRegistry:
+    """
+    Compiled message profiles by ID, compiled once per content hash.
+
+    :param directory: directory uploaded profiles are saved to and loaded from
+    :param max_profiles: profile IDs registered at most, and compiled
+        documents kept by content hash
+    """
+
+    def __init__(self, directory=None, max_profiles=500):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._profiles = {}
+        self._by_hash = LRUCache(max_profiles)
+        self._files = {}
+        self._scanned = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.getenv("HL7VALIDATOR_PROFILES_DIR") or None,
+            int(os.getenv("HL7VALIDATOR_MAX_PROFILES", "500")),
+        )
+
+    def compile(self, content, fmt=None):
+        """
+        Compiled profile of a document, from the cache when the same content was compiled before.
+        :raises ValueError: for malformed profiles
+        """
+        digest = content_hash(content)
+        profile = self._by_hash.get(digest)
+        if profile is None:
+            profile = compile_profile(load_profile(content, fmt), digest)
+            self._by_hash.set(digest, profile)
+        return profile
+
+    def _add(self, profile):
+        with self._lock:
+            if profile.id not in self._profiles and len(self._profiles) >= self.max_profiles:
+                raise ValueError(
+                    f"Too many message profiles: {self.max_profiles} are registered"
+                )
+            self._profiles[profile.id] = profile
+
+    def register(self, content, fmt=None):
+        """
+        Compile a profile and make it available by its ID, saving it to the
+        profile directory if there is one.
+        :return: CompiledProfile
+        :raises ValueError: for malformed profiles, or a new ID when max_profiles
+            are registered
+        """
+        profile = self.compile(content, fmt)
+        self._add(profile)
+        if self.directory:
+            fmt = fmt or {"<": "xml", "{": "json"}.get(content.lstrip()[:1], "yaml")
+            path = os.path.join(self.directory, f"{profile.id}.{fmt}")
+            os.makedirs(self.directory, exist_ok=True)
+            # written to a temporary file first so that other processes never read half a file
+            partial = f"{path}.{os.getpid()}.tmp"
+            with open(partial, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(partial, path)
+            for other in PROFILE_FORMATS:
+                stale = os.path.join(self.directory, f"{profile.id}.{other}")
+                if other != fmt and os.path.exists(stale):
+                    os.remove(stale)
+            with self._lock:
+                self._files[path] = (os.stat(path).st_mtime_ns, profile.id)
+        logger.info(f"Registered message profile {profile.id} ({profile.hash[:12]})")
+        return profile
+
+    def scan(self):
+        """
+        Load the profiles of the profile directory that are new or changed
+        since the directory was last modified (profiles are replaced by renames).
+        """
+        if not self.directory:
+            return
+        try:
+            modified = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return
+        if modified == self._scanned:
+            return
+        self._scanned = modified
+        for name in sorted(os.listdir(self.directory)):
+            fmt = _EXTENSIONS.get(os.path.splitext(name)[1])
+            if fmt is None:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if self._files.get(path, (None,))[0] == mtime:
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    profile = self.compile(f.read(), fmt)
+                self._add(profile)
+            except (OSError, ValueError) as err:
+                logger.error(f"Not able to load message profile {path}: {err}")
+                continue
+            with self._lock:
+                self._files[path] = (mtime, profile.id)
+
+    def get(self, profile):
+        """
+        Compiled profile by ID; CompiledProfile instances are returned as they are.
+        :raises ValueError: for unknown profiles
+        """
+        if profile is None or isinstance(profile, CompiledProfile):
+            return profile
+        # registered or replaced by another process
+        self.scan()
+        compiled = self._profiles.get(profile)
+        if compiled is None:
+            raise ValueError(f"Unknown message profile '{profile}'")
+        return compiled
+
+    def profiles(self):
+        self.scan()
+        return [profile.describe() for _, profile in sorted(self._profiles.items())]
+
+
+registry = ProfileRegistry.from_env()
@@ -0,0 +1,170 @@
+"""
+Intra-message parallel validation for very large messages.
+
+ORU/MDM messages with thousands of OBX segments spend nearly all of their
+validation time parsing and checking segments one by one. Above a size
+threshold, the segments are split into chunks that worker processes parse
+(to find parse errors) and check against the compiled constraint tables.
+The message structure is still validated in a single pass over a skeleton
+of the message (MSH plus segment IDs), and the findings are merged back in
+segment order, giving the same result as api.hl7validatorapi().
+
+Only tolerant validation with the fast engine is split; anything else, and
+messages whose skeleton does not parse, are validated serially.
+"""
+
+import logging
+
+from hl7apy import parser
+from hl7apy.consts import VALIDATION_LEVEL
+from hl7apy.parser import parse_message, parse_segment
+
+from hl7validator import api
+from hl7validator.constraints import load_constraints, placed_segments, segment_report, skeleton
+from hl7validator.logs import log_message
+
+logger = logging.getLogger("hl7validator")
+
+
+def segment_count(msg):
+    """Approximate number of segments, for comparing against the threshold."""
+    return max(msg.count("\r"), msg.count("\n")) + 1
+
+
+def applies(msg, threshold, validation_level, stages, engine):
+    return bool(
+        threshold
+        and msg
+        and "segments" in stages
+        and engine == "fast"
+        and api.is_tolerant(validation_level)
+        and segment_count(msg) > threshold
+    )
+
+
+def validate_chunk(segments, hl7version, encoding_chars):
+    """
+    Pool job: parse and check a chunk of segments.
+    :return: list of (parse error message or None, SegmentReport or None)
+    """
+    results = []
+    for seg_text in segments:
+        try:
+            parse_segment(seg_text, hl7version, encoding_chars, VALIDATION_LEVEL.TOLERANT)
+        except Exception as err:
+            results.append((str(err), None))
+            continue
+        results.append((None, segment_report(seg_text, hl7version, encoding_chars)))
+    return results
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def read_skeleton(msg):
+    """
+    Job: parse the skeleton of a message.
+    :return: (hl7version, MSH-9, MSH-18, texts of the segments hl7apy places,
+        encoding characters), or None when the skeleton does not parse or its
+        version has no consistent constraint tables
+    """
+    setmsg = api.set_message_to_validate(msg)
+    segments, skeleton_text = skeleton(setmsg)
+    try:
+        parsed = parse_message(skeleton_text, validation_level=VALIDATION_LEVEL.TOLERANT)
+        hl7version = parsed.version
+        msh_9 = parsed.msh.msh_9.value
+    except Exception:
+        # the error (or an earlier one in a segment) is reported by the serial path
+        return None
+    if not load_constraints(hl7version).consistent:
+        return None
+    try:
+        msh_18 = parsed.msh.msh_18.value
+    except Exception:
+        msh_18 = "ASCII"
+    # the segments hl7apy parses, in order; MSH was parsed with the skeleton
+    placed = [text for _, text in placed_segments(segments, parsed)][1:]
+    return hl7version, msh_9, msh_18, placed, parser.get_message_info(setmsg)[0]
+
+
+def check_content(msg, hl7version, details, reports, stages, profile=None):
+    """
+    Job: the message structure and site profile checks of a message whose
+    segments were checked, reports being their SegmentReports by text.
+    :return: the api.hl7validatorapi() result dict
+    """
+    resultmessage = api.resultMessage()
+    if "structure" not in stages:
+        result = api._result(resultmessage, details, [], hl7version, "Valid")
+    else:
+        result = api._validate_content(
+            resultmessage, api.set_message_to_validate(msg), hl7version, details, [], "Valid",
+            reports=reports, stages=stages,
+        )
+    return api.add_profile_findings(result, msg, profile)
+
+
+def _call(fn, *args):
+    return fn(*args)
+
+
+def validate(msg, run_chunks, chunk_size=200, validation_profile=None, profile=None, run=None):
+    """
+    Tolerant, fast-engine validation of a large message with the segment work
+    done by run_chunks.
+
+    :param run_chunks: function taking a list of validate_chunk() argument
+        tuples and returning their results in the same order, e.g. by
+        spreading them over a process pool
+    :param chunk_size: segments per chunk
+    :param profile: CompiledProfile of a site message profile
+    :param run: runs the whole-message stages (read_skeleton, check_content)
+        as run(fn, *args), e.g. in a worker process under the time budget;
+        they run in this process by default
+    :return: the api.hl7validatorapi() result dict, or None when the message
+        must be validated serially
+    """
+    run = run or _call
+    stages = api.get_validation_profile(validation_profile)
+    header = run(read_skeleton, msg)
+    if header is None:
+        return None
+    hl7version, msh_9, msh_18, placed, encoding_chars = header
+
+    log_message(
+        logger, logging.INFO, "message received in hl7validatorapi", msg,
+        validation_level="tolerant", validation_profile=validation_profile,
+        message_length=len(msg), parallel=True,
+    )
+    resultmessage = api.resultMessage()
+
+    unique = list(dict.fromkeys(placed))
+    results = run_chunks(
+        [(chunk, hl7version, encoding_chars) for chunk in chunked(unique, chunk_size)]
+    )
+    outcomes = dict(zip(unique, (result for chunk in results for result in chunk)))
+    for seg_text in placed:
+        parse_error, _ = outcomes[seg_text]
+        if parse_error:
+            # the error quotes the rejected value, which may be PHI: only the segment is logged
+            log_message(
+                logger, logging.ERROR, "Not able to parse message", msg, segment=seg_text[:3]
+            )
+            resultmessage.statusCode = "Failed"
+            resultmessage.hl7version = hl7version
+            resultmessage.message = "[Error parsing message] " + parse_error
+            return resultmessage.__dict__
+
+    if msh_9 == "":
+        resultmessage.statusCode = "Failed"
+        resultmessage.hl7version = hl7version
+        resultmessage.message = "[Error parsing message] No MSH9"
+        return resultmessage.__dict__
+    details = []
+    if msh_18 == "ASCII" and not msg.isascii():
+        details.append({"level": "Error", "message": "Message is not ASCII encoded"})
+
+    reports = {seg_text: report for seg_text, (_, report) in outcomes.items()}
+    return run(check_content, msg, hl7version, details, reports, stages, profile)
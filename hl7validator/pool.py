@@ -0,0 +1,456 @@
+"""Bounded process pools for the CPU-bound validation work."""
+
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hl7validator import logs
+
+logger = logging.getLogger(__name__)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_count(cgroup_root="/sys/fs/cgroup"):
+    """CPUs this process may use: its affinity, capped by a cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    quota = None
+    cpu_max = _read(os.path.join(cgroup_root, "cpu.max"))  # v2: "<quota> <period>"
+    if cpu_max:
+        limit, _, period = cpu_max.partition(" ")
+        if limit != "max" and period:
+            quota = int(limit) / int(period)
+    else:  # v1
+        limit = _read(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us"))
+        period = _read(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us"))
+        if limit and period and int(limit) > 0:
+            quota = int(limit) / int(period)
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def default_workers():
+    """
+    Default number of processes of a pool: the CPUs this process may use,
+    shared by the HL7VALIDATOR_SERVER_WORKERS server workers of the host
+    (set by gunicorn_conf, 1 otherwise), at least 1.
+    """
+    servers = int(os.getenv("HL7VALIDATOR_SERVER_WORKERS") or 1)
+    return max(1, cpu_count() // max(1, servers))
+
+
+class PoolSaturated(Exception):
+    """Raised when a job is submitted while the pool queue is full."""
+
+
+class JobTimeout(Exception):
+    """Raised when a job overran its time budget and its worker was killed."""
+
+
+def _serve(conn, log_level=None, sample_rate=0, initializer=None, initargs=()):
+    """
+    Worker process loop: run initializer(*initargs), then the jobs received
+    on conn, one at a time. Records of the "hl7validator" logger are sent on
+    conn as (None, record), for the parent to write with its own handlers.
+    """
+    lock = threading.Lock()
+
+    def send_record(record):
+        with lock:
+            conn.send((None, record))
+
+    if log_level is not None:
+        logs.forward_logging(send_record, log_level, sample_rate)
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception as err:
+            # the jobs still run, only without the warm-up
+            logger.error(f"Worker process initializer failed: {type(err).__name__}: {err}")
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        fn, args, kwargs = job
+        try:
+            reply = (True, fn(*args, **kwargs))
+        except Exception as err:
+            reply = (False, err)
+        with lock:
+            try:
+                conn.send(reply)
+            except Exception as err:
+                # result or exception that does not pickle
+                conn.send((False, RuntimeError(f"{type(err).__name__}: {err}")))
+
+
+class _Worker:
+    def __init__(self, context, initializer=None, initargs=()):
+        self.conn, child_conn = context.Pipe()
+        # the logging settings of this process, for the records of the worker
+        log_level = logging.getLogger(logs.LOGGER_NAME).getEffectiveLevel()
+        self.process = context.Process(
+            target=_serve,
+            args=(child_conn, log_level, logs.sampler.rate, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def receive(self, timeout):
+        """
+        Wait for the reply to the current job, handling the log records the
+        worker sends before it with the loggers of this process.
+        :return: (ok, result), or None when timeout ran out first
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self.conn.poll(remaining):
+                return None
+            ok, result = self.conn.recv()
+            if ok is not None:
+                return ok, result
+            logging.getLogger(result.name).handle(result)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes that run one job at a time and can be killed mid-job.
+
+    Unlike a ProcessPoolExecutor, a job that overruns its timeout does not
+    keep its process busy: the process is killed, replaced on the next job
+    and :class:`JobTimeout` is raised to the caller. ``run`` is blocking and
+    thread-safe; callers wait for an idle process when all are busy, and that
+    wait does not count against the timeout.
+
+    Processes are spawned by default, so they start from a clean interpreter
+    and only import the modules of the jobs they run. Their log records are
+    sent back with the results and written by the logging setup of this
+    process (see logs.configure_logging), at its level and sampling rate.
+
+    :param initializer: run with initargs in each process when it starts,
+        before its first job, e.g. to load what the jobs need
+    """
+
+    def __init__(self, size=1, start_method="spawn", initializer=None, initargs=()):
+        self.size = size
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.killed = 0
+        # callers waiting for an idle process
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context(start_method)
+        # idle workers, None standing for a process not started yet
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def run(self, timeout, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) in a worker process and return its result.
+        Exceptions raised by fn are re-raised here.
+
+        :param timeout: seconds, None or 0 for no limit
+        :raises JobTimeout: when the job did not finish within timeout
+        """
+        return self._call(lambda: timeout, fn, args, kwargs)
+
+    def run_until(self, deadline, fn, *args, **kwargs):
+        """
+        Like run(), with a time.monotonic() deadline instead of a timeout:
+        the wait for an idle process counts against it, so the jobs of a
+        batch share one budget however many processes there are.
+        """
+        return self._call(lambda: max(deadline - time.monotonic(), 0.001), fn, args, kwargs)
+
+    def _call(self, get_timeout, fn, args, kwargs):
+        with self._lock:
+            self._waiting += 1
+        try:
+            worker = self._idle.get()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        try:
+            if worker is None:
+                worker = self._new_worker()
+            timeout = get_timeout()
+            worker.conn.send((fn, args, kwargs))
+            reply = worker.receive(timeout)
+            if reply is None:
+                worker.kill()
+                worker = None
+                self.killed += 1
+                raise JobTimeout(f"Job did not finish within {timeout:g} s")
+            ok, result = reply
+        except (EOFError, OSError) as err:
+            if worker is not None:
+                worker.kill()
+                worker = None
+            raise RuntimeError(f"Worker process died: {err}") from err
+        finally:
+            self._idle.put(worker)
+        if not ok:
+            raise result
+        return result
+
+    def run_each(self, timeout, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) once in every started process, e.g. to inspect
+        them, after the busy ones finish their job; processes not started yet
+        are skipped. Exceptions raised by fn are re-raised here, the first one
+        once every process ran the job.
+
+        :param timeout: seconds per process, None or 0 for no limit
+        :return: the results, one per process
+        """
+        workers = [self._idle.get() for _ in range(self.size)]
+        results = []
+        error = None
+        try:
+            for index, worker in enumerate(workers):
+                if worker is None:
+                    continue
+                try:
+                    worker.conn.send((fn, args, kwargs))
+                    reply = worker.receive(timeout)
+                except (EOFError, OSError) as err:
+                    reply = (False, RuntimeError(f"Worker process died: {err}"))
+                    worker.kill()
+                    workers[index] = None
+                if reply is None:
+                    worker.kill()
+                    workers[index] = None
+                    self.killed += 1
+                    reply = (False, JobTimeout(f"Job did not finish within {timeout:g} s"))
+                ok, result = reply
+                if ok:
+                    results.append(result)
+                elif error is None:
+                    error = result
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+        if error is not None:
+            raise error
+        return results
+
+    def _new_worker(self):
+        return _Worker(self._context, self.initializer, self.initargs)
+
+    def start(self):
+        """
+        Start the processes that are not running yet, instead of on their
+        first job, so that their initializer runs before the first requests.
+        Call it in the process that runs the jobs (after a fork).
+        """
+        workers = []
+        while True:
+            try:
+                workers.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            for index, worker in enumerate(workers):
+                if worker is None:
+                    workers[index] = self._new_worker()
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def stats(self):
+        """
+        Return a snapshot of the pool occupancy; saturation is 1 when every
+        process is busy, above 1 when callers wait for one.
+        """
+        with self._lock:
+            waiting = self._waiting
+        busy = self.size - self._idle.qsize()
+        return {
+            "workers": self.size,
+            "busy": busy,
+            "waiting": waiting,
+            "saturation": (busy + waiting) / self.size,
+            "killed": self.killed,
+        }
+
+    def shutdown(self):
+        for _ in range(self.size):
+            worker = self._idle.get()
+            if worker is not None:
+                worker.stop()
+            self._idle.put(None)
+
+
+class ValidationPool:
+    """
+    Process pool with a bounded number of pending jobs.
+
+    ``max_workers`` processes run jobs; at most ``max_queue`` further jobs wait
+    for a free process. Anything beyond that is rejected with
+    :class:`PoolSaturated` instead of queueing without limit, so callers can
+    shed load (e.g. answer 503) while the pool catches up.
+
+    Jobs running longer than ``time_budget`` seconds have their process
+    killed and their future fails with :class:`JobTimeout`. ``initializer``
+    runs in each process when it starts (see :class:`WorkerPool`).
+    """
+
+    def __init__(
+        self, max_workers=None, max_queue=None, start_method=None, time_budget=None,
+        initializer=None, initargs=(),
+    ):
+        self.max_workers = max_workers or default_workers()
+        self.max_queue = self.max_workers * 2 if max_queue is None else max_queue
+        self.start_method = start_method or "spawn"
+        self.time_budget = time_budget
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.completed = 0
+        self.rejected = 0
+        self._pending = 0
+        self._executor = None
+        self._workers = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, initializer=None, initargs=()):
+        """
+        Build a pool from the HL7VALIDATOR_POOL_* environment variables.
+        """
+        workers = os.getenv("HL7VALIDATOR_POOL_WORKERS")
+        max_queue = os.getenv("HL7VALIDATOR_POOL_QUEUE")
+        return cls(
+            max_workers=int(workers) if workers else None,
+            max_queue=int(max_queue) if max_queue else None,
+            start_method=os.getenv("HL7VALIDATOR_POOL_START_METHOD") or None,
+            time_budget=float(os.getenv("HL7VALIDATOR_TIME_BUDGET", "30")) or None,
+            initializer=initializer,
+            initargs=initargs,
+        )
+
+    def _get_executor(self):
+        if self._executor is None:
+            # one thread per process, each blocking on its process until the job is done
+            self._workers = WorkerPool(
+                self.max_workers, self.start_method, self.initializer, self.initargs
+            )
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="validation-pool"
+            )
+            logger.info(
+                f"Started validation pool: {self.max_workers} workers, queue {self.max_queue}"
+            )
+        return self._executor
+
+    @property
+    def workers(self):
+        """The WorkerPool running the jobs, e.g. to run other jobs on its processes."""
+        with self._lock:
+            self._get_executor()
+            return self._workers
+
+    def start(self):
+        """Start the worker processes now instead of on the first jobs."""
+        with self._lock:
+            self._get_executor()
+            workers = self._workers
+        workers.start()
+
+    def run_each(self, timeout, fn, *args, **kwargs):
+        """WorkerPool.run_each() on the processes of this pool, if started."""
+        with self._lock:
+            workers = self._workers
+        if workers is None:
+            return []
+        return workers.run_each(timeout, fn, *args, **kwargs)
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit a job to the pool.
+
+        :return: a :class:`concurrent.futures.Future`
+        :raises PoolSaturated: when all workers are busy and the queue is full
+        """
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolSaturated(
+                    f"Validation queue is full ({self._pending} jobs pending)"
+                )
+            self._pending += 1
+            executor = self._get_executor()
+        try:
+            future = executor.submit(self._workers.run, self.time_budget, fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._job_done)
+        return future
+
+    def stats(self):
+        """
+        Return a snapshot of the pool occupancy.
+        """
+        with self._lock:
+            pending = self._pending
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": min(pending, self.max_workers),
+                "queued": max(0, pending - self.max_workers),
+                "saturation": pending / (self.max_workers + self.max_queue),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "killed": self._workers.killed if self._workers else 0,
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            workers, self._workers = self._workers, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        if workers is not None and wait:
+            workers.shutdown()
@@ -0,0 +1,487 @@
+"""
+Feed profiling: how senders actually fill the fields of their messages.
+
+Messages are sliced on their encoding characters (no hl7apy elements are
+built) and, for every (message type, segment, field, component), constant
+size aggregates are kept: fill rate, maximum length, an estimate of the
+number of distinct values (HyperLogLog, exact while small), the most
+frequent values (Space-Saving) and the values that do not match the
+datatype or HL7 table of the element in the constraint tables of the
+message's version. Component 0 stands for the field as a whole.
+
+Profiles are mergeable, so partial profiles built by parallel workers
+combine into the profile of the whole feed::
+
+    profile = FeedProfile()
+    for msg in messages:
+        profile.add(msg)
+    report = profile.report()
+"""
+
+import base64
+import functools
+import hashlib
+import math
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from hl7apy import SUPPORTED_LIBRARIES
+
+from hl7validator.codec import declared_charset
+from hl7validator.constraints import load_constraints
+from hl7validator.spool import iter_messages
+
+# Longest value kept by the top values counters
+MAX_VALUE_LENGTH = 64
+
+# Characters read at a time from a feed file
+READ_SIZE = 1 << 20
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+_DATE = r"\d{4}((0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])?)?"
+_TIME = r"([01]\d|2[0-3])([0-5]\d([0-5]\d(\.\d{1,4})?)?)?"
+_ZONE = r"([+-]\d{4})?"
+
+# Formats of the primitive datatypes with a fixed syntax
+DATATYPE_FORMATS = {
+    "NM": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)\Z"),
+    "SI": re.compile(r"\d+\Z"),
+    "DT": re.compile(_DATE + r"\Z"),
+    "TM": re.compile(_TIME + _ZONE + r"\Z"),
+    "DTM": re.compile(
+        r"\d{4}((0[1-9]|1[0-2])((0[1-9]|[12]\d|3[01])(" + _TIME + r")?)?)?" + _ZONE + r"\Z"
+    ),
+}
+
+
+def _hash(value):
+    digest = hashlib.blake2b(value.encode("utf-8", "replace"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class DistinctCounter:
+    """
+    Distinct values estimate: an exact set of value hashes while small, a
+    HyperLogLog of 2**precision registers (about 1.04 / sqrt(2**precision)
+    relative error) beyond.
+    """
+
+    __slots__ = ("precision", "exact", "registers")
+
+    EXACT_LIMIT = 64
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.exact = set()
+        self.registers = None
+
+    def add(self, value):
+        self._add_hash(_hash(value))
+
+    def _add_hash(self, h):
+        if self.registers is None:
+            self.exact.add(h)
+            if len(self.exact) > self.EXACT_LIMIT:
+                self.registers = bytearray(1 << self.precision)
+                for h in self.exact:
+                    self._set_register(h)
+                self.exact = None
+        else:
+            self._set_register(h)
+
+    def _set_register(self, h):
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        if self.registers is None:
+            return len(self.exact)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # linear counting for small cardinalities
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+    def merge(self, other):
+        if other.registers is None:
+            for h in other.exact:
+                self._add_hash(h)
+            return
+        if self.registers is None:
+            exact, self.exact = self.exact, None
+            self.registers = bytearray(other.registers)
+            for h in exact:
+                self._set_register(h)
+            return
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_dict(self):
+        if self.registers is None:
+            return {"exact": sorted(self.exact)}
+        return {"registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data, precision=10):
+        counter = cls(precision)
+        if "registers" in data:
+            counter.exact = None
+            counter.registers = bytearray(base64.b64decode(data["registers"]))
+            counter.precision = len(counter.registers).bit_length() - 1
+        else:
+            counter.exact = set(data["exact"])
+        return counter
+
+
+class TopValues:
+    """Most frequent values, counted with the Space-Saving algorithm in `capacity` counters."""
+
+    __slots__ = ("capacity", "counts")
+
+    def __init__(self, capacity=30):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value, count=1):
+        value = value[:MAX_VALUE_LENGTH]
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+        elif len(counts) < self.capacity:
+            counts[value] = count
+        else:
+            # the new value takes over the least frequent counter
+            least = min(counts, key=counts.get)
+            counts[value] = counts.pop(least) + count
+
+    def merge(self, other):
+        counts = self.counts
+        for value, count in other.counts.items():
+            counts[value] = counts.get(value, 0) + count
+        if len(counts) > self.capacity:
+            self.counts = dict(sorted(counts.items(), key=lambda item: -item[1])[: self.capacity])
+
+    def top(self, k):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+class ElementStats:
+    """Aggregates of one (message type, segment, field, component)."""
+
+    __slots__ = (
+        "datatype", "filled", "values", "max_length", "distinct", "top",
+        "datatype_violations", "table_violations",
+    )
+
+    def __init__(self, datatype=None, precision=10, capacity=30):
+        self.datatype = datatype
+        # segments where the element has a value, and values (repetitions) seen
+        self.filled = 0
+        self.values = 0
+        self.max_length = 0
+        self.distinct = DistinctCounter(precision)
+        self.top = TopValues(capacity)
+        self.datatype_violations = 0
+        self.table_violations = 0
+
+    def merge(self, other):
+        self.datatype = self.datatype or other.datatype
+        self.filled += other.filled
+        self.values += other.values
+        self.max_length = max(self.max_length, other.max_length)
+        self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+        self.datatype_violations += other.datatype_violations
+        self.table_violations += other.table_violations
+
+    def to_dict(self):
+        return {
+            "datatype": self.datatype,
+            "filled": self.filled,
+            "values": self.values,
+            "max_length": self.max_length,
+            "distinct": self.distinct.to_dict(),
+            "top": self.top.counts,
+            "datatype_violations": self.datatype_violations,
+            "table_violations": self.table_violations,
+        }
+
+    @classmethod
+    def from_dict(cls, data, capacity=30):
+        stats = cls(data["datatype"], capacity=capacity)
+        stats.filled = data["filled"]
+        stats.values = data["values"]
+        stats.max_length = data["max_length"]
+        stats.distinct = DistinctCounter.from_dict(data["distinct"])
+        stats.top.counts = dict(data["top"])
+        stats.datatype_violations = data["datatype_violations"]
+        stats.table_violations = data["table_violations"]
+        return stats
+
+
+def _constraints(version):
+    """Constraint tables of a version, None for versions hl7apy does not know."""
+    # checked before the cache, which would otherwise keep every bad MSH-12 of a feed
+    if version not in SUPPORTED_LIBRARIES:
+        return None
+    return _load_constraints(version)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_constraints(version):
+    try:
+        return load_constraints(version)
+    except Exception:
+        return None
+
+
+class FeedProfile:
+    """
+    Field usage statistics of a feed, in memory bounded by the number of
+    distinct elements (not messages).
+
+    :param precision: HyperLogLog precision, 2**precision one-byte registers per element
+    :param capacity: counters of the top values per element
+    """
+
+    def __init__(self, precision=10, capacity=30):
+        self.precision = precision
+        self.capacity = capacity
+        self.messages = 0
+        self.unparsed = 0
+        # (message type, segment) -> occurrences
+        self.segments = {}
+        # (message type, segment, field, component) -> ElementStats
+        self.elements = {}
+
+    def _stats(self, key, datatype):
+        stats = self.elements.get(key)
+        if stats is None:
+            stats = self.elements[key] = ElementStats(datatype, self.precision, self.capacity)
+        return stats
+
+    def add(self, msg):
+        """Add a raw ER7 message to the profile."""
+        text = msg.lstrip()
+        if not text.startswith("MSH") or len(text) < 8:
+            self.unparsed += 1
+            return
+        self.messages += 1
+        field_sep, component_sep, repetition_sep = text[3], text[4], text[5]
+        segments = [segment for segment in _SEGMENT_SEPARATORS.split(text) if segment.strip()]
+        msh = segments[0].split(field_sep)
+        message_type = component_sep.join(msh[8].split(component_sep)[:2]) if len(msh) > 8 else ""
+        vc = _constraints(msh[11].split(component_sep)[0] if len(msh) > 11 else "")
+        for segment in segments:
+            name = segment[:3]
+            key = (message_type, name)
+            self.segments[key] = self.segments.get(key, 0) + 1
+            if name == "MSH":
+                # MSH-1 is the field separator itself and MSH-2 the encoding characters
+                values = [field_sep] + segment[4:].split(field_sep)
+            else:
+                values = segment[4:].split(field_sep)
+            segment_node = vc.segment(name) if vc is not None else None
+            nodes = segment_node.children if segment_node is not None else None
+            for number, value in enumerate(values, 1):
+                if not value:
+                    continue
+                node = None
+                if nodes is not None and number <= len(nodes):
+                    node = nodes[number - 1][1]
+                if name == "MSH" and number <= 2:
+                    repetitions = [value]
+                else:
+                    repetitions = value.split(repetition_sep)
+                self._add_field((message_type, name, number), node, vc, repetitions, component_sep)
+
+    def _add_field(self, key, node, vc, repetitions, component_sep):
+        children = node.children if node is not None else None
+        filled = set()
+        for repetition in repetitions:
+            if not repetition:
+                continue
+            # (component, value, datatype, compiled node to check the value against)
+            parts = [(
+                0, repetition, node.datatype if node is not None else None,
+                node if children is None else None,
+            )]
+            if children is not None or node is None:
+                components = repetition.split(component_sep)
+                if children is not None or len(components) > 1:
+                    for index, component in enumerate(components, 1):
+                        child = None
+                        if children and index <= len(children):
+                            child = children[index - 1][1]
+                        datatype = child.datatype if child is not None else None
+                        parts.append((index, component, datatype, child))
+            for index, value, datatype, element in parts:
+                if not value:
+                    continue
+                stats = self._stats(key + (index,), datatype)
+                if index not in filled:
+                    filled.add(index)
+                    stats.filled += 1
+                stats.values += 1
+                if len(value) > stats.max_length:
+                    stats.max_length = len(value)
+                stats.distinct.add(value)
+                stats.top.add(value)
+                if element is not None and element.children is None:
+                    self._check(stats, element, vc, value)
+
+    @staticmethod
+    def _check(stats, element, vc, value):
+        pattern = DATATYPE_FORMATS.get(element.datatype)
+        if pattern is not None and not pattern.match(value):
+            stats.datatype_violations += 1
+        if element.table is not None:
+            table = vc.tables.get(element.table)
+            if table is not None and value not in table:
+                stats.table_violations += 1
+
+    def merge(self, other):
+        """Add the counts of another profile (e.g. built by another worker) to this one."""
+        self.messages += other.messages
+        self.unparsed += other.unparsed
+        for key, count in other.segments.items():
+            self.segments[key] = self.segments.get(key, 0) + count
+        for key, stats in other.elements.items():
+            if key in self.elements:
+                self.elements[key].merge(stats)
+            else:
+                self.elements[key] = stats
+        return self
+
+    def to_dict(self):
+        """Serializable partial profile, see from_dict()."""
+        return {
+            "messages": self.messages,
+            "unparsed": self.unparsed,
+            "segments": [[*key, count] for key, count in self.segments.items()],
+            "elements": [[*key, stats.to_dict()] for key, stats in self.elements.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data, capacity=30):
+        profile = cls(capacity=capacity)
+        profile.messages = data["messages"]
+        profile.unparsed = data["unparsed"]
+        profile.segments = {(t, s): count for t, s, count in data["segments"]}
+        profile.elements = {
+            (t, s, f, c): ElementStats.from_dict(stats, capacity)
+            for t, s, f, c, stats in data["elements"]
+        }
+        return profile
+
+    def report(self, top_k=10):
+        """
+        Statistics per element, fill rates relative to the occurrences of the segment.
+        :return: dict with the message counts and a list of element entries
+        """
+        message_types = {}
+        for (message_type, segment), count in self.segments.items():
+            if segment == "MSH":
+                message_types[message_type] = count
+        elements = []
+        for key in sorted(self.elements):
+            message_type, segment, field, component = key
+            stats = self.elements[key]
+            occurrences = self.segments.get((message_type, segment), 0)
+            name = f"{segment}-{field}" + (f".{component}" if component else "")
+            elements.append({
+                "message_type": message_type,
+                "element": name,
+                "datatype": stats.datatype,
+                "segments": occurrences,
+                "filled": stats.filled,
+                "fill_rate": round(stats.filled / occurrences, 4) if occurrences else None,
+                "values": stats.values,
+                "max_length": stats.max_length,
+                "distinct": stats.distinct.estimate(),
+                "top": stats.top.top(top_k),
+                "datatype_violations": stats.datatype_violations,
+                "table_violations": stats.table_violations,
+            })
+        return {
+            "messages": self.messages,
+            "unparsed": self.unparsed,
+            "message_types": dict(sorted(message_types.items())),
+            "elements": elements,
+        }
+
+
+def profile_batch(messages):
+    """Process pool job: profile a batch of messages and return the partial profile as a dict."""
+    profile = FeedProfile()
+    for msg in messages:
+        profile.add(msg)
+    return profile.to_dict()
+
+
+def read_messages(paths):
+    """
+    Messages of files, directories (read recursively) or "-" for stdin,
+    streamed in blocks so that large batch files are never read whole.
+    Files are decoded with the charset declared in the MSH-18 of their
+    first message, UTF-8 otherwise.
+    """
+    for path in paths:
+        if path == "-":
+            yield from iter_messages(iter(lambda: sys.stdin.read(READ_SIZE), ""))
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                yield from read_messages(
+                    os.path.join(root, name) for name in sorted(files) if not name.startswith(".")
+                )
+        else:
+            with open(path, "rb") as f:
+                charset = declared_charset(f.read(4096)) or "utf-8"
+            with open(path, encoding=charset, errors="replace", newline="") as f:
+                yield from iter_messages(iter(lambda: f.read(READ_SIZE), ""))
+
+
+def _batches(messages, size):
+    batch = []
+    for msg in messages:
+        batch.append(msg)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def profile_feed(messages, workers=1, batch_size=2000):
+    """
+    Profile a stream of messages, in batches spread over worker processes
+    whose partial profiles are merged as they complete.
+    :return: FeedProfile
+    """
+    profile = FeedProfile()
+    if workers <= 1:
+        for msg in messages:
+            profile.add(msg)
+        return profile
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = set()
+        for batch in _batches(messages, batch_size):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    profile.merge(FeedProfile.from_dict(future.result()))
+            pending.add(executor.submit(profile_batch, batch))
+        for future in pending:
+            profile.merge(FeedProfile.from_dict(future.result()))
+    return profile
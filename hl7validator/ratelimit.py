@@ -0,0 +1,302 @@
+"""
+Admission control for the validator: per-client token buckets and separate
+concurrency pools for interactive (web form) and bulk (API) traffic.
+
+Bucket state and counters live in a backend. ``MemoryBackend`` keeps them in
+the current process; ``SQLiteBackend`` keeps them in a local SQLite file so
+that every gunicorn worker on the host shares the same limits. Buckets left
+idle long enough to be full again are dropped, so one-off clients do not
+accumulate. The concurrency pools are always per process.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+def parse_limit(value):
+    """
+    Parse a "rate/burst" limit specification, e.g. "5/20" for 5 requests
+    per second with bursts of up to 20. A bare rate uses the rate as burst.
+    :return: (rate, burst) tuple, rate 0 meaning unlimited
+    """
+    if isinstance(value, dict):
+        rate = float(value.get("rate", 0))
+        return rate, float(value.get("burst", rate))
+    rate, _, burst = str(value).partition("/")
+    rate = float(rate or 0)
+    return rate, float(burst) if burst else rate
+
+
+class MemoryBackend:
+    """Bucket and counter storage local to the current process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def expire(self, before):
+        """Drop the buckets last updated before this time."""
+        with self._lock:
+            for key in [k for k, (_, updated) in self._buckets.items() if updated < before]:
+                del self._buckets[key]
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class SQLiteBackend:
+    """Bucket and counter storage shared by all processes using the same file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def expire(self, before):
+        """Drop the buckets last updated before this time."""
+        self._connect().execute("DELETE FROM buckets WHERE updated < ?", (before,))
+
+    def incr(self, name, amount=1):
+        self._connect().execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def counters(self):
+        return dict(self._connect().execute("SELECT name, value FROM counters"))
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter per client plus a concurrency pool per traffic class.
+
+    :param rate: default requests per second per client (0 disables limiting)
+    :param burst: default bucket size per client
+    :param overrides: dict of client id ("key:<api key>" or "ip:<address>")
+        to a "rate/burst" specification; only these API keys identify clients
+    :param concurrency: dict of traffic class to maximum in-flight requests
+        in this process (0 means unbounded); each gunicorn worker has its own
+        pools, so a host admits up to this many times its workers
+    :param expire_interval: seconds between sweeps of the idle buckets
+    """
+
+    def __init__(
+        self,
+        rate=0,
+        burst=None,
+        overrides=None,
+        concurrency=None,
+        backend=None,
+        expire_interval=60,
+    ):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.overrides = {k: parse_limit(v) for k, v in (overrides or {}).items()}
+        self.backend = backend or MemoryBackend()
+        self.expire_interval = expire_interval
+        self._expired = None
+        self.pools = {}
+        for name, limit in (concurrency or {}).items():
+            if limit:
+                self.pools[name] = threading.BoundedSemaphore(limit)
+
+    @classmethod
+    def from_config(cls, config):
+        storage = config.get("RATELIMIT_STORAGE")
+        backend = SQLiteBackend(storage) if storage else MemoryBackend()
+        overrides = {}
+        if config.get("RATELIMIT_OVERRIDES"):
+            with open(config["RATELIMIT_OVERRIDES"]) as f:
+                overrides = json.load(f)
+        rate, burst = parse_limit(config.get("RATELIMIT_DEFAULT") or 0)
+        return cls(
+            rate=rate,
+            burst=burst,
+            overrides=overrides,
+            concurrency={
+                INTERACTIVE: config.get("RATELIMIT_INTERACTIVE_CONCURRENCY", 0),
+                BULK: config.get("RATELIMIT_BULK_CONCURRENCY", 0),
+            },
+            backend=backend,
+        )
+
+    def check_rate(self, client, now=None):
+        """
+        Take one token from the client's bucket.
+        :return: (allowed, retry_after_seconds)
+        """
+        rate, burst = self.overrides.get(client, (self.rate, self.burst))
+        if rate <= 0:
+            return True, 0
+        now = time.time() if now is None else now
+        if self._expired is None or now - self._expired >= self.expire_interval:
+            self._expired = now
+            self.backend.expire(now - self.refill_seconds())
+        return self.backend.take(client, rate, burst, now)
+
+    def refill_seconds(self):
+        """Seconds for the slowest bucket to fill up: idle buckets are full after that."""
+        limits = [(self.rate, self.burst), *self.overrides.values()]
+        return max((burst / rate for rate, burst in limits if rate > 0), default=0)
+
+    def acquire(self, traffic_class):
+        """Reserve an in-flight slot; returns False when the pool is full."""
+        pool = self.pools.get(traffic_class)
+        return pool is None or pool.acquire(blocking=False)
+
+    def release(self, traffic_class):
+        pool = self.pools.get(traffic_class)
+        if pool is not None:
+            pool.release()
+
+    def admit(self, client, traffic_class):
+        """
+        Decide whether a request may run.
+        :return: (admitted, reason, retry_after) -- reason is None when admitted
+        """
+        allowed, retry_after = self.check_rate(client)
+        if not allowed:
+            reason = "rate_limit"
+        elif not self.acquire(traffic_class):
+            reason, retry_after = "concurrency", 1
+        else:
+            self.backend.incr(f"admitted:{traffic_class}")
+            return True, None, 0
+        self.backend.incr(f"rejected:{traffic_class}:{reason}")
+        return False, reason, retry_after
+
+    def metrics(self):
+        """Render the admission counters in Prometheus text format."""
+        lines = [
+            "# TYPE hl7validator_requests_admitted_total counter",
+            "# TYPE hl7validator_requests_rejected_total counter",
+        ]
+        for name, value in sorted(self.backend.counters().items()):
+            parts = name.split(":")
+            if parts[0] == "admitted":
+                lines.append(f'hl7validator_requests_admitted_total{{pool="{parts[1]}"}} {value}')
+            elif parts[0] == "rejected":
+                lines.append(
+                    f'hl7validator_requests_rejected_total{{pool="{parts[1]}",reason="{parts[2]}"}} {value}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+def client_id(api_key, remote_addr, overrides=()):
+    """
+    Identify the caller by API key when the key has an override, by remote
+    address otherwise: any other key would get a fresh bucket per request.
+    """
+    if api_key and "key:" + api_key in overrides:
+        return "key:" + api_key
+    return "ip:" + (remote_addr or "unknown")
+
+
+def traffic_class(request):
+    """Classify a request as bulk (API), interactive (web form) or None (not limited)."""
+    if request.path.startswith("/api/"):
+        return BULK
+    if request.method == "POST":
+        return INTERACTIVE
+    return None
+
+
+def init_app(app, limiter, collectors=()):
+    """
+    Register the admission hooks and the /metrics endpoint on a Flask app.
+    :param collectors: functions returning further metrics in Prometheus text format
+    """
+    from flask import g, request, jsonify, Response
+
+    @app.before_request
+    def admission_control():
+        klass = traffic_class(request)
+        if klass is None:
+            return None
+        client = client_id(
+            request.headers.get("X-API-Key"), request.remote_addr, limiter.overrides
+        )
+        admitted, reason, retry_after = limiter.admit(client, klass)
+        if admitted:
+            g.admitted_class = klass
+            return None
+        app.logger.warning(f"Rejected {klass} request from {client}: {reason}")
+        response = jsonify({"statusCode": "Failed", "message": "Too many requests", "reason": reason})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+        return response
+
+    @app.teardown_request
+    def release_slot(exc=None):
+        klass = g.pop("admitted_class", None)
+        if klass is not None:
+            limiter.release(klass)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        text = limiter.metrics() + "".join(collector() for collector in collectors)
+        return Response(text, mimetype="text/plain")
+
+    app.extensions["hl7validator.ratelimit"] = limiter
+    return limiter
@@ -0,0 +1,238 @@
+"""
+Sampling of high-volume feeds.
+
+On a feed too busy to validate every message in full, a deterministic
+1-in-N sample gets the full validation and every other message only the
+header checks (see api.check_header). The sample rate can differ per sender
+(MSH-3, MSH-4) and per message type (MSH-9). Whether a message is sampled
+depends only on its sender and control ID (MSH-10), so a resent message gets
+the same treatment and all workers agree.
+
+Counts are kept per sender, facility and message type, and the error rate
+of the sample is extrapolated to the whole feed.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+
+# Fields a sampling rule can match on
+RULE_FIELDS = (3, 4, 9)
+
+# Distinct (sender, facility, type) groups counted before the rest is lumped together
+MAX_GROUPS = 1000
+OTHER = ("*", "*", "*")
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+
+def msh_fields(msg):
+    """
+    MSH-3, MSH-4, MSH-9 and MSH-10 of a raw message, read without parsing.
+    :return: (dict of field number to value, component separator)
+    """
+    text = (msg or "").lstrip()
+    if not text.startswith("MSH") or len(text) < 5:
+        return {}, "^"
+    values = _SEGMENT_SEPARATORS.split(text, 1)[0].split(text[3])
+    # values[0] is "MSH" and MSH-1 the separator itself, so MSH-n is values[n - 1]
+    fields = {n: values[n - 1] if len(values) >= n else "" for n in RULE_FIELDS + (10,)}
+    return fields, text[4]
+
+
+class SamplingRule:
+    """
+    1-in-N rate for the messages matching all conditions.
+
+    :param conditions: dict of MSH field number (3, 4 or 9) to the expected
+        value; a value matches a field starting with the same components,
+        so "ADT" matches MSH-9 "ADT^A08^ADT_A01"
+    :param one_in: every Nth message is fully validated, 1 validates all
+    """
+
+    def __init__(self, conditions, one_in):
+        self.conditions = {number: tuple(value.split("^")) for number, value in conditions.items()}
+        self.one_in = max(1, int(one_in))
+
+    @classmethod
+    def parse(cls, key, one_in):
+        """
+        Build a rule from a key such as "MSH-3=EPIC,MSH-9=ADT^A08".
+        :raises ValueError: for fields other than MSH-3, MSH-4 and MSH-9
+        """
+        conditions = {}
+        for item in key.split(","):
+            field, _, value = item.strip().partition("=")
+            segment, _, number = field.strip().upper().partition("-")
+            if segment != "MSH" or not number.isdigit() or int(number) not in RULE_FIELDS:
+                raise ValueError(
+                    f"Invalid sampling rule '{key}': conditions must be on MSH-3, MSH-4 or MSH-9"
+                )
+            conditions[int(number)] = value.strip()
+        return cls(conditions, one_in)
+
+    def matches(self, fields, component_separator):
+        for number, expected in self.conditions.items():
+            components = tuple(fields.get(number, "").split(component_separator))
+            if components[: len(expected)] != expected:
+                return False
+        return True
+
+
+class SamplingStats:
+    """Thread-safe counts per (sender, facility, message type) group."""
+
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def record(self, group, sampled, failed):
+        with self._lock:
+            if group not in self._groups and len(self._groups) >= MAX_GROUPS:
+                group = OTHER
+            # seen, sampled, failed in the sample, failed the header check outside the sample
+            counts = self._groups.setdefault(group, [0, 0, 0, 0])
+            counts[0] += 1
+            if sampled:
+                counts[1] += 1
+                counts[2] += failed
+            else:
+                counts[3] += failed
+
+    def snapshot(self):
+        """
+        Counts and extrapolated error rates per group. The error rate is the
+        share of invalid messages in the sample, with its 95% Wilson score
+        interval; estimated_failed extrapolates it to every message seen.
+        """
+        with self._lock:
+            groups = {group: list(counts) for group, counts in self._groups.items()}
+        snapshot = []
+        for (sender, facility, message_type), (seen, sampled, failed, header_failed) in sorted(
+            groups.items()
+        ):
+            rate, low, high = _wilson(failed, sampled)
+            snapshot.append({
+                "sender": sender,
+                "facility": facility,
+                "message_type": message_type,
+                "seen": seen,
+                "sampled": sampled,
+                "sampled_failed": failed,
+                "header_failed": header_failed,
+                "error_rate": rate,
+                "error_rate_low": low,
+                "error_rate_high": high,
+                "estimated_failed": None if rate is None else round(rate * seen),
+            })
+        return snapshot
+
+
+def _wilson(failed, sampled, z=1.96):
+    if not sampled:
+        return None, None, None
+    rate = failed / sampled
+    denominator = 1 + z * z / sampled
+    centre = (rate + z * z / (2 * sampled)) / denominator
+    spread = rate * (1 - rate) / sampled + z * z / (4 * sampled * sampled)
+    margin = z * math.sqrt(spread) / denominator
+    return rate, max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+class SamplingPolicy:
+    """
+    Decide which messages of a feed get the full validation.
+
+    :param one_in: default rate, every Nth message is fully validated
+    :param rules: SamplingRules; the rule with the most matching conditions
+        applies, the first one listed on a tie
+    """
+
+    def __init__(self, one_in=1, rules=()):
+        self.one_in = max(1, int(one_in))
+        self.rules = sorted(rules, key=lambda rule: -len(rule.conditions))
+        self.stats = SamplingStats()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a policy from HL7VALIDATOR_SAMPLE_ONE_IN (default rate) and
+        HL7VALIDATOR_SAMPLING_RULES, a JSON file mapping rule keys
+        ("MSH-3=EPIC,MSH-9=ADT^A08") to their rate.
+        :return: the policy, or None when every message is fully validated
+        """
+        rules = []
+        path = os.getenv("HL7VALIDATOR_SAMPLING_RULES")
+        if path:
+            with open(path) as f:
+                rules = [SamplingRule.parse(key, value) for key, value in json.load(f).items()]
+        policy = cls(int(os.getenv("HL7VALIDATOR_SAMPLE_ONE_IN", "1")), rules)
+        return policy if policy.active else None
+
+    @property
+    def active(self):
+        return self.one_in > 1 or any(rule.one_in > 1 for rule in self.rules)
+
+    def rate(self, fields, component_separator="^"):
+        for rule in self.rules:
+            if rule.matches(fields, component_separator):
+                return rule.one_in
+        return self.one_in
+
+    def decide(self, msg):
+        """
+        :return: (sampled, group) -- sampled is True when the message gets the
+            full validation; group is the (sender, facility, type) to record it under
+        """
+        fields, component_separator = msh_fields(msg)
+        one_in = self.rate(fields, component_separator)
+        group = (
+            fields.get(3, "").split(component_separator)[0],
+            fields.get(4, "").split(component_separator)[0],
+            "^".join(fields.get(9, "").split(component_separator)[:2]),
+        )
+        if one_in == 1:
+            return True, group
+        key = "|".join((fields.get(3, ""), fields.get(4, ""), fields.get(10, "")))
+        if not fields.get(10):
+            key = msg or ""
+        digest = hashlib.blake2b(key.encode("utf-8", "replace"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % one_in == 0, group
+
+    def record(self, group, sampled, result):
+        self.stats.record(group, sampled, result.get("statusCode") != "Success")
+
+    def metrics(self):
+        """Render the sampling counters in Prometheus text format."""
+        lines = [
+            "# TYPE hl7validator_sampling_messages_total counter",
+            "# TYPE hl7validator_sampling_sampled_total counter",
+            "# TYPE hl7validator_sampling_sampled_failed_total counter",
+            "# TYPE hl7validator_sampling_header_failed_total counter",
+            "# TYPE hl7validator_sampling_estimated_error_rate gauge",
+        ]
+        for group in self.stats.snapshot():
+            labels = ",".join(
+                f'{name}="{_escape(group[name])}"'
+                for name in ("sender", "facility", "message_type")
+            )
+            lines.append(f"hl7validator_sampling_messages_total{{{labels}}} {group['seen']}")
+            lines.append(f"hl7validator_sampling_sampled_total{{{labels}}} {group['sampled']}")
+            lines.append(
+                f"hl7validator_sampling_sampled_failed_total{{{labels}}} {group['sampled_failed']}"
+            )
+            lines.append(
+                f"hl7validator_sampling_header_failed_total{{{labels}}} {group['header_failed']}"
+            )
+            if group["error_rate"] is not None:
+                lines.append(
+                    f"hl7validator_sampling_estimated_error_rate{{{labels}}} {group['error_rate']:g}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
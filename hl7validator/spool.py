@@ -0,0 +1,470 @@
+"""
+Drop-folder ingestion: validate the HL7 files that senders drop in a directory.
+
+A spool directory has four subdirectories::
+
+    inbox/   senders drop files here
+    work/    files claimed by the spooler, being validated
+    done/    files whose messages all validated
+    failed/  files with an invalid message, or that could not be validated
+
+Files are claimed by renaming them from inbox/ into work/, which is atomic
+on a single filesystem, so a file is never picked up twice or half-way.
+Each file may hold one or more messages (batch envelope segments and MLLP
+framing are ignored); the messages of a batch of files are validated on a
+process pool, the results are written as ``<file>.json`` next to the file
+(or into the done/ and failed/ subdirectories of a separate results
+directory) and only then is the file moved to done/ or failed/. A file that
+cannot be read or validated is moved to failed/ with the error as its
+result, and the spooler goes on with the others. Files still in work/ when
+the spooler starts, left by a crash, are validated again, so every file is
+processed at least once.
+
+Senders should write under a temporary name (a leading dot, or a ``.tmp``
+or ``.part`` suffix) and rename the file when complete; for those that
+cannot, ``settle`` skips files modified less than that many seconds ago.
+
+New files are noticed with inotify on Linux and by polling the inbox
+elsewhere. One spooler runs per spool directory; it scales through the
+number of pool workers.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from hl7validator.api import hl7validatorapi
+from hl7validator.budget import Limits, budget_result
+from hl7validator.codec import decode_er7, dumps
+from hl7validator.core import validate_job
+from hl7validator.pool import JobTimeout, PoolSaturated, ValidationPool
+from hl7validator.sampling import SamplingPolicy
+
+logger = logging.getLogger("hl7validator")
+
+SPOOL_DIRECTORIES = ("inbox", "work", "done", "failed")
+
+# Names of files still being written by the sender
+PARTIAL_SUFFIXES = (".tmp", ".part", ".partial")
+
+# Batch envelope segments, which are not part of any message
+ENVELOPE_SEGMENTS = ("FHS", "BHS", "BTS", "FTS")
+
+# MLLP start and end of block characters
+MLLP_CHARACTERS = "\x0b\x1c"
+
+_SEGMENT_SEPARATORS = re.compile(r"\r\n|\r|\n")
+
+
+def iter_messages(chunks):
+    """
+    Messages in a stream of text chunks (e.g. the blocks of a large batch
+    file), each starting at an MSH segment. Batch envelope segments and
+    MLLP framing are dropped; text without any MSH segment is one message.
+    :return: iterator of messages, segments separated by carriage returns
+    """
+    current = []
+    pending = ""
+    for chunk in chunks:
+        for char in MLLP_CHARACTERS:
+            chunk = chunk.replace(char, "")
+        segments = _SEGMENT_SEPARATORS.split(pending + chunk)
+        # the last segment may continue in the next chunk ("\r" then "\n" included)
+        pending = segments.pop()
+        if pending == "" and segments and chunk.endswith("\r"):
+            pending = "\r"
+        for segment in segments:
+            message = _add_segment(current, segment)
+            if message:
+                yield message
+    message = _add_segment(current, pending.rstrip("\r"))
+    if message:
+        yield message
+    if current:
+        yield "\r".join(current)
+
+
+def _add_segment(current, segment):
+    if not segment.strip() or segment.lstrip()[:3] in ENVELOPE_SEGMENTS:
+        return None
+    message = None
+    if segment.lstrip().startswith("MSH") and current:
+        message = "\r".join(current)
+        current.clear()
+    current.append(segment)
+    return message
+
+
+def split_messages(text):
+    """
+    Split the content of a dropped file into messages, each starting at an
+    MSH segment. Text that has no MSH segment is returned as one message.
+    :return: list of messages, segments separated by carriage returns
+    """
+    return list(iter_messages([text]))
+
+
+def _free_path(directory, name):
+    """Path for name in directory, with a numeric suffix if the name is taken."""
+    path = os.path.join(directory, name)
+    root, ext = os.path.splitext(name)
+    number = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{root}.{number}{ext}")
+        number += 1
+    return path
+
+
+def _write_atomic(path, content):
+    temporary = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+class _Inotify:
+    """Wait for files to be completed in, or moved into, a directory (Linux)."""
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    def __init__(self, stop):
+        self.stop = stop
+
+    def wait(self, timeout):
+        self.stop.wait(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class Spool:
+    """
+    Spooler for a drop-folder directory.
+
+    :param root: spool directory; its subdirectories are created as needed
+    :param pool: ValidationPool running the validations, defaults to one
+        configured by HL7VALIDATOR_POOL_* and HL7VALIDATOR_TIME_BUDGET
+    :param workers: number of pool processes when no pool is given
+    :param batch_size: files claimed at a time, defaults to 4 per worker
+    :param validation_level: 'tolerant' (default) or 'strict'
+    :param validation_profile: profile name (see api.VALIDATION_PROFILES)
+    :param results: directory for the result files, instead of next to the
+        files in done/ and failed/; they go in its done/ and failed/
+        subdirectories, so the results of done/x.hl7 and failed/x.hl7 differ
+    :param settle: seconds a file must be left unmodified before it is claimed
+    :param sampling: SamplingPolicy, defaults to SamplingPolicy.from_env();
+        messages outside the sample only get the header checks
+    """
+
+    def __init__(
+        self,
+        root,
+        pool=None,
+        workers=None,
+        batch_size=None,
+        validation_level="tolerant",
+        validation_profile=None,
+        results=None,
+        settle=0.0,
+        sampling=None,
+    ):
+        self.root = root
+        for name in SPOOL_DIRECTORIES:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        self.inbox, self.work, self.done, self.failed = (
+            os.path.join(root, name) for name in SPOOL_DIRECTORIES
+        )
+        self.results = results
+        if results:
+            for name in ("done", "failed"):
+                os.makedirs(os.path.join(results, name), exist_ok=True)
+        if pool is None:
+            pool = ValidationPool.from_env()
+            if workers:
+                pool.max_workers = workers
+                pool.max_queue = workers * 2
+        self.pool = pool
+        self.batch_size = batch_size or self.pool.max_workers * 4
+        self.validation_level = validation_level
+        self.validation_profile = validation_profile
+        self.settle = settle
+        self.limits = Limits.from_env()
+        self.sampling = SamplingPolicy.from_env() if sampling is None else sampling
+        self.processed = 0
+        self.failures = 0
+        # files of work/ that could not be moved out, not to be retried by this run
+        self._stuck = set()
+        self._stop = threading.Event()
+
+    def _ready(self, entry):
+        """
+        :return: modification time of a file ready to be claimed, None otherwise
+        """
+        name = entry.name
+        if name.startswith(".") or name.endswith(PARTIAL_SUFFIXES):
+            return None
+        try:
+            if not entry.is_file():
+                return None
+            mtime = entry.stat().st_mtime
+        except OSError:
+            # removed or replaced by the sender while the inbox was scanned
+            return None
+        return mtime if not self.settle or mtime <= time.time() - self.settle else None
+
+    def claim(self, limit=None):
+        """
+        Move up to limit ready files from inbox/ to work/, oldest first.
+        :return: paths of the claimed files
+        """
+        ready = []
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                mtime = self._ready(entry)
+                if mtime is not None:
+                    ready.append((mtime, entry))
+        ready.sort(key=lambda item: item[0])
+        claimed = []
+        for _, entry in ready[:limit or self.batch_size]:
+            target = _free_path(self.work, entry.name)
+            try:
+                os.rename(entry.path, target)
+            except FileNotFoundError:
+                # removed by the sender, or claimed by someone else
+                continue
+            except OSError as err:
+                logger.warning(f"Cannot claim {entry.path}: {err}")
+                continue
+            claimed.append(target)
+        return claimed
+
+    def recover(self):
+        """Files left in work/ by an interrupted run, to be validated again."""
+        with os.scandir(self.work) as entries:
+            return sorted(
+                entry.path
+                for entry in entries
+                if entry.is_file()
+                and not entry.name.startswith(".")
+                and entry.path not in self._stuck
+            )
+
+    def _submit(self, pending, message):
+        while True:
+            try:
+                return self.pool.submit(
+                    validate_job, message, self.validation_level, self.validation_profile
+                )
+            except PoolSaturated:
+                running = [future for future in pending if not future.done()]
+                if running:
+                    wait(running, return_when=FIRST_COMPLETED)
+                else:
+                    # finished, but the pool has not counted it yet
+                    time.sleep(0.01)
+
+    def _result(self, message, job):
+        if isinstance(job, dict):
+            return job
+        try:
+            return job.result()
+        except JobTimeout:
+            return budget_result(
+                message, f"validation did not finish within {self.pool.time_budget:g} s"
+            )
+        except Exception as err:
+            logger.error(f"Error validating a spooled message: {err}")
+            return {"statusCode": "Failed", "message": f"Error validating message: {err}"}
+
+    def _start(self, pending, message):
+        """
+        Submit the validation of a message to the pool, unless its result is
+        already known: over the size limits, or outside the sample.
+        :return: (Future or result dict, sampling decision or None)
+        """
+        reason = self.limits.check(message)
+        if reason:
+            return budget_result(message, reason), None
+        decision = None
+        if self.sampling is not None:
+            decision = self.sampling.decide(message)
+            if not decision[0]:
+                return hl7validatorapi(message, validation_profile="header"), decision
+        future = self._submit(pending, message)
+        pending.append(future)
+        return future, decision
+
+    def process(self, paths):
+        """
+        Validate claimed files and move them to done/ or failed/.
+        :return: list of (final path, outcome) with outcome "done" or "failed"
+        """
+        files = []
+        pending = []
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    messages = split_messages(decode_er7(f.read()))
+                files.append((path, [(m, *self._start(pending, m)) for m in messages], None))
+            except Exception as err:
+                # unreadable, or in a charset that cannot be decoded
+                files.append((path, None, err))
+
+        outcomes = []
+        for path, jobs, error in files:
+            try:
+                if error is None:
+                    outcomes.append(self._finish(path, self._collect(jobs)))
+                    continue
+            except Exception as err:
+                error = err
+            logger.error(f"Error processing spooled file {path}: {error}")
+            outcome = self._fail(path, error)
+            if outcome:
+                outcomes.append(outcome)
+        return outcomes
+
+    def _collect(self, jobs):
+        results = []
+        for message, job, decision in jobs:
+            result = self._result(message, job)
+            if decision is not None:
+                sampled, group = decision
+                result["sampled"] = sampled
+                self.sampling.record(group, sampled, result)
+            results.append(result)
+        return results or [{"statusCode": "Failed", "message": "No Content"}]
+
+    def _fail(self, path, err):
+        """
+        Move a file that could not be processed to failed/, with the error as
+        its result.
+        :return: (final path, "failed"), None when the file cannot be moved
+        """
+        result = {"statusCode": "Failed", "message": f"Error processing file: {err}"}
+        try:
+            return self._finish(path, [result], success=False)
+        except Exception as move_err:
+            logger.error(f"Cannot move {path} to {self.failed}: {move_err}")
+            self._stuck.add(path)
+            return None
+
+    def _finish(self, path, results, success=None):
+        if success is None:
+            success = all(result.get("statusCode") == "Success" for result in results)
+        outcome = "done" if success else "failed"
+        name = os.path.basename(path)
+        target = _free_path(self.done if success else self.failed, name)
+        report = {
+            "file": name,
+            "statusCode": "Success" if success else "Failed",
+            "messages": results,
+        }
+        # the result is written before the file leaves work/: after a crash in
+        # between, the file is validated again and the result rewritten
+        if self.results:
+            results_dir = os.path.join(self.results, outcome)
+        else:
+            results_dir = os.path.dirname(target)
+        _write_atomic(os.path.join(results_dir, os.path.basename(target) + ".json"), dumps(report))
+        os.replace(path, target)
+        self.processed += 1
+        if not success:
+            self.failures += 1
+        return target, outcome
+
+    def run_once(self):
+        """
+        Validate the files left in work/ and one batch from inbox/.
+        :return: number of files processed
+        """
+        paths = self.recover() or self.claim()
+        if not paths:
+            return 0
+        started = time.monotonic()
+        outcomes = self.process(paths)
+        logger.info(
+            "spool batch processed",
+            extra={
+                "files": len(outcomes),
+                "failed": sum(1 for _, outcome in outcomes if outcome == "failed"),
+                "elapsed": round(time.monotonic() - started, 3),
+            },
+        )
+        return len(outcomes)
+
+    def serve(self, poll_interval=1.0):
+        """
+        Process files as they arrive until stop() is called. The inbox is
+        also rescanned every poll_interval seconds, so files missed by the
+        watcher are picked up anyway.
+        """
+        recovered = len(self.recover())
+        if recovered:
+            logger.warning(f"Recovering {recovered} files left in {self.work}")
+        try:
+            watcher = _Inotify(self.inbox)
+        except (OSError, AttributeError, TypeError):
+            watcher = _Poller(self._stop)
+        logger.info(
+            f"Spooling {self.inbox} with {self.pool.max_workers} workers "
+            f"({'inotify' if isinstance(watcher, _Inotify) else 'polling'})"
+        )
+        try:
+            while not self._stop.is_set():
+                try:
+                    if self.run_once():
+                        continue
+                except Exception:
+                    # e.g. the inbox unreadable for a while: try again on the next round
+                    logger.exception("Error processing the spool")
+                watcher.wait(poll_interval)
+        finally:
+            watcher.close()
+
+    def stop(self):
+        """Stop serve() once the current batch is finished."""
+        self._stop.set()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def stats(self):
+        stats = {"processed": self.processed, "failed": self.failures, **self.pool.stats()}
+        if self.sampling is not None:
+            stats["sampling"] = self.sampling.stats.snapshot()
+        return stats
@@ -0,0 +1,283 @@
+"""
+HL7 table (value set) validation.
+
+Coded values are looked up in per-version indexes: one frozenset per table,
+built once from the tables bundled with hl7apy (the same frozensets the
+constraint tables use, see ``constraints.VersionConstraints.tables``) and
+overlaid with the site's own tables, if any. Every check is a set
+membership test.
+
+The validation engines already report leaf ID/IS values outside their
+table (as hl7apy does, as warnings). This stage adds:
+
+- the identifier of coded fields (CE, CWE, CNE, CF) bound to a table, when
+  their coding system is empty or names that table (PID-10 "W^^HL70005");
+  the alternate identifier when its coding system names the table
+- site tables: the findings of the engines for a table the site overrides
+  are replaced by checks against the site's values
+
+Site tables are JSON files (HL7VALIDATOR_TABLES, files or directories,
+separated by commas) mapping table IDs to their values, or to values added
+to and removed from the bundled table; keys naming a version hold tables
+for that version only::
+
+    {
+        "HL70001": ["F", "M", "U", "X"],
+        "HL70004": {"add": ["H"], "remove": ["B"]},
+        "2.5.1": {"HL70203": {"add": ["NNPOR"]}}
+    }
+
+Files are checked for changes at most every HL7VALIDATOR_TABLES_CHECK_INTERVAL
+seconds (2) and reloaded when one changed, so tables can be edited on a
+running server.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from hl7validator import zsegments
+from hl7validator.cache import LRUCache, content_key
+from hl7validator.constraints import load_constraints
+
+logger = logging.getLogger("hl7validator")
+
+# Composite datatypes whose first component is a code of the field's table
+CODED_DATATYPES = frozenset(("CE", "CWE", "CNE", "CF"))
+
+# Findings about table values, as hl7apy words them
+TABLE_FINDING = re.compile(r"\s*Value (.*) not in table (\S+) in element ")
+
+_VERSION = re.compile(r"\d+(\.\d+)+\Z")
+
+# Findings per segment text, kept apart from api.segment_cache
+finding_cache = LRUCache(int(os.getenv("HL7VALIDATOR_SEGMENT_CACHE_SIZE", "4096")))
+
+
+def _edit(values, change):
+    """Apply a site table entry (list of values, or dict with add/remove) to a table."""
+    if isinstance(change, dict):
+        return (frozenset(values or ()) | frozenset(change.get("add", ()))) - frozenset(
+            change.get("remove", ())
+        )
+    return frozenset(change)
+
+
+class SiteTables:
+    """
+    Site table files, reloaded when they change.
+
+    :param paths: JSON files, or directories of *.json files
+    :param check_interval: seconds between checks of the files for changes
+    """
+
+    def __init__(self, paths=(), check_interval=2.0):
+        self.paths = tuple(paths)
+        self.check_interval = check_interval
+        # incremented on every reload, part of the cache keys of the findings
+        self.generation = 0
+        self._signature = None
+        self._entries = []
+        self._indexes = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    @classmethod
+    def from_env(cls):
+        paths = [p.strip() for p in os.getenv("HL7VALIDATOR_TABLES", "").split(",") if p.strip()]
+        interval = float(os.getenv("HL7VALIDATOR_TABLES_CHECK_INTERVAL", "2"))
+        return cls(paths, interval)
+
+    def _files(self):
+        for path in self.paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if name.endswith(".json") and not name.startswith("."):
+                        yield os.path.join(path, name)
+            else:
+                yield path
+
+    def _stat(self):
+        signature = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append((path, None))
+            else:
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def refresh(self, force=False):
+        """Reload the files if one of them changed since the last check."""
+        if not self.paths:
+            return
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            self._checked = now
+            signature = self._stat()
+            if signature == self._signature:
+                return
+            entries = []
+            for path, *stat in signature:
+                if stat == [None]:
+                    logger.error(f"Site table file {path} not found")
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        entries.append(json.load(f))
+                except (OSError, ValueError) as err:
+                    # keep serving the tables loaded last
+                    logger.error(f"Not able to load site tables from {path}: {err}")
+                    return
+            self._entries = entries
+            self._signature = signature
+            self._indexes = {}
+            self.generation += 1
+            logger.info(f"Loaded site tables from {len(entries)} file(s)")
+
+    def index(self, version):
+        """
+        Tables of a version, built once per version and reload.
+        :return: (dict of table ID to the frozenset of its values, frozenset of the
+            IDs of the tables the site overrides)
+        """
+        index = self._indexes.get(version)
+        if index is None:
+            bundled = _bundled(version)
+            overrides = {}
+            for entry in self._entries:
+                for key, value in entry.items():
+                    if _VERSION.match(key):
+                        if key != version:
+                            continue
+                        changes = value.items()
+                    else:
+                        changes = [(key, value)]
+                    for table, change in changes:
+                        overrides[table] = _edit(overrides.get(table, bundled.get(table)), change)
+            tables = dict(bundled, **overrides) if overrides else bundled
+            index = self._indexes[version] = (tables, frozenset(overrides))
+        return index
+
+
+def _bundled(version):
+    try:
+        return load_constraints(version).tables
+    except Exception:
+        return {}
+
+
+def _leaves(node, text, separators, parent, name):
+    """(node, value, parent, name) of the leaf values of an element with a table."""
+    if node.children is None:
+        if node.table is not None:
+            yield node, text, parent, name
+        return
+    if not separators:
+        return
+    values = text.split(separators[0])
+    for index, (child_name, child, _, _) in enumerate(node.children):
+        if index < len(values) and values[index]:
+            yield from _leaves(child, values[index], separators[1:], name, child_name)
+
+
+def check_segment(text, version, encoding_chars, overridden, tables):
+    """
+    Table findings of the ER7 text of a segment.
+    :param overridden: table IDs whose leaf values are checked here rather than by the engines
+    :param tables: dict of table ID to its values
+    :return: list of warning messages
+    """
+    vc = load_constraints(version)
+    text = text.strip()
+    name = text[:3]
+    segment = vc.segment(name)
+    if segment is None:
+        return []
+    enc = encoding_chars
+    if name == "MSH":
+        # MSH-1 is the field separator itself
+        values = [enc["FIELD"]] + text[4:].split(enc["FIELD"])
+    else:
+        values = text[4:].split(enc["FIELD"])
+    separators = (enc["COMPONENT"], enc["SUBCOMPONENT"])
+    findings = []
+    for (field_name, node, _, _), value in zip(segment.children, values):
+        if not value or (name == "MSH" and field_name in ("MSH_1", "MSH_2")):
+            continue
+        for repetition in value.split(enc["REPETITION"]):
+            if not repetition or enc["ESCAPE"] in repetition:
+                continue
+            if node.children is not None and node.datatype in CODED_DATATYPES and node.table:
+                findings += _check_coded(
+                    node, repetition, enc["COMPONENT"], name, field_name, tables
+                )
+            if not overridden:
+                continue
+            for leaf, value, parent, leaf_name in _leaves(
+                node, repetition, separators, name, field_name
+            ):
+                if leaf.table in overridden and value not in tables[leaf.table]:
+                    findings.append(
+                        f"Value {value} not in table {leaf.table} in element {parent}.{leaf_name}"
+                    )
+    return findings
+
+
+def _check_coded(node, text, separator, segment, field_name, tables):
+    values = tables.get(node.table)
+    if not values:
+        # user-defined tables without values
+        return []
+    components = text.split(separator)
+    components += [""] * (6 - len(components))
+    # the identifier when its coding system is empty or the table, the alternate
+    # identifier when its coding system is the table
+    codes = (
+        (components[0], components[2] in ("", node.table)),
+        (components[3], components[5] == node.table),
+    )
+    return [
+        f"Value {code} not in table {node.table} in element {segment}.{field_name}"
+        for code, checked in codes
+        if code and checked and code not in values
+    ]
+
+
+def table_findings(setmsg, version, encoding_chars, site=None, cache=finding_cache):
+    """
+    Table findings of a message, per segment text cached in cache.
+    :param site: SiteTables, defaults to the tables of HL7VALIDATOR_TABLES
+    :param cache: LRUCache, or None to check every segment
+    :return: (list of warning messages, set of the table IDs the site overrides)
+    """
+    site = site_tables if site is None else site
+    site.refresh()
+    tables, overridden = site.index(version)
+    key = (
+        id(site), site.generation, zsegments.registry.generation,
+        tuple(sorted(encoding_chars.items())),
+    )
+    findings = []
+    for seg_text in setmsg.split("\r"):
+        if not seg_text.strip():
+            continue
+        if cache is None:
+            found = check_segment(seg_text, version, encoding_chars, overridden, tables)
+        else:
+            found = cache.get_or_compute(
+                ("tables", version, key, content_key(seg_text)),
+                lambda: check_segment(seg_text, version, encoding_chars, overridden, tables),
+            )
+        findings += [f for f in found if f not in findings]
+    return findings, overridden
+
+
+site_tables = SiteTables.from_env()
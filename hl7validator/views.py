@@ -1,4 +1,5 @@
 from flask import (
+    Response,
     render_template,
     redirect,
     request,
@@ -9,9 +10,23 @@ from flask import (
     g,
 )
 from flask_babel import gettext, get_locale
+import itertools
 import os
-from hl7validator.api import hl7validatorapi, from_hl7_to_df, highlight_message, build_tree_structure
-from hl7validator import app
+from hl7validator.api import is_tolerant
+from hl7validator.budget import BUDGET_EXCEEDED, BudgetExceeded
+from hl7validator.codec import decode_er7, is_er7
+from hl7validator.diagnostics import unauthorized
+from hl7validator.hl7json import (
+    JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+    convert_stream,
+    encoder,
+    to_json,
+)
+from hl7validator.spool import iter_messages
+from hl7validator.message_profiles import MEDIA_TYPES as PROFILE_MEDIA_TYPES
+from hl7validator.webapp import app, validator
 from hl7validator.__version__ import __version__
 
 # Version is now managed centrally in __version__.py and pyproject.toml
@@ -53,14 +68,47 @@ def home(lang=None):
         req = request.form.get("options")
         msg = request.form.get("msg")
         validation_level = request.form.get("validation_level", "tolerant")
+        validation_profile = request.form.get("validation_profile") or None
         if not msg:
             return render_template("hl7validatorhome.html", version=VERSION)
         elif req == "hl7v2":
-            validation = hl7validatorapi(request.form.get("msg"), validation_level=validation_level)
-            print(validation)
-            if validation["hl7version"]:
-                parsed_message, validation = highlight_message(msg, validation)
-                tree_structure, validation = build_tree_structure(msg, validation)
+            try:
+                stages = validator.stages(validation_profile)
+            except ValueError:
+                abort(400)
+            if (
+                app.config["INCREMENTAL_VALIDATION"]
+                and "fields" in stages
+                and is_tolerant(validation_level)
+            ):
+                validation = validator.validate_incremental(msg, validation_level=validation_level)
+            else:
+                validation = validator.validate(
+                    msg,
+                    validation_level=validation_level,
+                    validation_profile=validation_profile,
+                )
+            app.logger.debug(
+                "validation result",
+                extra={
+                    "status": validation["statusCode"],
+                    "hl7version": validation["hl7version"],
+                    "findings": len(validation.get("details") or []),
+                },
+            )
+            if (
+                validation["hl7version"]
+                and "parse" in stages
+                and validation["message"] != BUDGET_EXCEEDED
+            ):
+                try:
+                    parsed_message, validation = validator.highlight(
+                        msg, validation, checks="fields" in stages
+                    )
+                    tree_structure, validation = validator.tree(msg, validation)
+                except BudgetExceeded as err:
+                    # the validation result is shown without the rendered message
+                    validation.setdefault("warnings", []).append(f"{BUDGET_EXCEEDED}: {err}")
             details = sorted(validation["details"], key=lambda d: list(d.values())[0])
             warnings = validation.get("warnings", [])
 
@@ -80,23 +128,109 @@ def home(lang=None):
             )
 
         elif req == "converter":
-            return send_from_directory(
-                os.getcwd(), from_hl7_to_df(request.form.get("msg")), as_attachment=True
-            )
+            try:
+                file = validator.convert(request.form.get("msg"))
+            except BudgetExceeded:
+                abort(422)
+            return send_from_directory(os.getcwd(), file, as_attachment=True)
     else:
         return render_template("hl7validatorhome.html", version=VERSION)
 
 
+def read_api_request():
+    """
+    Message and options of an API request: either a JSON document with a
+    "data" field, or the raw message with an ER7 media type and the options
+    as query parameters.
+    :return: (message, options mapping)
+    """
+    if is_er7(request.mimetype):
+        data = decode_er7(request.get_data(), request.mimetype_params.get("charset"))
+        return data, request.args
+    return request.json["data"], request.json
+
+
 @app.route("/api/hl7/v1/validate/", methods=["POST"])
 def hl7v2validatorapi():
     """
     file: docs/v2.yml
     """
 
-    data = request.json["data"]
-    validation_level = request.json.get("validation_level", "tolerant")
+    data, options = read_api_request()
+    validation_level = options.get("validation_level", "tolerant")
+    validation_profile = options.get("validation_profile")
+    profile = options.get("profile")
+    if not data:
+        abort(404)
+    try:
+        validator.stages(validation_profile)
+        profile = validator.profiles.get(profile)
+    except ValueError as err:
+        return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+
+    if validation_profile is None and profile is None:
+        # feed traffic: full validation of the configured sample only, if any
+        return jsonify(validator.validate_sampled(data, validation_level=validation_level))
+    return jsonify(
+        validator.validate(
+            data,
+            validation_level=validation_level,
+            validation_profile=validation_profile,
+            profile=profile,
+        )
+    )
+
+
+@app.route("/api/hl7/v1/profiles/", methods=["POST"])
+def upload_message_profile():
+    """
+    file: docs/profiles.yml
+    """
+    # profiles change what every later validation checks: uploads are an admin operation
+    if not app.config["ADMIN_TOKEN"]:
+        return jsonify({
+            "statusCode": "Failed",
+            "message": "Profile uploads are disabled: HL7VALIDATOR_ADMIN_TOKEN is not set",
+        }), 403
+    denied = unauthorized(app.config["ADMIN_TOKEN"])
+    if denied:
+        return denied
+    if not validator.profiles.directory:
+        # a profile kept in this worker's memory would be unknown to the other workers
+        return jsonify({
+            "statusCode": "Failed",
+            "message": "Profile uploads need HL7VALIDATOR_PROFILES_DIR, shared by all workers",
+        }), 403
+    content = request.get_data(as_text=True)
+    if not content.strip():
+        abort(404)
+    try:
+        profile = validator.profiles.register(content, PROFILE_MEDIA_TYPES.get(request.mimetype))
+    except ValueError as err:
+        return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+    return jsonify(profile.describe()), 201
+
 
-    return jsonify(hl7validatorapi(data, validation_level=validation_level))
+@app.route("/api/hl7/v1/conformance/", methods=["POST"])
+def conformance_matrix():
+    """
+    file: docs/conformance.yml
+    """
+    data, options = read_api_request()
+    if not data:
+        abort(404)
+    try:
+        return jsonify(
+            validator.conformance_matrix(
+                data,
+                versions=options.get("versions"),
+                validation_level=options.get("validation_level", "tolerant"),
+            )
+        )
+    except ValueError as err:
+        return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+    except BudgetExceeded as err:
+        return jsonify({"statusCode": "Failed", "message": f"{BUDGET_EXCEEDED}: {err}"}), 422
 
 
 @app.route("/api/hl7/v1/convert/", methods=["POST"])
@@ -104,10 +238,52 @@ def from_hl7_to_df_converter():
     """
     file: docs/converter.yml
     """
-    data = request.json["data"]
+    data, _ = read_api_request()
     try:
         return send_from_directory(
-            os.getcwd(), from_hl7_to_df(data), as_attachment=True
+            os.getcwd(), validator.convert(data), as_attachment=True
         )
+    except BudgetExceeded as err:
+        return jsonify({"statusCode": "Failed", "message": f"{BUDGET_EXCEEDED}: {err}"}), 422
     except FileNotFoundError:
         abort(404)
+
+
+@app.route("/api/hl7/v1/convert/json", methods=["POST"])
+def hl7_to_json_converter():
+    """
+    file: docs/convert_json.yml
+    """
+    data, options = read_api_request()
+    if not data:
+        abort(404)
+    fmt = options.get("format")
+    if fmt is None:
+        best = request.accept_mimetypes.best_match([JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE])
+        fmt = "msgpack" if best == MSGPACK_MEDIA_TYPE else "json"
+    try:
+        encode = encoder(fmt)
+    except ValueError as err:
+        return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+    messages = iter_messages([data])
+    first = next(messages, None)
+    if first is None:
+        abort(404)
+    second = next(messages, None)
+    if second is None:
+        # a single message: one document
+        reason = validator.limits.check(first)
+        if reason:
+            return jsonify({"statusCode": "Failed", "message": f"{BUDGET_EXCEEDED}: {reason}"}), 422
+        try:
+            document = to_json(first)
+        except ValueError as err:
+            return jsonify({"statusCode": "Failed", "message": str(err)}), 400
+        return Response(
+            encode(document), mimetype=MSGPACK_MEDIA_TYPE if fmt == "msgpack" else JSON_MEDIA_TYPE
+        )
+    # a batch: one document per message, sent as each is converted
+    documents = convert_stream(itertools.chain([first, second], messages), fmt, validator.limits)
+    return Response(
+        documents, mimetype=MSGPACK_MEDIA_TYPE if fmt == "msgpack" else NDJSON_MEDIA_TYPE
+    )
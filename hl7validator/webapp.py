@@ -0,0 +1,146 @@
+"""
+Flask web application: the web form, the HTTP API and its Swagger docs, as
+thin adapters over the validation core.
+"""
+
+import os
+from flask import Flask, request, session
+from flask.json.provider import DefaultJSONProvider
+from flask_babel import Babel
+from flasgger import Swagger
+
+# Import version
+from hl7validator.__version__ import __version__
+from hl7validator import codec, compression, diagnostics, health, logs, ratelimit
+from hl7validator.budget import Limits
+from hl7validator.core import Validator
+
+# Before the first use of app.logger, so Flask does not add its own stderr handler
+logs.configure_logging()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Request and response JSON through hl7validator.codec (orjson when installed)."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return codec.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            codec.dumps(obj, default=self.default), mimetype=self.mimetype
+        )
+
+
+# Named after the package so templates, static files and the "hl7validator" logger stay put
+app = Flask("hl7validator")
+app.json = JSONProvider(app)
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'hl7-validator-secret-key-change-in-production')
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size
+app.config['BABEL_TRANSLATION_DIRECTORIES'] = 'translations'
+app.config['BABEL_DEFAULT_LOCALE'] = 'en'
+app.config['LANGUAGES'] = {
+    'en': 'English',
+    'pt': 'Português'
+}
+app.config['VERSION'] = __version__
+# Default validation profile (header, parse-only, structure or full), can be overridden per request
+app.config['VALIDATION_PROFILE'] = os.getenv('HL7VALIDATOR_VALIDATION_PROFILE', 'full')
+# Engine of the per-segment validation: "fast" (compiled constraint tables) or "hl7apy"
+app.config['VALIDATION_ENGINE'] = os.getenv('HL7VALIDATOR_VALIDATION_ENGINE', 'fast')
+# HL7 versions loaded and compiled at startup instead of on their first message
+app.config['PRELOAD_VERSIONS'] = [v.strip() for v in os.getenv('HL7VALIDATOR_PRELOAD_VERSIONS', '').split(',') if v.strip()]
+# Web form re-validates only the segments that changed since the last submission
+app.config['INCREMENTAL_VALIDATION'] = os.getenv('HL7VALIDATOR_INCREMENTAL_VALIDATION', 'true').lower() == 'true'
+# Admission control: "rate/burst" per client (0 disables), optional SQLite file shared
+# by all workers, JSON file with per API key / IP overrides and per-pool concurrency
+# (in-flight requests per worker: the pools are not shared by the workers)
+app.config['RATELIMIT_DEFAULT'] = os.getenv('HL7VALIDATOR_RATE_LIMIT', '0')
+app.config['RATELIMIT_STORAGE'] = os.getenv('HL7VALIDATOR_RATE_LIMIT_STORAGE')
+app.config['RATELIMIT_OVERRIDES'] = os.getenv('HL7VALIDATOR_RATE_LIMIT_OVERRIDES')
+app.config['RATELIMIT_INTERACTIVE_CONCURRENCY'] = int(os.getenv('HL7VALIDATOR_INTERACTIVE_CONCURRENCY', '0'))
+app.config['RATELIMIT_BULK_CONCURRENCY'] = int(os.getenv('HL7VALIDATOR_BULK_CONCURRENCY', '0'))
+# Messages with more segments than this have their segments validated in parallel (0 disables)
+app.config['PARALLEL_THRESHOLD'] = int(os.getenv('HL7VALIDATOR_PARALLEL_THRESHOLD', '1000'))
+# gzip/brotli compression of the responses of compressible types from this size (bytes)
+app.config['COMPRESSION'] = os.getenv('HL7VALIDATOR_COMPRESSION', 'true').lower() == 'true'
+app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('HL7VALIDATOR_COMPRESSION_MIN_SIZE', '1024'))
+# Bearer token of the /admin/memory diagnostics endpoints, not registered without it, and of
+# message profile uploads, refused without it
+app.config['ADMIN_TOKEN'] = os.getenv('HL7VALIDATOR_ADMIN_TOKEN')
+app.debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+
+# Shared by all request threads; per-request level and profile are passed on each call
+validator = Validator(
+    validation_profile=app.config['VALIDATION_PROFILE'],
+    engine=app.config['VALIDATION_ENGINE'],
+    versions=app.config['PRELOAD_VERSIONS'],
+    # size limits and a 30 s default time budget, enforced in killable worker processes
+    limits=Limits.from_env(time_budget='30'),
+    parallel_threshold=app.config['PARALLEL_THRESHOLD'],
+)
+
+def get_locale():
+    # 1. Check if language is manually selected (stored in session)
+    if 'language' in session:
+        return session['language']
+
+    # 2. Check if language is specified in URL (handled in views)
+    # This will be set by the route handlers
+
+    # 3. Try to match browser's accept languages
+    return request.accept_languages.best_match(app.config['LANGUAGES'].keys()) or 'en'
+
+babel = Babel(app, locale_selector=get_locale)
+
+limiter = ratelimit.init_app(
+    app,
+    ratelimit.RateLimiter.from_config(app.config),
+    collectors=[
+        collector.metrics for collector in (validator.sampling, validator.duplicates) if collector
+    ],
+)
+
+compression.init_app(app)
+
+readiness = health.init_app(
+    app,
+    health.Readiness(
+        versions=validator.versions,
+        pools={"validation": validator.workers.stats} if validator.workers else {},
+        run=validator._run,
+    ),
+)
+
+diagnostics.init_app(app, pools={"validation": validator.workers} if validator.workers else {})
+
+swagger = Swagger(
+    app,
+    template={
+        "swagger": "2.0",
+        "info": {
+            "title": "HL7 Validator",
+            "description": "HL7 Validation API",
+            "contact": {
+                "responsibleOrganization": "HL7PT",
+                "responsibleDeveloper": "Joao Almeida",
+                "email": "geral@hl7.pt",
+                "url": "http://hl7.pt",
+            },
+            "termsOfService": "http://me.com/terms",
+            "version": __version__,
+        },
+        "host": "version2.hl7.pt",  # overrides localhost:500
+        "basePath": "",  # base bash for blueprint registration
+        "schemes": ["https"],
+    },
+)
+
+from hl7validator import views
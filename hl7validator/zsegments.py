@@ -0,0 +1,184 @@
+"""
+Site definitions of Z-segments and other custom segments.
+
+HL7 lets sites add segments of their own (Z-segments), which hl7apy knows
+nothing about: they were neither validated nor described when rendered. A
+site declares their layout in JSON files (HL7VALIDATOR_SEGMENTS, files or
+directories, separated by commas)::
+
+    {
+        "ZPI": {
+            "long_name": "Patient insurance extension",
+            "versions": ["2.5", "2.5.1"],
+            "fields": [
+                {"name": "Set ID", "datatype": "SI", "required": true},
+                {"name": "Plan", "datatype": "CWE", "repeats": true, "table": "HL70072"},
+                {"name": "Effective date", "datatype": "DT", "max_length": 8}
+            ]
+        }
+    }
+
+Fields are listed in order. A field has a name and a datatype of the HL7
+version, ST by default. Optional keys are ``required``, ``repeats`` (or
+``max`` repetitions), ``max_length`` and ``table``. ``long_name`` describes
+the segment in the highlighted and tree views. ``versions`` limits a
+definition to some HL7 versions. Only segments the HL7 version does not
+define itself can be declared.
+
+Each definition is turned into an hl7apy style reference once per version,
+built from the datatype structures of that version. The constraint tables
+compile it like any HL7 segment (see ``constraints.VersionConstraints.segment``),
+so custom segments are validated by the fast engine, and the renderers parse
+them with their reference instead of going through their error paths.
+"""
+
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+
+from hl7apy import load_library
+
+logger = logging.getLogger("hl7validator")
+
+_SEGMENT_ID = re.compile(r"[A-Z][A-Z0-9]{2}\Z")
+
+# Generations are unique across registries, so that cache keys never collide
+_generations = itertools.count(1)
+
+
+def _long_name(name):
+    return re.sub(r"[^A-Z0-9]+", "_", name.upper()).strip("_")
+
+
+def _check_definition(name, definition):
+    """:raises ValueError: for malformed definitions"""
+    if not _SEGMENT_ID.match(name):
+        raise ValueError(f"Invalid segment ID '{name}'")
+    if not isinstance(definition, dict) or not isinstance(definition.get("fields"), list):
+        raise ValueError(f"Segment {name} needs a list of fields")
+    if not isinstance(definition.get("long_name", ""), str):
+        raise ValueError(f"Invalid long_name for segment {name}")
+    for position, field in enumerate(definition["fields"], 1):
+        if not isinstance(field, dict) or not field.get("name"):
+            raise ValueError(f"Field {name}-{position} needs a name")
+        for key in ("max", "max_length"):
+            if field.get(key) is not None and not isinstance(field[key], int):
+                raise ValueError(f"Invalid {key} for field {name}-{position}")
+
+
+class SegmentRegistry:
+    """
+    Custom segment definitions, with their references per HL7 version.
+
+    :param definitions: dict of segment ID to definition
+    """
+
+    def __init__(self, definitions=None):
+        self._definitions = {}
+        self._references = {}
+        self._lock = threading.Lock()
+        # changes with the definitions, part of the cache keys of segment results
+        self.generation = 0
+        if definitions:
+            self.register(definitions)
+
+    @classmethod
+    def from_env(cls):
+        registry = cls()
+        for path in os.getenv("HL7VALIDATOR_SEGMENTS", "").split(","):
+            path = path.strip()
+            if path:
+                registry.load(path)
+        return registry
+
+    def load(self, path):
+        """Register the definitions of a JSON file, or of the *.json files of a directory."""
+        if os.path.isdir(path):
+            files = [
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(".json") and not name.startswith(".")
+            ]
+        else:
+            files = [path]
+        for file in files:
+            try:
+                with open(file, encoding="utf-8") as f:
+                    self.register(json.load(f))
+            except (OSError, ValueError) as err:
+                logger.error(f"Not able to load segment definitions from {file}: {err}")
+
+    def register(self, definitions):
+        """
+        Add or replace segment definitions.
+        :raises ValueError: for malformed definitions; none of them is registered then
+        """
+        for name, definition in definitions.items():
+            _check_definition(name, definition)
+        with self._lock:
+            self._definitions.update(definitions)
+            self._references = {}
+            self.generation = next(_generations)
+
+    def __contains__(self, name):
+        return name in self._definitions
+
+    def names(self):
+        return sorted(self._definitions)
+
+    def long_name(self, name):
+        """Description of a custom segment, None when it has none or is not defined."""
+        return self._definitions.get(name, {}).get("long_name") or None
+
+    def reference(self, name, version):
+        """
+        hl7apy style reference of a custom segment in a version, built once.
+        :return: the reference, or None when the segment is not defined for the version
+        """
+        if name not in self._definitions:
+            return None
+        key = (name, version)
+        try:
+            return self._references[key]
+        except KeyError:
+            pass
+        reference = self._build(name, self._definitions[name], version)
+        self._references[key] = reference
+        return reference
+
+    def _build(self, name, definition, version):
+        if definition.get("versions") and version not in definition["versions"]:
+            return None
+        lib = load_library(version)
+        if name in lib.SEGMENTS:
+            logger.warning(f"Segment {name} is defined by HL7 v{version}, ignoring its site definition")
+            return None
+        fields = []
+        for position, field in enumerate(definition["fields"], 1):
+            datatype = field.get("datatype") or "ST"
+            if datatype in lib.DATATYPES_STRUCTS:
+                kind, components = "sequence", lib.DATATYPES_STRUCTS[datatype]
+            elif datatype in lib.BASE_DATATYPES:
+                kind, components = "leaf", None
+            else:
+                logger.error(
+                    f"Unknown datatype {datatype} of field {name}-{position} in HL7 v{version}, "
+                    f"ignoring the definition of {name}"
+                )
+                return None
+            maximum = -1 if field.get("repeats") else field.get("max", 1)
+            fields.append((
+                f"{name}_{position}",
+                (
+                    kind, components, datatype, _long_name(field["name"]),
+                    field.get("table"), field.get("max_length") or -1,
+                ),
+                (1 if field.get("required") else 0, maximum),
+                "FIE",
+            ))
+        return ("sequence", tuple(fields))
+
+
+registry = SegmentRegistry.from_env()
@@ -0,0 +1,125 @@
+import asyncio
+import gzip
+import json
+import unittest
+from unittest import mock
+
+from hl7validator import asgi
+from hl7validator.duplicates import DuplicateDetector
+from hl7validator.pool import ValidationPool
+
+
+MESSAGE = "MSH|^~\\&|KIS||CommServer||200811111017||QRY^A19|ertyusdfg|P|2.2|\rQRD|200811111016|R|I|Q1004|||1^RD|10000437363|DEM|18rg||"
+
+
+def call(method, path, body=b"", headers=None):
+    """Run the ASGI app for a single request and collect the response."""
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": headers or [(b"content-type", b"application/json")],
+    }
+    events = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return events.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    start = sent[0]
+    return start["status"], dict(start["headers"]), b"".join(m.get("body", b"") for m in sent[1:])
+
+
+class TestASGI(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.original_pool = asgi.pool
+        asgi.pool = ValidationPool(max_workers=1, max_queue=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        asgi.pool.shutdown()
+        asgi.pool = cls.original_pool
+
+    def test_validate(self):
+        status, headers, body = call(
+            "POST", asgi.VALIDATE_PATH, json.dumps({"data": MESSAGE}).encode()
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["statusCode"], "Success")
+
+    def test_compressed_response(self):
+        with mock.patch.dict(asgi.flask_app.config, {"COMPRESSION_MIN_SIZE": 0}):
+            status, headers, body = call(
+                "POST", asgi.VALIDATE_PATH, json.dumps({"data": MESSAGE}).encode(),
+                headers=[(b"content-type", b"application/json"), (b"accept-encoding", b"gzip")],
+            )
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-encoding"], b"gzip")
+        self.assertEqual(int(headers[b"content-length"]), len(body))
+        self.assertEqual(json.loads(gzip.decompress(body))["statusCode"], "Success")
+
+    def test_duplicates(self):
+        body = json.dumps({"data": MESSAGE}).encode()
+        with mock.patch.object(
+            asgi.validator, "duplicates", DuplicateDetector(window=60, capacity=100)
+        ):
+            first = json.loads(call("POST", asgi.VALIDATE_PATH, body)[2])
+            again = json.loads(call("POST", asgi.VALIDATE_PATH, body)[2])
+        self.assertFalse(any("Duplicate" in d["message"] for d in first["details"]))
+        self.assertIn("Duplicate of an earlier message", again["details"][-1]["message"])
+
+    def test_health_endpoints(self):
+        status, _, body = call("GET", "/healthz")
+        self.assertEqual((status, json.loads(body)), (200, {"status": "ok"}))
+        status, _, body = call("GET", "/readyz")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["pools"]["asgi"]["workers"], 1)
+
+    def test_validator_runs_on_the_pool_processes(self):
+        self.assertIs(asgi.validator.workers, self.original_pool.workers)
+        self.assertNotIn("validation", asgi.readiness.pools)
+        self.assertNotIn(
+            "validation", asgi.flask_app.extensions.get("hl7validator.diagnostics", {})
+        )
+
+    def test_validate_raw_er7(self):
+        status, _, body = call(
+            "POST", asgi.VALIDATE_PATH, MESSAGE.encode("ascii"),
+            headers=[(b"content-type", b"x-application/hl7-v2+er7")],
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["statusCode"], "Success")
+
+    def test_convert(self):
+        status, headers, body = call(
+            "POST", asgi.CONVERT_PATH, json.dumps({"data": MESSAGE}).encode()
+        )
+        self.assertEqual(status, 200)
+        self.assertIn(b"attachment; filename=ertyusdfg.csv", headers[b"content-disposition"])
+        self.assertIn(b"MSH_10", body)
+
+    def test_bad_request(self):
+        status, _, _ = call("POST", asgi.VALIDATE_PATH, b"not json")
+        self.assertEqual(status, 400)
+
+    def test_saturated_pool_sheds_load(self):
+        asgi.pool._pending = asgi.pool.max_workers + asgi.pool.max_queue
+        try:
+            status, headers, _ = call(
+                "POST", asgi.VALIDATE_PATH, json.dumps({"data": MESSAGE}).encode()
+            )
+        finally:
+            asgi.pool._pending = 0
+        self.assertEqual(status, 503)
+        self.assertEqual(headers[b"retry-after"], asgi.RETRY_AFTER.encode())
+
+    def test_other_routes_use_flask(self):
+        status, headers, body = call("GET", "/docs", headers=[])
+        self.assertEqual(status, 302)
+        self.assertEqual(headers[b"location"], b"/apidocs")
@@ -0,0 +1,159 @@
+import random
+import time
+import unittest
+
+from hl7validator.budget import BUDGET_EXCEEDED, BudgetExceeded, Limits, budget_result
+from hl7validator.constraints import compiled_versions
+from hl7validator.core import Validator, warm_up
+from hl7validator.pool import JobTimeout, WorkerPool
+
+
+HEADER = "MSH|^~\\&|A|B|C|D|20200101||ADT^A01^ADT_A01|1|P|2.5\rEVN|A01|20200101\r"
+PID = "PID|1||123^^^X||DOE^JOHN||19700101|M\r"
+PV1 = "PV1|1|I|2000^2012^01\r"
+
+
+def adversarial_corpus(seed=0):
+    """Pathological messages: huge counts, long fields, deep nesting and noise."""
+    rng = random.Random(seed)
+    corpus = {
+        "many segments": HEADER + PID + PV1 * 20000,
+        "long field": HEADER + "PID|1||" + "9" * 2_000_000 + "||DOE\r",
+        "many repetitions": HEADER + "PID|1||" + "~".join(["1^^^X"] * 5000) + "\r",
+        "many fields": HEADER + "PID" + "|" * 200000 + "\r",
+        "deep components": HEADER + "PID|1||" + "^&" * 100000 + "\r",
+        "separator noise": HEADER + "".join(rng.choice("|^~\\&\r") for _ in range(50000)),
+        "binary noise": HEADER + "".join(chr(rng.randrange(1, 0x2FF)) for _ in range(50000)),
+        "no header": "PID|" * 100000,
+    }
+    base = HEADER + PID + PV1
+    for i in range(10):
+        chars = list(base)
+        for _ in range(rng.randrange(1, 50)):
+            position = rng.randrange(len(chars))
+            chars[position:position] = rng.choice("|^~\\&\r") * rng.randrange(1, 2000)
+        corpus[f"mutation {i}"] = "".join(chars)
+    return corpus
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class TestLimits(unittest.TestCase):
+    def setUp(self):
+        self.limits = Limits(max_segments=100, max_field_length=1000, max_repetitions=50)
+
+    def test_within_limits(self):
+        self.assertIsNone(self.limits.check(HEADER + PID + PV1))
+        self.assertIsNone(Limits().check(HEADER + PV1 * 10000))
+
+    def test_exceeded(self):
+        self.assertIn("segments", self.limits.check(HEADER + PV1 * 200))
+        self.assertIn("characters", self.limits.check(HEADER + "PID|1||" + "9" * 2000))
+        self.assertIn("repetitions", self.limits.check(HEADER + "PID|1||" + "1~" * 60))
+
+    def test_partial_result(self):
+        result = budget_result(HEADER + PV1 * 200, "too big")
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertEqual(result["message"], BUDGET_EXCEEDED)
+        self.assertEqual(result["hl7version"], "2.5")
+        self.assertIn({"level": "Error", "message": "Budget exceeded: too big"}, result["details"])
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_overrun_job_is_killed(self):
+        workers = WorkerPool(1)
+        self.addCleanup(workers.shutdown)
+        self.assertEqual(workers.run(5, _sleep, 0), 0)
+        started = time.monotonic()
+        with self.assertRaises(JobTimeout):
+            workers.run(0.2, _sleep, 30)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(workers.killed, 1)
+        # the worker is replaced for the next job
+        self.assertEqual(workers.run(5, _sleep, 0), 0)
+
+    def test_exceptions_are_reraised(self):
+        workers = WorkerPool(1)
+        self.addCleanup(workers.shutdown)
+        with self.assertRaises(TypeError):
+            workers.run(5, _sleep, "not a number")
+
+    def test_processes_start_warm(self):
+        workers = WorkerPool(2, initializer=warm_up, initargs=(["2.6"],))
+        self.addCleanup(workers.shutdown)
+        workers.start()
+        self.assertEqual(workers.stats()["busy"], 0)
+        self.assertIn("2.6", workers.run(30, compiled_versions))
+
+
+class TestBudgets(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.time_budget = 3
+        cls.validator = Validator(
+            limits=Limits(
+                max_segments=5000,
+                max_field_length=100000,
+                max_repetitions=1000,
+                time_budget=cls.time_budget,
+            ),
+            workers=2,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.validator.close()
+
+    def test_adversarial_corpus_is_bounded(self):
+        for name, msg in adversarial_corpus().items():
+            started = time.monotonic()
+            result = self.validator.validate(msg)
+            elapsed = time.monotonic() - started
+            # spawning a replacement worker is not part of the budget
+            self.assertLess(elapsed, self.time_budget + 5, name)
+            self.assertIn(result["statusCode"], ("Success", "Failed"), name)
+
+    def test_time_budget_bounds_unlimited_sizes(self):
+        validator = Validator(limits=Limits(time_budget=1), workers=1)
+        self.addCleanup(validator.close)
+        for name, msg in adversarial_corpus(seed=1).items():
+            started = time.monotonic()
+            result = validator.validate(msg)
+            self.assertLess(time.monotonic() - started, 1 + 5, name)
+            self.assertIn(result["statusCode"], ("Success", "Failed"), name)
+
+    def test_size_limits_skip_validation(self):
+        result = self.validator.validate(HEADER + PV1 * 6000)
+        self.assertEqual(result["message"], BUDGET_EXCEEDED)
+        with self.assertRaises(BudgetExceeded):
+            self.validator.convert(HEADER + PV1 * 6000)
+
+    def test_time_budget(self):
+        validator = Validator(limits=Limits(time_budget=0.001), workers=1)
+        self.addCleanup(validator.close)
+        result = validator.validate(HEADER + PID + PV1)
+        self.assertEqual(result["message"], BUDGET_EXCEEDED)
+        self.assertIn("did not finish", result["details"][-1]["message"])
+
+    def test_valid_message_in_worker(self):
+        result = self.validator.validate(HEADER + PID + PV1)
+        self.assertEqual(result["statusCode"], "Success")
+
+    def test_rendering_in_worker(self):
+        msg = HEADER + PID + PV1
+        html, validation = self.validator.highlight(msg, self.validator.validate(msg))
+        self.assertIn("PID", html)
+        tree, _ = self.validator.tree(msg, validation)
+        self.assertIn("PV1", tree)
+
+        validator = Validator(limits=Limits(time_budget=0.001), workers=1)
+        self.addCleanup(validator.close)
+        with self.assertRaises(BudgetExceeded):
+            validator.highlight(msg, validation)
+
+
+if __name__ == "__main__":
+    unittest.main()
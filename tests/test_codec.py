@@ -0,0 +1,76 @@
+import json
+import os
+import unittest
+
+from hl7validator import app, codec
+
+
+MESSAGE = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4||||||{charset}\r"
+    "EVN|A60|200906011158\r"
+    "PID||111987|111987||Gonçalves^João^||19810902|F\r"
+)
+
+
+class TestER7Decoding(unittest.TestCase):
+    def test_charset_from_msh_18(self):
+        msg = MESSAGE.format(charset="8859/1")
+        self.assertEqual(codec.declared_charset(msg.encode("latin-1")), "latin-1")
+        self.assertEqual(codec.decode_er7(msg.encode("latin-1")), msg)
+
+    def test_charset_from_header_and_bom(self):
+        msg = MESSAGE.format(charset="UNICODE UTF-8")
+        self.assertEqual(codec.decode_er7(msg.encode("utf-8")), msg)
+        self.assertEqual(codec.decode_er7(msg.encode("latin-1"), "latin-1"), msg)
+        self.assertEqual(codec.decode_er7(msg.encode("utf-16")), msg)
+
+    def test_undeclared_charset(self):
+        msg = MESSAGE.format(charset="")
+        self.assertEqual(codec.declared_charset(msg.encode("utf-8")), None)
+        self.assertEqual(codec.decode_er7(msg.encode("utf-8")), msg)
+        # bytes that are not valid UTF-8 still decode, so the validator can report them
+        self.assertEqual(codec.decode_er7(msg.encode("latin-1")), msg)
+
+    def test_parse_content_type(self):
+        self.assertEqual(
+            codec.parse_content_type('X-Application/HL7-V2+ER7; charset="ISO-8859-1"'),
+            ("x-application/hl7-v2+er7", {"charset": "ISO-8859-1"}),
+        )
+
+    def test_json_roundtrip(self):
+        payload = {"data": MESSAGE, "details": [{"level": "Error", "message": "ç"}]}
+        self.assertEqual(codec.loads(codec.dumps(payload)), payload)
+        self.assertEqual(json.loads(codec.dumps(payload)), payload)
+
+
+class TestRawBodies(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_validate_raw_body(self):
+        msg = MESSAGE.format(charset="8859/1")
+        raw = self.client.post(
+            "/api/hl7/v1/validate/?validation_profile=structure",
+            data=msg.encode("latin-1"),
+            content_type="x-application/hl7-v2+er7",
+        )
+        as_json = self.client.post(
+            "/api/hl7/v1/validate/",
+            json={"data": msg, "validation_profile": "structure"},
+        )
+        self.assertEqual(raw.status_code, 200)
+        self.assertEqual(raw.get_json(), as_json.get_json())
+
+    def test_convert_raw_body(self):
+        response = self.client.post(
+            "/api/hl7/v1/convert/",
+            data=MESSAGE.format(charset="UNICODE UTF-8").encode("utf-8"),
+            content_type="x-application/hl7-v2+er7; charset=utf-8",
+        )
+        self.addCleanup(os.remove, "AWONG-0025.csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Gonçalves", response.get_data(as_text=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
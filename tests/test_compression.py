@@ -0,0 +1,120 @@
+import gzip
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator import app, compression
+from hl7validator.compression import StaticAssets, negotiate
+
+
+MESSAGE = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy||19810902|F\r"
+    "PV1|1|I\r"
+)
+
+GZIP = {"Accept-Encoding": "gzip, deflate"}
+
+
+class TestNegotiation(unittest.TestCase):
+    def test_accept_encoding(self):
+        both = ("br", "gzip")
+        self.assertEqual(negotiate("gzip, deflate, br", both), "br")
+        self.assertEqual(negotiate("br;q=0.5, gzip", both), "gzip")
+        self.assertEqual(negotiate("br;q=0, *", both), "gzip")
+        self.assertEqual(negotiate("*;q=0.1", ("gzip",)), "gzip")
+        self.assertIsNone(negotiate("identity", both))
+        self.assertIsNone(negotiate("gzip;q=0", both))
+        self.assertIsNone(negotiate(None, both))
+        self.assertIsNone(negotiate("gzip", ()))
+
+
+class TestCompressedResponses(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_web_form_is_compressed(self):
+        data = {"msg": MESSAGE, "options": "hl7v2"}
+        plain = self.client.post("/", data=data)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+        response = self.client.post("/", data=data, headers=GZIP)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        # the page differs by a few characters between requests
+        self.assertEqual(len(gzip.decompress(response.data)), len(plain.data))
+        self.assertLess(len(response.data), len(plain.data) / 2)
+
+        # small responses, and images, are sent as they are
+        with mock.patch.dict(app.config, {"COMPRESSION_MIN_SIZE": len(plain.data) + 1}):
+            self.assertNotIn("Content-Encoding", self.client.post("/", data=data, headers=GZIP).headers)
+        with mock.patch.dict(app.config, {"COMPRESSION": False}):
+            self.assertNotIn("Content-Encoding", self.client.post("/", data=data, headers=GZIP).headers)
+
+    def test_csv_export_is_compressed(self):
+        # the export is written to the working directory, named after MSH-10
+        self.addCleanup(lambda: os.path.exists("1.csv") and os.remove("1.csv"))
+        with mock.patch.dict(app.config, {"COMPRESSION_MIN_SIZE": 0}):
+            response = self.client.post(
+                "/api/hl7/v1/convert/", json={"data": MESSAGE}, headers=GZIP
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"PID", gzip.decompress(response.data))
+
+    def test_static_files_have_hashed_names(self):
+        page = self.client.get("/en").data.decode()
+        url = re.search(r'href="(/static/mystyle\.[0-9a-f]{10}\.css)"', page).group(1)
+        with open(os.path.join(app.static_folder, "mystyle.css"), "rb") as f:
+            content = f.read()
+
+        response = self.client.get(url, headers=GZIP)
+        self.assertEqual(response.headers["Cache-Control"], compression.IMMUTABLE)
+        self.assertEqual(response.headers["Content-Type"], "text/css; charset=utf-8")
+        self.assertEqual(gzip.decompress(response.data), content)
+        response.close()
+        image = re.search(r'src="(/static/hl7pt\.[0-9a-f]{10}\.png)"', page).group(1)
+        response = self.client.get(image, headers=GZIP)
+        self.assertEqual(response.headers["Cache-Control"], compression.IMMUTABLE)
+        self.assertNotIn("Content-Encoding", response.headers)
+        response.close()
+        # the plain names are still served
+        response = self.client.get("/static/mystyle.css")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get("Cache-Control"), compression.IMMUTABLE)
+        response.close()
+
+    def test_precompressed_copies(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "site.css"), "w") as f:
+            f.write("body { margin: 0; }\n" * 200)
+        with open(os.path.join(directory, "logo.png"), "wb") as f:
+            f.write(b"\x89PNG" + os.urandom(100))
+        assets = StaticAssets(directory)
+        hashed = assets.names["site.css"]
+        self.assertEqual(assets.files[hashed], "site.css")
+        self.assertEqual(assets.url("site.css"), "/static/" + hashed)
+        self.assertEqual(assets.precompressed(hashed), ())
+
+        written = assets.build()
+        self.assertEqual(written, [os.path.join(directory, hashed + ".gz")])
+        self.assertEqual(assets.precompressed(hashed), ("gzip",))
+        self.assertEqual(assets.build(), [])
+
+        # a new content gets a new name, and the old copies are removed
+        with open(os.path.join(directory, "site.css"), "a") as f:
+            f.write("p { color: red; }\n")
+        assets.scan()
+        self.assertNotEqual(assets.names["site.css"], hashed)
+        assets.build()
+        self.assertEqual(
+            sorted(os.listdir(directory)),
+            sorted(["site.css", "logo.png", assets.names["site.css"] + ".gz"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
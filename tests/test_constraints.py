@@ -0,0 +1,98 @@
+import glob
+import os
+import unittest
+
+from hl7validator.api import hl7validatorapi, segment_cache
+from hl7validator.constraints import (
+    Unsupported,
+    check_segment,
+    hl7apy_segment,
+    load_constraints,
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "corpus")
+
+ENCODING_CHARS = {
+    "FIELD": "|",
+    "COMPONENT": "^",
+    "SUBCOMPONENT": "&",
+    "REPETITION": "~",
+    "ESCAPE": "\\",
+    "SEGMENT": "\r",
+    "GROUP": "\r",
+}
+
+MESSAGES = [
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4|||\r"
+    "EVN|A60|200906011158|||I000007^INTERFACE^ADT^^^^^^M^^^^^LAMH\r"
+    "PID||111987|111987||Wong^Amy^||19810902|X||2028-9|999 NINE AVE^^LONG BEACH^CA^90745^US^H||(562)555-0025^^M||ENG|M|BUD\r"
+    "PV1||O|ZBC||||7^SIMPSON^MARGE^|18^WIGGUM^RALPH^|2^MOUSE^M^|MED\r",
+    "MSH|^~\\&|ADT1|GOOD HEALTH HOSPITAL|GHH LAB, INC.|GOOD HEALTH HOSPITAL|198808181126|SECURITY|ADT^A01^ADT_A01|MSG00001|P|2.5|\r"
+    "EVN|A01|200708181123||\r"
+    "PID|1||PATID1234^5^M11^ADT1^MR^GOOD HEALTH HOSPITAL&1.2.3&ISO&X~123456789^^^USSSA^SS||EVERYMAN^ADAM^A^III||19610615|M^F||C\r"
+    "ZAL|1|A^B|C\r"
+    "NK1|1|NUCLEAR^NELDA^W|SPO^SPOUSE||||NK^NEXT OF KIN\r"
+    "PV1|1|I|2000^2012^01||||004777^ATTEND^AARON^A|||SUR||||ADM|A0|\r",
+]
+
+
+def _findings(result):
+    return sorted((d["level"], d["message"]) for d in result["details"] or [])
+
+
+class TestConstraintTables(unittest.TestCase):
+    def test_compiled_segment(self):
+        pid = load_constraints("2.5").segments["PID"]
+        self.assertEqual(pid.by_name["PID_8"].table, "HL70001")
+        self.assertEqual(pid.by_name["PID_5"].datatype, "XPN")
+        self.assertIn("XPN_1", pid.by_name["PID_5"].by_name)
+        self.assertIn("M", load_constraints("2.5").tables["HL70001"])
+
+    def test_check_segment(self):
+        report = check_segment("PID|1||A^^^B||DOE^JOHN||19700101|Q", "2.5", ENCODING_CHARS)
+        self.assertIn("Value Q not in table HL70001 in element PID.PID_8", report.warnings)
+        self.assertEqual(report.errors, [])
+        # one report per field present in the text
+        self.assertEqual(len(report.fields), 5)
+        self.assertEqual(report.fields[-1].warnings, report.warnings)
+
+    def test_matches_hl7apy_segment(self):
+        for segment, version in [
+            ("PID|1||A^^^B&C&D&E||DOE^JOHN~SMITH||19700101|M^F|||||^^^X^^^^^^^^^^^^^^^^^^^^^Y", "2.5"),
+            ("EVN|A01|200708181123||", "2.8"),
+            ("PID|1||||||||||||||||||||987654^NC", "2.8"),
+            ("MSH|^~\\&|A^1.2^ISO&X|B|C|D|2009||ADT^A01^ADT_A01^X|1|P|2.3.1", "2.3.1"),
+        ]:
+            fast = check_segment(segment, version, ENCODING_CHARS)
+            reference = hl7apy_segment(segment, version, ENCODING_CHARS)
+            self.assertEqual(fast, reference, segment)
+
+    def test_unsupported_segments(self):
+        with self.assertRaises(Unsupported):
+            check_segment("ZAL|1|A^B", "2.5", ENCODING_CHARS)
+        with self.assertRaises(Unsupported):
+            check_segment("NTE|1||Escaped \\T\\ text", "2.5", ENCODING_CHARS)
+
+
+class TestFastEngine(unittest.TestCase):
+    def validate(self, msg, engine, validation_level="tolerant"):
+        segment_cache.clear()
+        return hl7validatorapi(msg, validation_level=validation_level, engine=engine)
+
+    def test_equivalent_to_hl7apy(self):
+        messages = list(MESSAGES)
+        for path in sorted(glob.glob(os.path.join(CORPUS, "*.hl7"))):
+            with open(path, newline="") as f:
+                messages.append(f.read())
+        for msg in messages:
+            for level in ("tolerant", "strict"):
+                reference = self.validate(msg, "hl7apy", level)
+                fast = self.validate(msg, "fast", level)
+                self.assertEqual(fast["statusCode"], reference["statusCode"])
+                self.assertEqual(fast["message"], reference["message"])
+                self.assertEqual(_findings(fast), _findings(reference))
+                self.assertEqual(fast.get("warnings"), reference.get("warnings"))
+
+
+if __name__ == "__main__":
+    unittest.main()
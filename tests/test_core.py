@@ -0,0 +1,65 @@
+import subprocess
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from hl7validator.core import Validator
+
+
+MESSAGE = """MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4|||
+EVN|A60|200906011158|||I000007^INTERFACE^ADT^^^^^^M^^^^^LAMH
+PID||111987|111987||Wong^Amy^||19810902|F||2028-9|999 NINE AVE^^LONG BEACH^CA^90745^US^H||(562)555-0025^^M||ENG|M|BUD|LBACT0025|730-85-8464|||||||||||N
+PV1||O|ZBC||||7^SIMPSON^MARGE^|18^WIGGUM^RALPH^|2^MOUSE^M^|MED|||||||000819^LEE VOGT^JUDY^K|O|824477665||||||||||||||||||||SIMPSON CLINIC||N|||||||||210010404670
+"""
+
+INVALID_MESSAGE = """MSH|^~\\&|ADT1|GOOD HEALTH HOSPITAL|GHH LAB, INC.|GOOD HEALTH HOSPITAL|198808181126|SECURITY|ADT^A01^ADT_A01|MSG00001|P|2.8||
+EVN|A01|200708181123||
+PID|1||PATID1234^5^M11^ADT1^MR^GOOD HEALTH HOSPITAL~123456789^^^USSSA^SS||EVERYMAN^ADAM^A^III||19610615|X||C|2222 HOME STREET^^GREENSBORO^NC^27401-1020
+PV1|1|I|2000^2012^01||||004777^ATTEND^AARON^A|||SUR||||ADM|A0|
+PV1|1|I
+"""
+
+
+class TestValidator(unittest.TestCase):
+    def test_core_does_not_import_web_stack(self):
+        code = (
+            "import sys, hl7validator.core; "
+            "print(sorted(m for m in ('flask', 'flasgger', 'flask_babel', 'pandas') if m in sys.modules))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_validate(self):
+        validator = Validator(versions=["2.4"], cache_size=64)
+        self.assertEqual(validator.validate(MESSAGE)["statusCode"], "Success")
+        result = validator.validate(INVALID_MESSAGE)
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertEqual(validator.validate(INVALID_MESSAGE, validation_profile="header")["statusCode"], "Success")
+        self.assertGreater(validator.stats()["size"], 0)
+
+    def test_settings(self):
+        validator = Validator(validation_level="strict", validation_profile="structure", engine="hl7apy")
+        self.assertEqual(validator.stages(), ("header", "parse", "structure"))
+        self.assertEqual(validator.stages("header"), ("header",))
+        with self.assertRaises(ValueError):
+            Validator(validation_profile="everything")
+        with self.assertRaises(ValueError):
+            Validator(engine="turbo")
+        with self.assertRaises(ValueError):
+            validator.validate("")
+
+    def test_shared_across_threads(self):
+        validator = Validator(cache_size=256)
+        messages = [MESSAGE, INVALID_MESSAGE] * 8
+        expected = [Validator(cache_size=0).validate(msg) for msg in messages]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(validator.validate, messages))
+        for result, reference in zip(results, expected):
+            self.assertEqual(result["statusCode"], reference["statusCode"])
+            self.assertCountEqual(result["details"], reference["details"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import tracemalloc
+import unittest
+
+from flask import Flask
+
+from hl7validator import api, diagnostics, health
+from hl7validator.pool import WorkerPool
+
+TOKEN = "s3cret"
+
+
+class TestDiagnostics(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config["ADMIN_TOKEN"] = TOKEN
+        self.assertTrue(diagnostics.init_app(app))
+        self.client = app.test_client()
+        self.headers = {"Authorization": f"Bearer {TOKEN}"}
+        self.addCleanup(diagnostics.stop_tracing)
+
+    def test_disabled_without_token(self):
+        app = Flask(__name__)
+        self.assertFalse(diagnostics.init_app(app))
+        self.assertEqual(app.test_client().get("/admin/memory").status_code, 404)
+
+    def test_authorization(self):
+        for headers in ({}, {"Authorization": "Bearer wrong"}, {"Authorization": TOKEN}):
+            response = self.client.get("/admin/memory", headers=headers)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.headers["WWW-Authenticate"], "Bearer")
+        response = self.client.post("/admin/memory/tracemalloc/start")
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_memory_report(self):
+        # rendering leaves hl7apy elements in reference cycles until the collector runs
+        api.highlight_message(health.SELF_TEST_MESSAGE, {"hl7version": "2.5", "details": []})
+        report = self.client.get("/admin/memory", headers=self.headers).json
+        self.assertEqual(report["processes"]["pid"], os.getpid())
+        self.assertGreater(report["processes"]["rss"], 0)
+        self.assertGreater(report["elements"]["by_class"]["Field"], 0)
+        self.assertIn("segments", report["caches"])
+        self.assertFalse(report["tracemalloc"]["tracing"])
+
+        report = self.client.get("/admin/memory?collect=true", headers=self.headers).json
+        self.assertEqual(report["elements"], {"total": 0, "by_class": {}})
+
+    def test_tracemalloc(self):
+        response = self.client.post("/admin/memory/tracemalloc/snapshot", headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            "/admin/memory/tracemalloc/start", json={"frames": 3}, headers=self.headers
+        )
+        self.assertEqual(response.json["frames"], 3)
+        self.assertTrue(response.json["tracing"])
+
+        first = self.client.post("/admin/memory/tracemalloc/snapshot", headers=self.headers).json
+        self.assertNotIn("diff", first)
+        retained = [bytearray(1000) for _ in range(1000)]
+        second = self.client.post(
+            "/admin/memory/tracemalloc/snapshot?limit=5", headers=self.headers
+        ).json
+        self.assertLessEqual(len(second["top"]), 5)
+        self.assertTrue(
+            any(os.path.basename(__file__) in site["site"] and site["size_diff"] >= 1000000
+                for site in second["diff"]),
+            second["diff"],
+        )
+        del retained
+
+        response = self.client.post(
+            "/admin/memory/tracemalloc/snapshot?group_by=module", headers=self.headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post("/admin/memory/tracemalloc/stop", headers=self.headers)
+        self.assertFalse(response.json["tracing"])
+        self.assertFalse(response.json["snapshot"])
+
+    def test_validation_processes(self):
+        workers = WorkerPool(2)
+        self.addCleanup(workers.shutdown)
+        app = Flask(__name__)
+        app.config["ADMIN_TOKEN"] = TOKEN
+        diagnostics.init_app(app, pools={"validation": workers})
+        client = app.test_client()
+
+        # processes not started yet are not started for the report
+        report = client.get("/admin/memory", headers=self.headers).json
+        self.assertEqual(report["pools"], {"validation": []})
+
+        workers.start()
+        validation = {"hl7version": "2.5", "details": []}
+        workers.run(30, api.highlight_message, health.SELF_TEST_MESSAGE, validation)
+        report = client.get("/admin/memory", headers=self.headers).json
+        processes = report["pools"]["validation"]
+        self.assertEqual(len(processes), 2)
+        self.assertNotIn(os.getpid(), [process["pid"] for process in processes])
+        self.assertGreater(sum(process["elements"]["total"] for process in processes), 0)
+
+        client.post("/admin/memory/tracemalloc/start", headers=self.headers)
+        client.post("/admin/memory/tracemalloc/snapshot", headers=self.headers)
+        second = client.post("/admin/memory/tracemalloc/snapshot", headers=self.headers).json
+        self.assertEqual(second["pid"], os.getpid())
+        for process in second["pools"]["validation"]:
+            self.assertIn("diff", process)
+        stopped = client.post("/admin/memory/tracemalloc/stop", headers=self.headers).json
+        self.assertEqual(
+            [process["tracing"] for process in stopped["pools"]["validation"]], [False, False]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator.core import Validator
+from hl7validator.duplicates import (
+    DUPLICATE,
+    REUSED_CONTROL_ID,
+    DuplicateDetector,
+    RotatingBloomFilter,
+)
+
+
+def feed_message(control_id, sender="EPIC", patient="Wong^Amy"):
+    return (
+        f"MSH|^~\\&|{sender}|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|{control_id}|P|2.5\r"
+        "EVN|A08|200906011158\r"
+        f"PID|1||111987^^^LAMH^MR||{patient}\r"
+        "PV1|1|I\r"
+    )
+
+
+def _check_in_child(detector, msg, outcomes):
+    outcomes.put(detector.check(msg, now=1010)[0])
+
+
+class TestDuplicateDetector(unittest.TestCase):
+    def test_duplicates(self):
+        detector = DuplicateDetector(window=60, capacity=1000)
+        self.assertEqual(detector.check(feed_message(1), now=1000)[0], None)
+        # line endings and trailing blanks do not change the content
+        resent = feed_message(1).replace("\r", "\r\n") + "\n"
+        self.assertEqual(detector.check(resent, now=1010)[0], DUPLICATE)
+        self.assertEqual(
+            detector.check(feed_message(1, patient="Doe^John"), now=1020)[0], REUSED_CONTROL_ID
+        )
+        # the identifier is the sender, facility and control ID
+        self.assertIsNone(detector.check(feed_message(1, sender="LAB"), now=1030)[0])
+        self.assertIsNone(detector.check(feed_message(2), now=1030)[0])
+        # no control ID: nothing to compare
+        self.assertIsNone(detector.check(feed_message(""), now=1030)[0])
+        self.assertIsNone(detector.check(feed_message(""), now=1030)[0])
+        self.assertEqual(detector.counts, {"checked": 5, DUPLICATE: 1, REUSED_CONTROL_ID: 1})
+        self.assertIn('hl7validator_duplicates_total{kind="duplicate"} 1', detector.metrics())
+
+        finding = detector.finding(feed_message(2), now=1040)
+        self.assertEqual(finding["level"], "Warning")
+        self.assertTrue(finding["message"].startswith("Duplicate of an earlier message: MSH-10 '2'"))
+
+    def test_window(self):
+        detector = DuplicateDetector(window=60, capacity=1000)
+        detector.check(feed_message(1), now=1000)
+        self.assertEqual(detector.check(feed_message(1), now=1059)[0], DUPLICATE)
+        # remembered from the last check, and forgotten a window and a slice later
+        self.assertEqual(detector.check(feed_message(1), now=1110)[0], DUPLICATE)
+        self.assertIsNone(detector.check(feed_message(1), now=1200)[0])
+
+    def test_fixed_memory_and_error_rate(self):
+        bloom = RotatingBloomFilter(window=60, capacity=20000, error_rate=0.01)
+        size = bloom.size
+        seen = sum(any(bloom.add(b"key %d" % i, now=1000 + i * 60 / 20000)) for i in range(20000))
+        self.assertLess(seen / 20000, 0.01)
+        self.assertEqual(len(bloom._data), size)
+        with self.assertRaises(ValueError):
+            RotatingBloomFilter(window=0, capacity=10)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "shared by forked workers")
+    def test_shared_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "duplicates.bin")
+        detector = DuplicateDetector(window=60, capacity=1000, path=path)
+        self.addCleanup(detector.close)
+        detector.check(feed_message(1), now=1000)
+
+        # another worker forked from the same master
+        context = multiprocessing.get_context("fork")
+        outcomes = context.Queue()
+        process = context.Process(
+            target=_check_in_child, args=(detector, feed_message(1), outcomes)
+        )
+        process.start()
+        self.assertEqual(outcomes.get(timeout=30), DUPLICATE)
+        process.join()
+
+        # another process opening the file
+        other = DuplicateDetector(window=60, capacity=1000, path=path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.check(feed_message(1, patient="Doe^John"), now=1020)[0],
+                         REUSED_CONTROL_ID)
+        # a file sized for other settings is started again
+        resized = DuplicateDetector(window=60, capacity=5000, path=path)
+        self.addCleanup(resized.close)
+        self.assertIsNone(resized.check(feed_message(1), now=1030)[0])
+
+    def test_from_env(self):
+        with mock.patch.dict(os.environ, {"HL7VALIDATOR_DUPLICATE_WINDOW": "0"}):
+            self.assertIsNone(DuplicateDetector.from_env())
+        with mock.patch.dict(os.environ, {
+            "HL7VALIDATOR_DUPLICATE_WINDOW": "3600", "HL7VALIDATOR_DUPLICATE_CAPACITY": "500",
+        }):
+            detector = DuplicateDetector.from_env()
+        self.assertEqual(detector.window, 3600)
+
+
+class TestDuplicateValidation(unittest.TestCase):
+    def test_validate_sampled(self):
+        validator = Validator(
+            duplicates=DuplicateDetector(window=60, capacity=1000), cache_size=0
+        )
+        self.addCleanup(validator.close)
+        first = validator.validate_sampled(feed_message(7))
+        self.assertEqual(first["statusCode"], "Success")
+        self.assertFalse(any("Duplicate" in d["message"] for d in first["details"]))
+        again = validator.validate_sampled(feed_message(7))
+        self.assertEqual(again["statusCode"], "Success")
+        self.assertEqual(again["details"][-1]["level"], "Warning")
+        self.assertIn("Duplicate of an earlier message", again["details"][-1]["message"])
+        # other validations are not feed traffic
+        self.assertEqual(validator.validate(feed_message(7))["details"], first["details"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator import gunicorn_conf
+from hl7validator.gunicorn_conf import MIB, MemoryWatchdog, cpu_count, memory_limit, settings
+from hl7validator.pool import ValidationPool, default_workers
+
+
+class TestGunicornConf(unittest.TestCase):
+    def cgroup(self, files):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name, content in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content + "\n")
+        return root
+
+    def test_cgroup_limits(self):
+        with mock.patch("os.sched_getaffinity", return_value=set(range(16))):
+            # v2: 2.5 CPUs, 1 GiB
+            root = self.cgroup({"cpu.max": "250000 100000", "memory.max": str(1024 * MIB)})
+            self.assertEqual(cpu_count(root), 3)
+            self.assertEqual(memory_limit(root), 1024 * MIB)
+            # v2 without limits
+            root = self.cgroup({"cpu.max": "max 100000", "memory.max": "max"})
+            self.assertEqual(cpu_count(root), 16)
+            # v1: 2 CPUs, and the "unlimited" memory value falls back to the physical memory
+            root = self.cgroup({
+                "cpu/cpu.cfs_quota_us": "200000", "cpu/cpu.cfs_period_us": "100000",
+                "memory/memory.limit_in_bytes": str(2**63 - 4096),
+            })
+            self.assertEqual(cpu_count(root), 2)
+            self.assertLess(memory_limit(root), 2**63 - 4096)
+
+    def test_validation_processes_share_the_cpus(self):
+        with mock.patch("hl7validator.pool.cpu_count", return_value=8):
+            with mock.patch.dict(os.environ, {"HL7VALIDATOR_SERVER_WORKERS": "3"}):
+                self.assertEqual(default_workers(), 2)
+                self.assertEqual(ValidationPool().max_workers, 2)
+            with mock.patch.dict(os.environ, {"HL7VALIDATOR_SERVER_WORKERS": "16"}):
+                self.assertEqual(default_workers(), 1)
+            with mock.patch.dict(os.environ):
+                os.environ.pop("HL7VALIDATOR_SERVER_WORKERS", None)
+                self.assertEqual(default_workers(), 8)
+
+    def test_settings(self):
+        config = settings({}, cpus=8, memory=16384 * MIB)
+        self.assertEqual(config["workers"], 8)
+        self.assertEqual(config["threads"], 2)
+        self.assertTrue(config["preload_app"])
+        self.assertEqual((config["max_requests"], config["max_requests_jitter"]), (1000, 100))
+        self.assertEqual(config["validation_processes"], 1)
+        self.assertEqual(config["max_worker_rss"], (16384 - 256) * MIB // 8)
+
+        # a 1 GiB container fits 2 workers of 256 MiB with 2 validation processes of 48 MiB
+        # each, besides the master
+        config = settings({}, cpus=4, memory=1024 * MIB)
+        self.assertEqual((config["workers"], config["validation_processes"]), (2, 2))
+        self.assertIn("1024 MiB", config["sizing"])
+
+        # the watchdog limit leaves room for the validation processes of the workers
+        config = settings({}, cpus=8, memory=2048 * MIB)
+        self.assertEqual(config["workers"], 5)
+        self.assertGreaterEqual(config["max_worker_rss"], (256 + 48) * MIB)
+        config = settings({"HL7VALIDATOR_BUDGET_WORKERS": "4"}, cpus=8, memory=2048 * MIB)
+        self.assertEqual((config["workers"], config["validation_processes"]), (4, 4))
+        self.assertGreaterEqual(config["max_worker_rss"], (256 + 4 * 48) * MIB)
+
+        config = settings({"HL7VALIDATOR_SERVER_MODE": "asgi"}, cpus=8, memory=16384 * MIB)
+        self.assertEqual(config["workers"], 2)
+        self.assertEqual(config["worker_class"], "uvicorn.workers.UvicornWorker")
+        self.assertNotIn("threads", config)
+
+        config = settings({
+            "GUNICORN_WORKERS": "5", "GUNICORN_THREADS": "4", "GUNICORN_BIND": "127.0.0.1:8000",
+            "GUNICORN_MAX_REQUESTS": "0", "GUNICORN_MAX_WORKER_RSS": "512",
+            "GUNICORN_PRELOAD": "false",
+        }, cpus=1, memory=1024 * MIB)
+        self.assertEqual(config["workers"], 5)
+        self.assertEqual(config["sizing"], "GUNICORN_WORKERS")
+        self.assertEqual(config["threads"], 4)
+        self.assertEqual(config["bind"], "127.0.0.1:8000")
+        self.assertEqual(config["max_requests"], 0)
+        self.assertEqual(config["max_worker_rss"], 512 * MIB)
+        self.assertFalse(config["preload_app"])
+
+    def test_module_settings(self):
+        # read by gunicorn from the module
+        self.assertGreaterEqual(gunicorn_conf.workers, 1)
+        self.assertTrue(gunicorn_conf.preload_app)
+        self.assertFalse(hasattr(gunicorn_conf, "sizing"))
+
+    def test_memory_watchdog(self):
+        worker = mock.Mock(pid=os.getpid())
+        with mock.patch("os.kill") as kill:
+            self.assertFalse(MemoryWatchdog(worker, 1 << 50).check())
+            kill.assert_not_called()
+            self.assertTrue(MemoryWatchdog(worker, MIB).check())
+            kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
+        worker.log.warning.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from hl7validator import app, health
+from hl7validator.budget import Limits
+from hl7validator.core import Validator
+from hl7validator.health import Readiness
+from hl7validator.pool import WorkerPool
+
+
+class TestHealth(unittest.TestCase):
+    def test_liveness(self):
+        client = app.test_client()
+        with mock.patch("flask.templating._render") as render:
+            response = client.get("/healthz")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"status": "ok"})
+        render.assert_not_called()
+
+    def test_readiness(self):
+        readiness = Readiness(versions=["2.5"], cache_seconds=60)
+        ready, report = readiness.check()
+        self.assertTrue(ready, report)
+        self.assertIn("2.5", report["versions"]["loaded"])
+        self.assertTrue(report["self_test"]["passed"])
+
+        # the self-test is cached
+        with mock.patch.object(health.api, "hl7validatorapi") as validate:
+            readiness.check()
+            validate.assert_not_called()
+
+        readiness = Readiness(versions=["2.7.1"], cache_seconds=0)
+        with mock.patch.object(health.api, "hl7validatorapi", side_effect=RuntimeError("boom")):
+            ready, report = readiness.check()
+        self.assertFalse(ready)
+        self.assertEqual(report["reasons"], [
+            "HL7 versions not loaded: 2.7.1", "self-test failed: RuntimeError: boom",
+        ])
+
+    def test_self_test_in_validation_processes(self):
+        validator = Validator(limits=Limits(time_budget=30), workers=1, parallel_threshold=0)
+        self.addCleanup(validator.close)
+        readiness = Readiness(run=validator._run, pools={"validation": validator.workers.stats})
+        ready, report = readiness.check()
+        self.assertTrue(ready, report)
+        self.assertTrue(report["self_test"]["passed"])
+        # run by the validation process, started for it
+        self.assertIsNotNone(validator.workers._idle.queue[0])
+
+        # a saturated pool keeps the last self-test instead of waiting for a process
+        readiness.cache_seconds = 0
+        busy = validator.workers._idle.get()
+        try:
+            ready, report = readiness.check()
+        finally:
+            validator.workers._idle.put(busy)
+        self.assertEqual(report["reasons"], ["saturated: validation"])
+        self.assertTrue(report["self_test"]["passed"])
+
+    def test_saturated_pools(self):
+        pool = WorkerPool(2)
+        self.assertEqual(pool.stats()["saturation"], 0)
+        pool._idle.get()
+        self.assertEqual(pool.stats()["busy"], 1)
+        readiness = Readiness(pools={"validation": pool.stats}, max_saturation=0.5)
+        ready, report = readiness.check()
+        self.assertFalse(ready)
+        self.assertEqual(report["reasons"], ["saturated: validation"])
+        self.assertEqual(report["pools"]["validation"]["saturation"], 0.5)
+
+        client = app.test_client()
+        with mock.patch.dict(app.extensions["hl7validator.readiness"].pools, {"test": pool.stats}):
+            self.assertEqual(client.get("/readyz").status_code, 200)
+            pool._idle.get()
+            response = client.get("/readyz")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json["status"], "not ready")
+
+
+if __name__ == "__main__":
+    unittest.main()
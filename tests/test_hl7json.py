@@ -0,0 +1,118 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from hl7validator import app, hl7json
+from hl7validator.__main__ import main
+from hl7validator.budget import Limits
+from hl7validator.hl7json import convert_stream, to_er7, to_json
+
+
+MESSAGE = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH&1.2.3&ISO^MR~2^^^X||Wong^Amy||19810902|F\r"
+    "PV1|1|I|\r"
+)
+
+BATCH = "\r\n".join([
+    "FHS|^~\\&|EPIC",
+    MESSAGE.replace("\r", "\r\n"),
+    "MSH|^~\\&|EPIC|LAMH|||20090601115851||ADT^A08|2|P|2.4",
+    "PID|1||222",
+    "BTS|2",
+    "FTS|1",
+])
+
+
+class TestHL7JSON(unittest.TestCase):
+    def test_hierarchy(self):
+        document = to_json(MESSAGE)
+        self.assertEqual(document["hl7version"], "2.5")
+        self.assertEqual([s["id"] for s in document["segments"]], ["MSH", "EVN", "PID", "PV1"])
+        msh, _, pid, pv1 = (s["fields"] for s in document["segments"])
+        self.assertEqual(msh[:3], [[["|"]], [["^~\\&"]], [["EPIC"]]])
+        self.assertEqual(msh[8], [["ADT", "A08", "ADT_A01"]])
+        self.assertEqual(pid[1], [])
+        self.assertEqual(pid[2], [
+            ["111987", "", "", ["LAMH", "1.2.3", "ISO"], "MR"],
+            ["2", "", "", "X"],
+        ])
+        self.assertEqual(pv1, [[["1"]], [["I"]], []])
+        self.assertEqual(to_er7(document), MESSAGE.rstrip("\r"))
+        with self.assertRaisesRegex(ValueError, "MSH"):
+            to_json("PID|1")
+
+    def test_batches_are_converted_one_message_at_a_time(self):
+        lines = list(convert_stream(BATCH))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0]), to_json(MESSAGE))
+        self.assertEqual(json.loads(lines[1])["hl7version"], "2.4")
+
+        lines = list(convert_stream([MESSAGE, "PID|1"], limits=Limits(max_segments=3)))
+        self.assertEqual(
+            [json.loads(line)["error"] for line in lines],
+            ["Budget exceeded: message has 4 segments, the limit is 3",
+             "The message does not start with an MSH segment"],
+        )
+        with self.assertRaisesRegex(ValueError, "Unknown output format"):
+            convert_stream(BATCH, "xml")
+
+    @unittest.skipIf(hl7json.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        unpacker = hl7json.msgpack.Unpacker()
+        unpacker.feed(b"".join(convert_stream(BATCH, "msgpack")))
+        self.assertEqual(list(unpacker)[0], to_json(MESSAGE))
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.post("/api/hl7/v1/convert/json", json={"data": MESSAGE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(response.json, to_json(MESSAGE))
+
+        response = client.post(
+            "/api/hl7/v1/convert/json", data=BATCH.encode(),
+            content_type="x-application/hl7-v2+er7",
+        )
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(len(response.data.splitlines()), 2)
+
+        response = client.post("/api/hl7/v1/convert/json", json={"data": "PID|1"})
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/api/hl7/v1/convert/json", json={"data": MESSAGE, "format": "x"})
+        self.assertEqual(response.status_code, 400)
+        with mock.patch("hl7validator.views.validator.limits", Limits(max_segments=3)):
+            response = client.post("/api/hl7/v1/convert/json", json={"data": MESSAGE})
+        self.assertEqual(response.status_code, 422)
+
+        response = client.post(
+            "/api/hl7/v1/convert/json", json={"data": MESSAGE},
+            headers={"Accept": "application/x-msgpack"},
+        )
+        if hl7json.msgpack is None:
+            self.assertEqual(response.status_code, 400)
+        else:
+            self.assertEqual(hl7json.msgpack.unpackb(response.data), to_json(MESSAGE))
+
+    def test_cli(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "batch.hl7"), "w", newline="") as f:
+            f.write(BATCH)
+        output = os.path.join(directory, "out.jsonl")
+        main(["convert-json", directory, "-o", output])
+        with open(output, "rb") as f:
+            self.assertEqual([json.loads(line)["hl7version"] for line in f], ["2.5", "2.4"])
+        if hl7json.msgpack is None:
+            with self.assertRaises(SystemExit), redirect_stdout(io.StringIO()), \
+                    mock.patch("sys.stderr", io.StringIO()):
+                main(["convert-json", directory, "--format", "msgpack"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from hl7validator import app
+from hl7validator.api import (
+    build_tree_structure,
+    hl7validatorapi,
+    hl7validatorapi_incremental,
+    highlight_message,
+    segment_cache,
+)
+
+
+MESSAGE = """MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4|||
+EVN|A60|200906011158|||I000007^INTERFACE^ADT^^^^^^M^^^^^LAMH
+PID||111987|111987||Wong^Amy^||19810902|F||2028-9|999 NINE AVE^^LONG BEACH^CA^90745^US^H||(562)555-0025^^M||ENG|M|BUD|LBACT0025|730-85-8464|||||||||||N
+PV1||O|ZBC||||7^SIMPSON^MARGE^|18^WIGGUM^RALPH^|2^MOUSE^M^|MED|||||||000819^LEE VOGT^JUDY^K|O|824477665||||||||||||||||||||SIMPSON CLINIC||N|||||||||210010404670
+"""
+
+INVALID_MESSAGE = """MSH|^~\\&|ADT1|GOOD HEALTH HOSPITAL|GHH LAB, INC.|GOOD HEALTH HOSPITAL|198808181126|SECURITY|ADT^A01^ADT_A01|MSG00001|P|2.8||
+EVN|A01|200708181123||
+PID|1||PATID1234^5^M11^ADT1^MR^GOOD HEALTH HOSPITAL~123456789^^^USSSA^SS||EVERYMAN^ADAM^A^III||19610615|X||C|2222 HOME STREET^^GREENSBORO^NC^27401-1020
+PV1|1|I|2000^2012^01||||004777^ATTEND^AARON^A|||SUR||||ADM|A0|
+PV1|1|I
+"""
+
+# trailing blanks, which the full validation strips from every segment
+PADDED_MESSAGE = (
+    "MSH|^~\\&|||||20040629164652|1|PPR^PC1|331|P|2.3.1|| \r\n"
+    "PID|||10290^^^WEST^MR||KARLS^TOM^ANDREW^^MR.^||20040530|M|||||||||||398-44-5555"
+    "|||||||||||N \r\n"
+    "PRB|AD|2004062916460000|596.5^BLADDER DYSFUNCTION^I9|26744|||20040629||||||ACTIVE|||20040629 "
+)
+
+
+def _sorted(details):
+    return sorted(details, key=lambda d: (d["level"], d["message"]))
+
+
+class TestIncrementalValidation(unittest.TestCase):
+    def setUp(self):
+        segment_cache.clear()
+
+    def assertSameResult(self, msg):
+        canonical = hl7validatorapi(msg)
+        incremental = hl7validatorapi_incremental(msg)
+        self.assertEqual(incremental["statusCode"], canonical["statusCode"])
+        self.assertEqual(incremental["message"], canonical["message"])
+        self.assertEqual(_sorted(incremental["details"]), _sorted(canonical["details"]))
+
+    def test_matches_full_validation(self):
+        self.assertSameResult(MESSAGE)
+        self.assertSameResult(INVALID_MESSAGE)
+        self.assertSameResult(PADDED_MESSAGE)
+
+    def test_header_errors_match_full_validation(self):
+        self.assertSameResult(MESSAGE.replace("^~\\&", "^~\\&#"))
+        self.assertSameResult(MESSAGE.replace("|2.4|", "|9.9|"))
+        self.assertSameResult("PID|1||111987\r")
+
+    def test_resubmission_uses_cache(self):
+        hl7validatorapi_incremental(MESSAGE)
+        misses = segment_cache.stats()["misses"]
+        hl7validatorapi_incremental(MESSAGE)
+        self.assertEqual(segment_cache.stats()["misses"], misses)
+
+    def test_edited_segment_is_revalidated(self):
+        hl7validatorapi_incremental(MESSAGE)
+        misses = segment_cache.stats()["misses"]
+        edited = MESSAGE.replace("|19810902|F|", "|19810902|X|")
+        self.assertSameResult(edited)
+        segment_cache.clear()
+        hl7validatorapi_incremental(MESSAGE)
+        misses = segment_cache.stats()["misses"]
+        hl7validatorapi_incremental(edited)
+        # only the PID segment is validated again; the structure check is unchanged
+        self.assertEqual(segment_cache.stats()["misses"], misses + 1)
+
+    def test_highlight_is_cached_per_segment(self):
+        with app.app_context():
+            first, _ = highlight_message(MESSAGE, hl7validatorapi(MESSAGE))
+            misses = segment_cache.stats()["misses"]
+            second, validation = highlight_message(MESSAGE, hl7validatorapi(MESSAGE))
+        self.assertEqual(first, second)
+        self.assertEqual(segment_cache.stats()["misses"], misses)
+        self.assertIn('class="segment PID"', second)
+
+    def test_tree_is_cached_per_segment(self):
+        first, _ = build_tree_structure(MESSAGE, hl7validatorapi(MESSAGE))
+        misses = segment_cache.stats()["misses"]
+        second, _ = build_tree_structure(MESSAGE, hl7validatorapi(MESSAGE))
+        self.assertEqual(first, second)
+        self.assertEqual(segment_cache.stats()["misses"], misses)
+        # the findings about a segment's fields are part of its HTML
+        finding = {"level": "Error", "message": "Invalid date format on field PID.PID_7"}
+        flagged, _ = build_tree_structure(MESSAGE, {"hl7version": "2.4", "details": [finding]})
+        self.assertNotIn('error">PID-7<', second)
+        self.assertIn('error">PID-7<', flagged)
+
+    def test_web_form(self):
+        client = app.test_client()
+        response = client.post("/", data={"options": "hl7v2", "msg": INVALID_MESSAGE})
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from hl7validator import app
+from hl7validator.api import hl7validatorapi
+
+
+VALID = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy\r"
+    "PV1|1|I\r"
+)
+
+# tolerant accepts the date, strict parsing rejects it and stops there
+STRICT_ONLY = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy||1981-09-02\r"
+)
+
+# parses at both levels; PV1 is missing for both
+COMMON = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy\r"
+)
+
+
+def without_scope(result):
+    result = dict(result)
+    levels = result.pop("levels")
+    result["details"] = [
+        {key: value for key, value in detail.items() if key != "scope"}
+        for detail in result["details"]
+        if detail["scope"] != "strict-only"
+    ]
+    return result, levels
+
+
+class TestBothLevels(unittest.TestCase):
+    def assert_combines(self, msg):
+        tolerant = hl7validatorapi(msg)
+        strict = hl7validatorapi(msg, validation_level="strict")
+        result, levels = without_scope(hl7validatorapi(msg, validation_level="both"))
+        self.assertEqual(result, dict(tolerant, details=tolerant["details"] or []))
+        self.assertEqual(levels["tolerant"], {
+            "statusCode": tolerant["statusCode"], "message": tolerant["message"]
+        })
+        self.assertEqual(levels["strict"], {
+            "statusCode": strict["statusCode"], "message": strict["message"]
+        })
+
+    def test_valid_at_both_levels(self):
+        self.assert_combines(VALID)
+        result = hl7validatorapi(VALID, validation_level="both")
+        self.assertEqual(result["levels"]["strict"]["statusCode"], "Success")
+        self.assertEqual(result["details"], [])
+
+    def test_strict_only_findings(self):
+        self.assert_combines(STRICT_ONLY)
+        result = hl7validatorapi(STRICT_ONLY, validation_level="both")
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertEqual(
+            [d["message"].strip() for d in result["details"] if d["scope"] == "strict-only"],
+            ["1981-09-02 is not an HL7 valid date value"],
+        )
+        # strict validation stops at the parse error: the tolerant findings are not common
+        scopes = {d["scope"] for d in result["details"]}
+        self.assertEqual(scopes, {"strict-only", "tolerant-only"})
+
+    def test_common_findings(self):
+        self.assert_combines(COMMON)
+        result = hl7validatorapi(COMMON, validation_level="both")
+        self.assertEqual(result["levels"]["strict"]["statusCode"], "Failed")
+        self.assertTrue(result["details"])
+        self.assertEqual({d["scope"] for d in result["details"]}, {"common"})
+
+    def test_unparsable_and_header_only(self):
+        self.assert_combines("MSH|^~\\&|EPIC|LAMH\rPID|1")
+        result = hl7validatorapi(VALID, validation_level="both", validation_profile="header")
+        self.assertEqual(result["levels"]["strict"], result["levels"]["tolerant"])
+
+    def test_endpoint(self):
+        response = app.test_client().post(
+            "/api/hl7/v1/validate/", json={"data": STRICT_ONLY, "validation_level": "both"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["levels"]["strict"]["statusCode"], "Failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from hl7validator import logs
+from hl7validator.budget import Limits
+from hl7validator.core import Validator
+
+
+MESSAGE = (
+    "MSH|^~\\&|ADT1|GOOD HEALTH HOSPITAL|GHH LAB|GOOD HEALTH HOSPITAL|198808181126|SECURITY|ADT^A01^ADT_A01|MSG00001|P|2.5\r"
+    "EVN|A01|200708181123\r"
+    "PID|1||PATID1234^5^M11~123456789^^^USSSA^SS||EVERYMAN^ADAM^A^III||19610615|M\r"
+    "ZPD|1|SECRET\r"
+)
+
+
+class TestRedaction(unittest.TestCase):
+    def test_redact_fields(self):
+        fields = logs.parse_redact_fields("PID-3,PID-5,PID-7,ZPD-*,MSH-4")
+        redacted = logs.redact_message(MESSAGE, fields)
+        segments = redacted.split("\r")
+        self.assertEqual(segments[0].split("|")[3], "***")
+        self.assertEqual(segments[1], "EVN|A01|200708181123")
+        self.assertEqual(segments[2], "PID|1||***||***||***|M")
+        self.assertEqual(segments[3], "ZPD|***|***")
+        for value in ("EVERYMAN", "19610615", "123456789", "SECRET", "GOOD HEALTH HOSPITAL|GHH"):
+            self.assertNotIn(value, redacted)
+
+    def test_unparseable_message_is_redacted_whole(self):
+        self.assertEqual(logs.redact_message("PID|1||123||DOE^JOHN", {}), logs.REDACTED)
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "validation.log")
+        self.rate = logs.sampler.rate
+        self.logger = logging.getLogger(logs.LOGGER_NAME)
+        logs.configure_logging(path=self.path, level="INFO", fmt="json")
+
+    def tearDown(self):
+        logs.stop_logging()
+        logs.sampler.rate = self.rate
+        self.tmpdir.cleanup()
+
+    def read_lines(self):
+        logs.stop_logging()
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines_with_sampled_redacted_bodies(self):
+        logs.sampler.rate = 0
+        logs.log_message(self.logger, logging.INFO, "received", MESSAGE, validation_level="strict")
+        logs.sampler.rate = 1
+        logs.log_message(self.logger, logging.INFO, "received", MESSAGE)
+        self.logger.warning("count: %d", 3)
+
+        unsampled, sampled, warning = self.read_lines()
+        self.assertEqual(unsampled["message"], "received")
+        self.assertEqual(unsampled["validation_level"], "strict")
+        self.assertNotIn(logs.MESSAGE_ATTRIBUTE, unsampled)
+        self.assertIn("PID|1||***||***||***|M", sampled[logs.MESSAGE_ATTRIBUTE])
+        self.assertEqual((warning["level"], warning["message"]), ("WARNING", "count: 3"))
+
+    def test_records_point_at_the_caller(self):
+        logger = logging.getLogger("hl7validator.tests")
+        with self.assertLogs(logger, logging.INFO) as captured:
+            logs.log_message(logger, logging.INFO, "received", MESSAGE)
+        (record,) = captured.records
+        self.assertEqual((record.module, record.funcName), ("test_logs", self._testMethodName))
+
+    def test_exceptions(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("failed")
+        (entry,) = self.read_lines()
+        self.assertIn("ValueError: boom", entry["exc_info"])
+
+    def test_records_of_the_validation_processes(self):
+        logs.sampler.rate = 1
+        validator = Validator(limits=Limits(time_budget=30), workers=1, parallel_threshold=0)
+        try:
+            result = validator.validate(MESSAGE)
+        finally:
+            validator.close()
+        self.assertEqual(result["hl7version"], "2.5")
+        (received,) = [
+            entry for entry in self.read_lines()
+            if entry["message"] == "message received in hl7validatorapi"
+        ]
+        self.assertEqual(received["logger"], logs.LOGGER_NAME)
+        self.assertIn("PID|1||***||***||***|M", received[logs.MESSAGE_ATTRIBUTE])
+
+    def test_parse_errors_do_not_log_values(self):
+        from hl7validator.api import hl7validatorapi
+        from hl7validator.parallel import validate as validate_parallel
+
+        logs.sampler.rate = 0
+        msg = MESSAGE.replace("19610615", "1961-06-15")
+        strict = hl7validatorapi(msg, validation_level="strict")
+        # a segment that hl7apy rejects even tolerantly, with the same kind of error
+        error = strict["message"].replace("[Error parsing message] ", "")
+        parallel = validate_parallel(
+            msg, lambda jobs: [[(error, None)] * len(job[0]) for job in jobs]
+        )
+        for result in (strict, parallel):
+            self.assertIn("1961-06-15", result["message"])
+        errors = [entry for entry in self.read_lines() if entry["level"] == "ERROR"]
+        self.assertEqual([entry["message"] for entry in errors], ["Not able to parse message"] * 2)
+        self.assertNotIn("1961-06-15", json.dumps(errors))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from hl7validator import app, matrix
+from hl7validator.__main__ import main
+from hl7validator.api import hl7validatorapi
+from hl7validator.budget import BudgetExceeded, Limits
+from hl7validator.core import Validator
+
+
+ADT = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5^POR\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy\r"
+    "PV1|1|I\r"
+)
+
+ORU = (
+    "MSH|^~\\&|LAB|H|X|Y|20200101||ORU^R01^ORU_R01|9|P|2.6\n"
+    "PID|1||1^^^H^MR||Doe^J\n"
+    "OBR|1||123|CBC\n"
+    "OBX|1|NM|WBC||7.5|10*3/uL|||||F\n"
+)
+
+
+class TestConformanceMatrix(unittest.TestCase):
+    def test_rewrites_msh_12_only(self):
+        lexed = matrix.lex(ORU)
+        self.assertEqual(lexed[0], "2.6")
+        self.assertEqual(
+            matrix.with_version(lexed, "2.3").split("\r")[0],
+            "MSH|^~\\&|LAB|H|X|Y|20200101||ORU^R01^ORU_R01|9|P|2.3",
+        )
+        self.assertTrue(matrix.with_version(matrix.lex(ADT), "2.4").startswith(
+            "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.4^POR\r"
+        ))
+        short = matrix.lex("MSH|^~\\&|LAB\rPID|1")
+        self.assertEqual(short[0], "")
+        self.assertEqual(matrix.with_version(short, "2.5"), "MSH|^~\\&|LAB|||||||||2.5\rPID|1")
+        self.assertIsNone(matrix.lex("PID|1"))
+
+    def test_same_findings_as_validating_each_version(self):
+        versions = ["2.2", "2.3.1", "2.5", "2.8"]
+        for msg in (ADT, ORU):
+            result = matrix.conformance_matrix(msg, versions)
+            declared, jobs = matrix.conformance_jobs(msg, versions)
+            self.assertEqual(result["declared"], declared)
+            self.assertEqual([row["version"] for row in result["versions"]], versions)
+            for (text, version, _), row in zip(jobs, result["versions"]):
+                expected = matrix.version_row(version, hl7validatorapi(text))
+                self.assertEqual(row, expected)
+            self.assertEqual(
+                result["conforms"],
+                [row["version"] for row in result["versions"] if row["statusCode"] == "Success"],
+            )
+        self.assertIn("2.5", matrix.conformance_matrix(ADT, "2.5,2.8")["conforms"])
+        [row] = matrix.conformance_matrix(ORU, ["2.2"])["versions"]
+        self.assertEqual(row["statusCode"], "Failed")
+
+    def test_invalid_requests(self):
+        with self.assertRaises(ValueError):
+            matrix.conformance_matrix(ADT, ["2.5", "3.0"])
+        with self.assertRaises(ValueError):
+            matrix.conformance_matrix("")
+        result = matrix.conformance_matrix("PID|1||1", ["2.4", "2.5"])
+        self.assertIsNone(result["declared"])
+        self.assertEqual(result["conforms"], [])
+        self.assertTrue(all(row["first_error"] for row in result["versions"]))
+
+    def test_validator_runs_versions_on_workers(self):
+        validator = Validator(limits=Limits(time_budget=60, max_segments=10), workers=2)
+        self.addCleanup(validator.close)
+        self.assertEqual(
+            validator.conformance_matrix(ORU, ["2.3", "2.4", "2.5"]),
+            matrix.conformance_matrix(ORU, ["2.3", "2.4", "2.5"]),
+        )
+        with self.assertRaises(BudgetExceeded):
+            validator.conformance_matrix(ORU + "NTE|1\r" * 10)
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.post(
+            "/api/hl7/v1/conformance/", json={"data": ADT, "versions": ["2.4", "2.5"]}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["declared"], "2.5")
+        self.assertEqual(len(response.json["versions"]), 2)
+        response = client.post(
+            "/api/hl7/v1/conformance/?versions=2.5",
+            data=ADT,
+            content_type="x-application/hl7-v2+er7",
+        )
+        self.assertEqual([row["version"] for row in response.json["versions"]], ["2.5"])
+        response = client.post("/api/hl7/v1/conformance/", json={"data": ADT, "versions": ["9"]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command_line_summary(self):
+        logger = logging.getLogger("hl7validator")
+        self.addCleanup(logger.setLevel, logger.level)
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "samples.hl7"), "w", newline="") as f:
+            f.write(ADT + "\r\n" + ORU + "\n" + ADT)
+        output = os.path.join(directory, "report.json")
+        main([
+            "conformance", os.path.join(directory, "samples.hl7"), "--versions", "2.3,2.5",
+            "--workers", "1", "--format", "json", "-o", output,
+        ])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report["messages"], 3)
+        self.assertEqual(report["declared"], {"2.5": 2, "2.6": 1})
+        by_version = {entry["version"]: entry for entry in report["versions"]}
+        self.assertEqual(by_version["2.5"]["conforming"], 3)
+        self.assertEqual(by_version["2.5"]["conformance_rate"], 1.0)
+
+        summary = matrix.conformance_feed(
+            [ADT, ORU, ADT], versions=["2.3", "2.5"], workers=2, batch_size=1
+        )
+        self.assertEqual(json.loads(json.dumps(summary.report())), report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator import app, message_profiles
+from hl7validator.api import hl7validatorapi
+from hl7validator.budget import Limits
+from hl7validator.core import Validator
+from hl7validator.message_profiles import ProfileRegistry, compile_profile, load_profile
+
+
+ADT = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR~2^^^X||Wong^Amy\r"
+    "PV1|1|I\r"
+    "ZPI|1\r"
+)
+
+PROFILE = {
+    "id": "acme-adt",
+    "hl7_version": "2.5",
+    "message_type": "ADT^A08",
+    "segments": {"PV1": {"usage": "R"}, "ZPI": {"usage": "X"}, "NK1": {"usage": "R"}},
+    "fields": {
+        "PID-3": {"usage": "R", "max": 1, "max_length": 20},
+        "PID-3.4": {"value": "LAMH"},
+        "PID-8": {"usage": "R", "values": ["F", "M", "U"]},
+        "EVN-2": {"max_length": 8},
+        "PV1-2": {"values": ["I", "O"]},
+    },
+}
+
+EXPECTED = [
+    "EVN-2 is 12 characters long, the profile allows 8",
+    "PID-3 has 2 repetitions, the profile allows 1",
+    "PID-3.4 value X is not allowed, the profile requires LAMH",
+    "PID-8 is required by the profile",
+    "Segment ZPI is not supported by the profile",
+    "Segment NK1 is required by the profile",
+]
+
+YAML_PROFILE = """
+id: acme-adt
+hl7_version: "2.5"
+message_type: ADT^A08
+segments:
+  PV1: {usage: R}
+  ZPI: {usage: X}
+  NK1: {usage: R}
+fields:
+  PID-3: {usage: R, max: 1, max_length: 20}
+  PID-3.4: {value: LAMH}
+  PID-8: {usage: R, values: [F, M, U]}
+  EVN-2: {max_length: 8}
+  PV1-2: {values: [I, O]}
+"""
+
+XML_PROFILE = """<?xml version="1.0" encoding="UTF-8"?>
+<HL7v2xConformanceProfile HL7Version="2.5" ProfileType="Implementation">
+  <MetaData Name="acme-adt" OrgName="ACME"/>
+  <HL7v2xStaticDef MsgType="ADT" EventType="A08" MsgStructID="ADT_A01">
+    <Segment Name="MSH" Usage="R" Min="1" Max="1"/>
+    <Segment Name="EVN" Usage="R" Min="1" Max="1">
+      <Field Name="Event Type Code" Usage="O" Min="0" Max="1" Datatype="ID" Length="3"/>
+      <Field Name="Recorded Date/Time" Usage="R" Min="1" Max="1" Datatype="TS" Length="8"/>
+    </Segment>
+    <Segment Name="PID" Usage="R" Min="1" Max="1">
+      <Field Name="Set ID" Usage="O" Min="0" Max="1" Datatype="SI"/>
+      <Field Name="Patient ID" Usage="X" Min="0" Max="0" Datatype="CX"/>
+      <Field Name="Patient Identifier List" Usage="R" Min="1" Max="1" Datatype="CX" Length="20">
+        <Component Name="ID Number" Usage="R" Datatype="ST"/>
+        <Component Name="Check Digit" Usage="O" Datatype="ST"/>
+        <Component Name="Check Digit Scheme" Usage="O" Datatype="ID"/>
+        <Component Name="Assigning Authority" Usage="R" Datatype="HD" ConstantValue="LAMH"/>
+      </Field>
+      <Field Name="Alternate Patient ID" Usage="O" Min="0" Max="1" Datatype="CX"/>
+      <Field Name="Patient Name" Usage="R" Min="1" Max="*" Datatype="XPN"/>
+      <Field Name="Mother's Maiden Name" Usage="O" Min="0" Max="1" Datatype="XPN"/>
+      <Field Name="Date/Time of Birth" Usage="O" Min="0" Max="1" Datatype="TS"/>
+      <Field Name="Administrative Sex" Usage="R" Min="1" Max="1" Datatype="IS"/>
+    </Segment>
+    <SegGroup Name="NEXT_OF_KIN" Usage="O" Min="0" Max="*">
+      <Segment Name="NK1" Usage="R" Min="1" Max="1"/>
+    </SegGroup>
+    <Segment Name="PV1" Usage="R" Min="1" Max="1"/>
+    <Segment Name="ZPI" Usage="X" Min="0" Max="0"/>
+  </HL7v2xStaticDef>
+</HL7v2xConformanceProfile>
+"""
+
+
+def errors(result):
+    return [d["message"].strip() for d in result["details"] if d["level"] == "Error"]
+
+
+class TestMessageProfiles(unittest.TestCase):
+    def test_rules_are_checked_in_one_pass(self):
+        profile = compile_profile(PROFILE, "hash")
+        self.assertEqual(profile.rule_count, 8)
+        self.assertEqual(set(profile.fields), {"PID", "EVN", "PV1"})
+
+        result = hl7validatorapi(ADT, profile=profile)
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertEqual(result["message"], "Not valid")
+        self.assertEqual(errors(result), EXPECTED)
+        self.assertEqual(result["profile"], {"id": "acme-adt", "hash": "hash"})
+        # without the profile the message is valid
+        self.assertEqual(hl7validatorapi(ADT)["statusCode"], "Success")
+
+        fixed = ADT.replace("~2^^^X", "").replace("Wong^Amy", "Wong^Amy|||F")
+        fixed = fixed.replace("200906011158", "20090601").replace("ZPI|1\r", "NK1|1\r")
+        self.assertEqual(errors(hl7validatorapi(fixed, profile=profile)), [])
+
+        other = ADT.replace("ADT^A08^ADT_A01", "ADT^A01^ADT_A01").replace("|P|2.5", "|P|2.4")
+        self.assertEqual(errors(hl7validatorapi(other, profile=profile))[:2], [
+            "Message type ADT^A01^ADT_A01 does not match the profile's ADT^A08",
+            "HL7 version 2.4 does not match the profile's 2.5",
+        ])
+        # messages that do not parse get the parse error only
+        broken = hl7validatorapi("PID|1", profile=profile)
+        self.assertNotIn("profile", broken)
+
+    def test_yaml_and_xml_profiles(self):
+        self.assertEqual(load_profile(YAML_PROFILE), PROFILE)
+        self.assertEqual(load_profile(json.dumps(PROFILE)), PROFILE)
+
+        profile = compile_profile(load_profile(XML_PROFILE))
+        self.assertEqual(profile.id, "acme-adt")
+        self.assertEqual(profile.message_type, ("ADT", "A08"))
+        # NK1 is in an optional group: its occurrences are not checked
+        self.assertNotIn("NK1", profile.segments)
+        self.assertEqual(errors(hl7validatorapi(ADT, profile=profile)), [
+            "EVN-2 is 12 characters long, the profile allows 8",
+            "PID-3 has 2 repetitions, the profile allows 1",
+            "PID-3.4 value X is not allowed, the profile requires LAMH",
+            "PID-8 is required by the profile",
+            "Segment ZPI is not supported by the profile",
+        ])
+
+    def test_malformed_profiles(self):
+        for document, message in (
+            ({"id": "../etc"}, "Invalid profile id"),
+            ({"id": "a", "fields": {"PID3": {}}}, "Invalid field location"),
+            ({"id": "a", "fields": {"PID-3": {"usage": "Q"}}}, "Invalid usage"),
+            ({"id": "a", "fields": {"PID-3.1": {"max": 1}}}, "Repetitions apply to fields"),
+            ({"id": "a", "segments": {"PID": {"max": "many"}}}, "Invalid max"),
+        ):
+            with self.assertRaisesRegex(ValueError, message):
+                compile_profile(document)
+        with self.assertRaisesRegex(ValueError, "DOCTYPE"):
+            load_profile('<!DOCTYPE x [<!ENTITY a "a">]><HL7v2xConformanceProfile/>')
+        with self.assertRaises(ValueError):
+            load_profile("{", "json")
+
+    def test_registry_compiles_once_and_shares_the_directory(self):
+        directory = tempfile.mkdtemp()
+        registry = ProfileRegistry(directory)
+        with mock.patch.object(
+            message_profiles, "compile_profile", wraps=message_profiles.compile_profile
+        ) as compiled:
+            first = registry.register(json.dumps(PROFILE))
+            self.assertIs(registry.register(json.dumps(PROFILE)), first)
+            self.assertEqual(compiled.call_count, 1)
+        self.assertIs(registry.get("acme-adt"), first)
+        self.assertIs(registry.get(first), first)
+        self.assertEqual(os.listdir(directory), ["acme-adt.json"])
+        with self.assertRaisesRegex(ValueError, "Unknown message profile"):
+            registry.get("other")
+
+        # another worker process sees the profile, and its replacement
+        other = ProfileRegistry(directory)
+        self.assertEqual(other.get("acme-adt").hash, first.hash)
+        replaced = registry.register(XML_PROFILE, "xml")
+        self.assertEqual(os.listdir(directory), ["acme-adt.xml"])
+        self.assertEqual(other.get("acme-adt").hash, replaced.hash)
+        self.assertEqual([p["id"] for p in other.profiles()], ["acme-adt"])
+
+    def test_validator_and_endpoints(self):
+        registry = ProfileRegistry()
+        profile = registry.register(YAML_PROFILE, "yaml")
+        validator = Validator(limits=Limits(time_budget=60), workers=1, profiles=registry)
+        self.addCleanup(validator.close)
+        # the compiled profile is sent to the worker process with the message
+        self.assertEqual(
+            validator.validate(ADT, profile="acme-adt"), hl7validatorapi(ADT, profile=profile)
+        )
+        with self.assertRaises(ValueError):
+            validator.validate(ADT, profile="other")
+
+        client = app.test_client()
+        upload = {"Authorization": "Bearer s3cret"}
+        registry.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, registry.directory)
+        with mock.patch.object(message_profiles, "registry", registry), \
+                mock.patch("hl7validator.views.validator.profiles", registry), \
+                mock.patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}):
+            response = client.post(
+                "/api/hl7/v1/profiles/", data=XML_PROFILE, content_type="application/xml"
+            )
+            self.assertEqual(response.status_code, 401)
+            response = client.post(
+                "/api/hl7/v1/profiles/", data=XML_PROFILE, content_type="application/xml",
+                headers=upload,
+            )
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json["message_type"], "ADT^A08")
+            response = client.post("/api/hl7/v1/validate/", json={"data": ADT, "profile": "acme-adt"})
+            self.assertEqual(response.json["profile"]["hash"], registry.get("acme-adt").hash)
+            self.assertIn("PID-8 is required by the profile", errors(response.json))
+            response = client.post("/api/hl7/v1/validate/", json={"data": ADT, "profile": "x"})
+            self.assertEqual(response.status_code, 400)
+            response = client.post(
+                "/api/hl7/v1/profiles/", data="id: ../x", content_type="application/yaml",
+                headers=upload,
+            )
+            self.assertEqual(response.status_code, 400)
+
+            # profiles kept in one worker's memory are refused, as are uploads without a token
+            registry.directory = None
+            response = client.post(
+                "/api/hl7/v1/profiles/", data=XML_PROFILE, content_type="application/xml",
+                headers=upload,
+            )
+            self.assertEqual(response.status_code, 403)
+            app.config["ADMIN_TOKEN"] = None
+            response = client.post(
+                "/api/hl7/v1/profiles/", data=XML_PROFILE, content_type="application/xml"
+            )
+            self.assertEqual(response.status_code, 403)
+
+    def test_registry_is_bounded(self):
+        registry = ProfileRegistry(max_profiles=2)
+        for index in range(2):
+            registry.register(json.dumps(dict(PROFILE, id=f"p{index}")))
+        with self.assertRaisesRegex(ValueError, "Too many message profiles"):
+            registry.register(json.dumps(dict(PROFILE, id="p2")))
+        # registered IDs can still be replaced, and old compilations are evicted
+        for length in range(5):
+            registry.register(json.dumps(dict(PROFILE, id="p0", note="x" * length)))
+        self.assertEqual(len(registry._by_hash), 2)
+        self.assertEqual([p["id"] for p in registry.profiles()], ["p0", "p1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
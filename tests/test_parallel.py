@@ -0,0 +1,90 @@
+import unittest
+
+from hl7validator import api, parallel
+from hl7validator.budget import Limits
+from hl7validator.cache import LRUCache
+from hl7validator.core import Validator
+
+
+def results_message(observations, version="2.5", structure="ORU^R01^ORU_R01"):
+    segments = [
+        f"MSH|^~\\&|LAB|HOSP|EHR|HOSP|20200101120000||{structure}|MSG1|P|{version}",
+        "PID|1||123456^^^HOSP^MR||DOE^JOHN||19800101|M",
+        "OBR|1|ORD1|FIL1|CBC^Complete blood count",
+    ]
+    for i in range(observations):
+        # every seventh value type is unknown, giving findings spread over the chunks
+        value_type = "XX" if i % 7 == 0 else "NM"
+        segments.append(f"OBX|{i + 1}|{value_type}|WBC^White cells||{i % 13}.{i % 10}|10*3/uL|4-11|N|||F")
+    segments.append("NTE|1||Reviewed")
+    segments.append("ZZZ|1")
+    return "\r".join(segments)
+
+
+def run_inline(jobs):
+    return [parallel.validate_chunk(*job) for job in jobs]
+
+
+class TestParallelValidation(unittest.TestCase):
+    def assertSameAsSerial(self, msg):
+        expected = api.hl7validatorapi(msg, cache=LRUCache(0))
+        result = parallel.validate(msg, run_inline, chunk_size=37)
+        self.assertIsNotNone(result)
+        self.assertEqual(result, expected)
+
+    def test_same_findings_as_serial(self):
+        self.assertSameAsSerial(results_message(300))
+        self.assertSameAsSerial(results_message(40, version="2.3", structure="ORU^R01"))
+
+    def test_parse_error_of_first_failing_segment(self):
+        msg = results_message(100)
+
+        def failing(jobs):
+            results = run_inline(jobs)
+            for chunk, job in zip(results, jobs):
+                for index, seg_text in enumerate(job[0]):
+                    if seg_text.startswith(("OBX|20|", "OBX|80|")):
+                        chunk[index] = (f"cannot parse {seg_text[:6]}", None)
+            return results
+
+        result = parallel.validate(msg, failing, chunk_size=10)
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertEqual(result["message"], "[Error parsing message] cannot parse OBX|20")
+
+    def test_whole_message_stages_go_through_run(self):
+        msg = results_message(60)
+        stages = []
+
+        def run(fn, *args):
+            stages.append(fn.__name__)
+            return fn(*args)
+
+        result = parallel.validate(msg, run_inline, chunk_size=37, run=run)
+        self.assertEqual(result, api.hl7validatorapi(msg, cache=LRUCache(0)))
+        self.assertEqual(stages, ["read_skeleton", "check_content"])
+
+    def test_falls_back_when_skeleton_does_not_parse(self):
+        self.assertIsNone(parallel.validate("PID|1\rOBX|1", run_inline))
+
+    def test_applies(self):
+        msg = results_message(50)
+        self.assertTrue(parallel.applies(msg, 20, "tolerant", api.get_validation_profile("full"), "fast"))
+        self.assertFalse(parallel.applies(msg, 0, "tolerant", api.get_validation_profile("full"), "fast"))
+        self.assertFalse(parallel.applies(msg, 100, "tolerant", api.get_validation_profile("full"), "fast"))
+        self.assertFalse(parallel.applies(msg, 20, "strict", api.get_validation_profile("full"), "fast"))
+        self.assertFalse(parallel.applies(msg, 20, "tolerant", api.get_validation_profile("full"), "hl7apy"))
+        self.assertFalse(parallel.applies(msg, 20, "tolerant", api.get_validation_profile("structure"), "fast"))
+
+    def test_validator_uses_worker_processes(self):
+        msg = results_message(120)
+        validator = Validator(
+            limits=Limits(time_budget=60), workers=2, parallel_threshold=100, parallel_chunk_size=50
+        )
+        self.addCleanup(validator.close)
+        self.assertEqual(validator.validate(msg), api.hl7validatorapi(msg, cache=LRUCache(0)))
+        small = results_message(10)
+        self.assertEqual(validator.validate(small), api.hl7validatorapi(small, cache=LRUCache(0)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+import unittest
+
+from hl7validator.__main__ import main
+from hl7validator import profiler
+from hl7validator.profiler import (
+    DistinctCounter,
+    FeedProfile,
+    TopValues,
+    profile_feed,
+    read_messages,
+)
+
+
+def feed(count):
+    for i in range(count):
+        sex = "FMU"[i % 3] if i % 5 else "Q"
+        birth = f"19{i % 90 + 10}0101" if i % 10 else "1981-01-01"
+        # every other patient has an SSN repetition, every fourth message no PV1-19
+        ids = f"{i}^^^LAMH^MR" + (f"~{i}^^^SSA^SS" if i % 2 else "")
+        yield (
+            f"MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|{i}|P|2.5\r"
+            f"PID|1||{ids}||Wong^Amy||{birth}|{sex}\r"
+            f"PV1|1|I" + ("" if i % 4 == 0 else f"|||||||||||||||||{i * 3}")
+        )
+
+
+def exact_parts(report):
+    # top values are only exact while an element has fewer distinct values than counters
+    return [
+        {key: value for key, value in entry.items() if key != "top" or entry["distinct"] < 30}
+        for entry in report["elements"]
+    ]
+
+
+def element(report, name, message_type="ADT^A08"):
+    for entry in report["elements"]:
+        if entry["element"] == name and entry["message_type"] == message_type:
+            return entry
+    raise KeyError(name)
+
+
+class TestSketches(unittest.TestCase):
+    def test_distinct_counter(self):
+        small = DistinctCounter()
+        for value in ["a", "b", "a"]:
+            small.add(value)
+        self.assertEqual(small.estimate(), 2)
+
+        large = DistinctCounter()
+        other = DistinctCounter()
+        for i in range(50000):
+            (large if i % 2 else other).add(str(i))
+        other.add("1")
+        large.merge(other)
+        self.assertAlmostEqual(large.estimate(), 50000, delta=50000 * 0.1)
+        restored = DistinctCounter.from_dict(json.loads(json.dumps(large.to_dict())))
+        self.assertEqual(restored.estimate(), large.estimate())
+
+    def test_top_values(self):
+        top = TopValues(capacity=5)
+        for i in range(1000):
+            top.add("common" if i % 2 else f"rare-{i}")
+        self.assertEqual(top.top(1)[0][0], "common")
+        self.assertEqual(len(top.counts), 5)
+
+
+class TestFeedProfile(unittest.TestCase):
+    def test_report(self):
+        profile = FeedProfile()
+        for msg in feed(100):
+            profile.add(msg)
+        profile.add("not a message")
+        report = profile.report(top_k=3)
+
+        self.assertEqual(report["messages"], 100)
+        self.assertEqual(report["unparsed"], 1)
+        self.assertEqual(report["message_types"], {"ADT^A08": 100})
+
+        ids = element(report, "PID-3")
+        self.assertEqual((ids["datatype"], ids["filled"], ids["values"]), ("CX", 100, 150))
+        self.assertEqual(element(report, "PID-3.5")["top"], [("MR", 100), ("SS", 50)])
+        self.assertAlmostEqual(element(report, "PID-3.1")["distinct"], 100, delta=5)
+
+        visit = element(report, "PV1-19")
+        self.assertEqual(visit["fill_rate"], 0.75)
+        self.assertEqual(visit["max_length"], 3)
+
+        self.assertEqual(element(report, "PID-8")["table_violations"], 20)
+        self.assertEqual(element(report, "PID-7.1")["datatype_violations"], 10)
+        self.assertEqual(element(report, "MSH-2")["top"], [("^~\\&", 100)])
+
+    def test_merge_partial_profiles(self):
+        messages = list(feed(300))
+        whole = FeedProfile()
+        for msg in messages:
+            whole.add(msg)
+        merged = FeedProfile()
+        for start in range(0, 300, 70):
+            partial = FeedProfile()
+            for msg in messages[start:start + 70]:
+                partial.add(msg)
+            merged.merge(FeedProfile.from_dict(json.loads(json.dumps(partial.to_dict()))))
+        self.assertEqual(exact_parts(merged.report()), exact_parts(whole.report()))
+        self.assertEqual(merged.report()["message_types"], whole.report()["message_types"])
+
+    def test_unknown_versions_are_not_cached(self):
+        profile = FeedProfile()
+        before = profiler._load_constraints.cache_info().currsize
+        for i in range(50):
+            profile.add(f"MSH|^~\\&|A|B|C|D|20090601||ADT^A08|{i}|P|9.{i}\rPID|1||{i}")
+        self.assertEqual(profiler._load_constraints.cache_info().currsize, before)
+        self.assertEqual(profile.messages, 50)
+
+    def test_read_and_profile_in_parallel(self):
+        directory = tempfile.mkdtemp()
+        messages = list(feed(50))
+        with open(os.path.join(directory, "batch.hl7"), "w", newline="") as f:
+            f.write("FHS|^~\\&\r\n" + "\r\n".join(messages) + "\r\nFTS|1\r\n")
+        os.makedirs(os.path.join(directory, "more"))
+        with open(os.path.join(directory, "more", "single.hl7"), "w", newline="") as f:
+            f.write(messages[0])
+
+        read = list(read_messages([directory]))
+        self.assertEqual(read, messages + messages[:1])
+
+        serial = profile_feed(read).report()
+        parallel = profile_feed(iter(read), workers=2, batch_size=10).report()
+        self.assertEqual(exact_parts(parallel), exact_parts(serial))
+        self.assertEqual(parallel["messages"], 51)
+
+        output = os.path.join(directory, "profile.json")
+        main(["feed-profile", directory, "--workers", "1", "--top", "2", "-o", output])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report["messages"], 51)
+        self.assertEqual(element(report, "PID-3.5")["top"], [["MR", 51], ["SS", 25]])
+
+
+if __name__ == "__main__":
+    unittest.main()
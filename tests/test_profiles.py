@@ -0,0 +1,61 @@
+import unittest
+
+from hl7validator import app
+from hl7validator.api import hl7validatorapi, check_header, get_validation_profile
+
+
+MESSAGE = """MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4|||
+EVN|A60|200906011158|||I000007^INTERFACE^ADT^^^^^^M^^^^^LAMH
+PID||111987|111987||Wong^Amy^||19810902|F||2028-9|999 NINE AVE^^LONG BEACH^CA^90745^US^H||(562)555-0025^^M||ENG|M|BUD|LBACT0025|730-85-8464|||||||||||N
+PV1||O|ZBC||||7^SIMPSON^MARGE^|18^WIGGUM^RALPH^|2^MOUSE^M^|MED|||||||000819^LEE VOGT^JUDY^K|O|824477665||||||||||||||||||||SIMPSON CLINIC||N|||||||||210010404670
+"""
+
+
+class TestValidationProfiles(unittest.TestCase):
+    def test_header_profile(self):
+        response = hl7validatorapi(MESSAGE, validation_profile="header")
+        self.assertEqual(response["statusCode"], "Success")
+        self.assertEqual(response["hl7version"], "2.4")
+
+    def test_header_failures(self):
+        result, error = check_header("MSH|^~\\&|A|B|C|D|20090601||||P|2.4\r")
+        self.assertTrue(error)
+        self.assertEqual(result["message"], "[Error parsing message] No MSH9")
+        result, error = check_header("MSH|^~\\&|A|B|C|D|20090601||ADT^A01|1|P|9.9\r")
+        self.assertTrue(error)
+        self.assertIn("not supported", result["message"])
+        result, error = check_header("PID|1\r")
+        self.assertTrue(error)
+
+    def test_header_charset(self):
+        result, _ = check_header(
+            "MSH|^~\\&|A|B|C|D|20090601||ADT^A01|1|P|2.4||||||ASCII\rPID|||José\r"
+        )
+        self.assertEqual(result["details"][0]["message"], "Message is not ASCII encoded")
+
+    def test_profiles_agree_on_charset(self):
+        # without MSH-18 no character set is declared, so none is checked
+        msg = "MSH|^~\\&|A|B|C|D|20090601||ADT^A01|1|P|2.4\rPID|||José\r"
+        for profile in ("header", "parse-only", "structure", "full"):
+            details = hl7validatorapi(msg, validation_profile=profile)["details"]
+            self.assertNotIn(
+                "Message is not ASCII encoded", [d["message"] for d in details], profile
+            )
+
+    def test_profiles_run_increasing_stages(self):
+        structure = hl7validatorapi(MESSAGE, validation_profile="structure")
+        full = hl7validatorapi(MESSAGE, validation_profile="full")
+        self.assertEqual(structure["warnings"], [])
+        for detail in structure["details"]:
+            self.assertIn(detail, full["details"])
+
+    def test_full_is_default(self):
+        self.assertEqual(hl7validatorapi(MESSAGE), hl7validatorapi(MESSAGE, validation_profile="full"))
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            get_validation_profile("everything")
+        response = app.test_client().post(
+            "/api/hl7/v1/validate/", json={"data": MESSAGE, "validation_profile": "everything"}
+        )
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+from hl7validator import app
+from hl7validator.ratelimit import (
+    BULK,
+    INTERACTIVE,
+    MemoryBackend,
+    RateLimiter,
+    SQLiteBackend,
+    client_id,
+    parse_limit,
+)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit("5/20"), (5.0, 20.0))
+        self.assertEqual(parse_limit("3"), (3.0, 3.0))
+        self.assertEqual(parse_limit({"rate": 1, "burst": 4}), (1.0, 4.0))
+
+    def test_token_bucket_refills(self):
+        limiter = RateLimiter(rate=1, burst=2)
+        self.assertTrue(limiter.check_rate("ip:a", now=100)[0])
+        self.assertTrue(limiter.check_rate("ip:a", now=100)[0])
+        allowed, retry_after = limiter.check_rate("ip:a", now=100)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 1.0)
+        # other clients have their own bucket
+        self.assertTrue(limiter.check_rate("ip:b", now=100)[0])
+        self.assertTrue(limiter.check_rate("ip:a", now=101)[0])
+
+    def test_overrides_per_api_key(self):
+        limiter = RateLimiter(rate=1, burst=1, overrides={"key:batch": "0"})
+        for _ in range(10):
+            self.assertTrue(limiter.check_rate("key:batch", now=0)[0])
+
+    def test_only_known_api_keys_identify_clients(self):
+        overrides = {"key:batch": "0"}
+        self.assertEqual(client_id("batch", "10.0.0.1", overrides), "key:batch")
+        self.assertEqual(client_id("made-up", "10.0.0.1", overrides), "ip:10.0.0.1")
+        self.assertEqual(client_id(None, None, overrides), "ip:unknown")
+
+    def test_idle_buckets_expire(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sqlite = SQLiteBackend(os.path.join(tmp, "limits.db"))
+            for backend, keys in (
+                (MemoryBackend(), lambda b: set(b._buckets)),
+                (sqlite, lambda b: {k for (k,) in b._connect().execute("SELECT key FROM buckets")}),
+            ):
+                limiter = RateLimiter(rate=1, burst=2, backend=backend, expire_interval=10)
+                limiter.check_rate("ip:a", now=100)
+                limiter.check_rate("ip:b", now=109)
+                self.assertEqual(keys(backend), {"ip:a", "ip:b"})
+                # the next sweep drops the buckets idle long enough to be full again
+                limiter.check_rate("ip:c", now=110)
+                self.assertEqual(keys(backend), {"ip:b", "ip:c"})
+
+    def test_concurrency_pools_are_separate(self):
+        limiter = RateLimiter(concurrency={INTERACTIVE: 1, BULK: 1})
+        self.assertTrue(limiter.admit("ip:a", BULK)[0])
+        self.assertEqual(limiter.admit("ip:a", BULK)[:2], (False, "concurrency"))
+        self.assertTrue(limiter.admit("ip:a", INTERACTIVE)[0])
+        limiter.release(BULK)
+        self.assertTrue(limiter.admit("ip:a", BULK)[0])
+        self.assertIn('reason="concurrency"', limiter.metrics())
+
+    def test_sqlite_backend_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "limits.db")
+            first, second = SQLiteBackend(path), SQLiteBackend(path)
+            self.assertTrue(first.take("ip:a", 1, 1, 100)[0])
+            self.assertFalse(second.take("ip:a", 1, 1, 100)[0])
+            first.incr("admitted:bulk")
+            second.incr("admitted:bulk")
+            self.assertEqual(first.counters(), {"admitted:bulk": 2})
+
+
+class TestRateLimitedAPI(unittest.TestCase):
+    def setUp(self):
+        self.limiter = app.extensions["hl7validator.ratelimit"]
+        self.saved = (self.limiter.rate, self.limiter.burst, self.limiter.backend)
+        self.limiter.rate, self.limiter.burst = 1, 1
+        self.limiter.backend = MemoryBackend()
+
+    def tearDown(self):
+        self.limiter.rate, self.limiter.burst, self.limiter.backend = self.saved
+
+    def test_api_returns_429(self):
+        client = app.test_client()
+        headers = {"X-API-Key": "test-client"}
+        client.post("/api/hl7/v1/validate/", json={"data": ""}, headers=headers)
+        response = client.post("/api/hl7/v1/validate/", json={"data": ""}, headers=headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+        # pages are not limited
+        self.assertEqual(client.get("/docs").status_code, 302)
+        self.assertIn('pool="bulk",reason="rate_limit"', client.get("/metrics").get_data(as_text=True))
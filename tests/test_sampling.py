@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator.core import Validator
+from hl7validator.sampling import SamplingPolicy, SamplingRule, msh_fields
+
+
+def feed_message(control_id, sender="EPIC", message_type="ADT^A08^ADT_A01", valid=True):
+    return (
+        f"MSH|^~\\&|{sender}|LAMH|KEANE|KEANE|20090601115851||{message_type}|{control_id}|P|2.5\r"
+        "EVN|A08|200906011158\r"
+        + ("PID|1||111987^^^LAMH^MR||Wong^Amy\rPV1|1|I\r" if valid else "PV1|1|I\rPV1|1|I\r")
+    )
+
+
+class TestSamplingPolicy(unittest.TestCase):
+    def test_msh_fields(self):
+        fields, separator = msh_fields("MSH|^~\\&|EPIC^1|LAMH|||||ADT^A08|42|P|2.5\nPID|1")
+        self.assertEqual(fields, {3: "EPIC^1", 4: "LAMH", 9: "ADT^A08", 10: "42"})
+        self.assertEqual(separator, "^")
+        self.assertEqual(msh_fields("PID|1")[0], {})
+
+    def test_rules(self):
+        policy = SamplingPolicy(10, [
+            SamplingRule.parse("MSH-3=EPIC", 100),
+            SamplingRule.parse("MSH-3=EPIC,MSH-9=ADT^A08", 20),
+            SamplingRule.parse("MSH-9=ORU", 1),
+        ])
+        rate = lambda msg: policy.rate(*msh_fields(msg))
+        self.assertEqual(rate(feed_message(1)), 20)
+        self.assertEqual(rate(feed_message(1, message_type="ADT^A01")), 100)
+        self.assertEqual(rate(feed_message(1, sender="LAB", message_type="ORU^R01")), 1)
+        self.assertEqual(rate(feed_message(1, sender="LAB")), 10)
+        with self.assertRaises(ValueError):
+            SamplingRule.parse("PID-3=123", 10)
+
+    def test_deterministic_one_in_n(self):
+        policy = SamplingPolicy(10)
+        messages = [feed_message(i) for i in range(5000)]
+        decisions = [policy.decide(msg)[0] for msg in messages]
+        self.assertEqual(decisions, [SamplingPolicy(10).decide(msg)[0] for msg in messages])
+        self.assertAlmostEqual(sum(decisions) / len(decisions), 0.1, delta=0.02)
+        self.assertTrue(all(SamplingPolicy(1).decide(msg)[0] for msg in messages[:10]))
+
+    def test_from_env(self):
+        with mock.patch.dict(os.environ, {"HL7VALIDATOR_SAMPLE_ONE_IN": "1"}):
+            self.assertIsNone(SamplingPolicy.from_env())
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"MSH-4=LAMH": 50}, f)
+        self.addCleanup(os.remove, f.name)
+        with mock.patch.dict(os.environ, {"HL7VALIDATOR_SAMPLING_RULES": f.name}):
+            policy = SamplingPolicy.from_env()
+        self.assertEqual(policy.rate(*msh_fields(feed_message(1))), 50)
+
+
+class TestSampledValidation(unittest.TestCase):
+    def test_extrapolated_stats(self):
+        validator = Validator(cache_size=256, sampling=SamplingPolicy(4))
+        results = [
+            validator.validate_sampled(feed_message(i, valid=i % 2 == 0)) for i in range(200)
+        ]
+        sampled = [result for result in results if result["sampled"]]
+        self.assertTrue(0 < len(sampled) < 200)
+        # outside the sample only the header is checked
+        self.assertTrue(all(r["statusCode"] == "Success" for r in results if not r["sampled"]))
+        self.assertTrue(any(r["statusCode"] == "Failed" for r in sampled))
+
+        [group] = validator.sampling.stats.snapshot()
+        self.assertEqual(
+            (group["sender"], group["facility"], group["message_type"]), ("EPIC", "LAMH", "ADT^A08")
+        )
+        self.assertEqual(group["seen"], 200)
+        self.assertEqual(group["sampled"], len(sampled))
+        self.assertLessEqual(group["error_rate_low"], group["error_rate"])
+        self.assertLessEqual(group["error_rate"], group["error_rate_high"])
+        self.assertLess(group["error_rate_low"], 0.5)
+        self.assertGreater(group["error_rate_high"], 0.5)
+        self.assertEqual(group["estimated_failed"], round(group["error_rate"] * 200))
+        self.assertIn(
+            'hl7validator_sampling_messages_total{sender="EPIC",facility="LAMH",message_type="ADT^A08"} 200',
+            validator.sampling.metrics(),
+        )
+
+    def test_without_sampling(self):
+        validator = Validator(cache_size=64)
+        self.assertIsNone(validator.sampling)
+        result = validator.validate_sampled(feed_message(1, valid=False))
+        self.assertEqual(result["statusCode"], "Failed")
+        self.assertNotIn("sampled", result)
+
+
+if __name__ == "__main__":
+    unittest.main()
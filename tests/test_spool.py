@@ -0,0 +1,182 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from hl7validator.__main__ import main
+from hl7validator.codec import decode_er7
+from hl7validator.pool import ValidationPool
+from hl7validator.sampling import SamplingPolicy
+from hl7validator.spool import Spool, split_messages
+
+
+MESSAGE = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851|I000007|ADT^A60|AWONG-0025|P|2.4|||\r"
+    "EVN|A60|200906011158|||I000007^INTERFACE^ADT^^^^^^M^^^^^LAMH\r"
+    "PID||111987|111987||Wong^Amy^||19810902|F||2028-9|999 NINE AVE^^LONG BEACH^CA^90745^US^H\r"
+)
+
+INVALID_MESSAGE = (
+    "MSH|^~\\&|ADT1|GOOD HEALTH HOSPITAL|GHH LAB, INC.|GOOD HEALTH HOSPITAL|198808181126|SECURITY|"
+    "ADT^A01^ADT_A01|MSG00001|P|2.8||\r"
+    "EVN|A01|200708181123||\r"
+    "PV1|1|I\r"
+)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.spool = Spool(self.root, pool=ValidationPool(max_workers=2), batch_size=3)
+        self.addCleanup(self.spool.close)
+
+    def drop(self, name, content):
+        path = os.path.join(self.spool.inbox, name)
+        with open(path, "w", newline="") as f:
+            f.write(content)
+        return path
+
+    def report(self, directory, name):
+        with open(os.path.join(directory, name + ".json")) as f:
+            return json.load(f)
+
+    def test_split_messages(self):
+        batch = "FHS|^~\\&\nBHS|^~\\&\n" + MESSAGE + "\n" + INVALID_MESSAGE + "BTS|2\nFTS|1\n"
+        self.assertEqual(
+            split_messages(batch), [MESSAGE.rstrip("\r"), INVALID_MESSAGE.rstrip("\r")]
+        )
+        self.assertEqual(split_messages("\x0b" + MESSAGE + "\x1c\r"), [MESSAGE.rstrip("\r")])
+        self.assertEqual(split_messages("PID|1"), ["PID|1"])
+        self.assertEqual(split_messages("\n\n"), [])
+
+    def test_processes_files_in_batches(self):
+        for i in range(4):
+            self.drop(f"valid-{i}.hl7", MESSAGE.replace("\r", "\n"))
+        self.drop("invalid.hl7", INVALID_MESSAGE)
+        self.drop("both.hl7", MESSAGE + INVALID_MESSAGE)
+        self.drop("empty.hl7", "")
+        self.drop(".hidden.hl7", MESSAGE)
+        self.drop("upload.hl7.part", MESSAGE)
+
+        processed = []
+        while True:
+            count = self.spool.run_once()
+            if not count:
+                break
+            self.assertLessEqual(count, 3)
+            processed.append(count)
+        self.assertEqual(sum(processed), 7)
+
+        self.assertEqual(sorted(os.listdir(self.spool.inbox)), [".hidden.hl7", "upload.hl7.part"])
+        self.assertEqual(os.listdir(self.spool.work), [])
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.spool.done) if name.endswith(".hl7")),
+            [f"valid-{i}.hl7" for i in range(4)],
+        )
+        report = self.report(self.spool.done, "valid-0.hl7")
+        self.assertEqual(report["statusCode"], "Success")
+        self.assertEqual(len(report["messages"]), 1)
+        self.assertEqual(report["messages"][0]["hl7version"], "2.4")
+
+        both = self.report(self.spool.failed, "both.hl7")
+        self.assertEqual(both["statusCode"], "Failed")
+        self.assertEqual(
+            [result["statusCode"] for result in both["messages"]], ["Success", "Failed"]
+        )
+        self.assertEqual(self.report(self.spool.failed, "empty.hl7")["messages"][0]["message"], "No Content")
+        self.assertEqual(self.spool.stats()["processed"], 7)
+        self.assertEqual(self.spool.stats()["failed"], 3)
+
+    def test_recovers_files_left_in_work(self):
+        with open(os.path.join(self.spool.work, "crashed.hl7"), "w") as f:
+            f.write(MESSAGE)
+        self.drop("new.hl7", MESSAGE)
+        self.assertEqual(self.spool.run_once(), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.spool.done, "crashed.hl7")))
+        self.assertTrue(os.path.exists(os.path.join(self.spool.inbox, "new.hl7")))
+        self.assertEqual(self.spool.run_once(), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.spool.done, "new.hl7")))
+
+    def test_results_directory_and_name_clashes(self):
+        results = os.path.join(self.root, "results")
+        spool = Spool(self.root, pool=self.spool.pool, results=results)
+        self.drop("same.hl7", MESSAGE)
+        spool.run_once()
+        self.drop("same.hl7", MESSAGE)
+        spool.run_once()
+        self.drop("same.hl7", INVALID_MESSAGE)
+        spool.run_once()
+        self.assertEqual(sorted(os.listdir(spool.done)), ["same.1.hl7", "same.hl7"])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(results, "done"))), ["same.1.hl7.json", "same.hl7.json"]
+        )
+        # failed/same.hl7 does not overwrite the result of done/same.hl7
+        failed = self.report(os.path.join(results, "failed"), "same.hl7")
+        self.assertEqual(failed["statusCode"], "Failed")
+        done = self.report(os.path.join(results, "done"), "same.hl7")
+        self.assertEqual(done["statusCode"], "Success")
+
+    def test_unprocessable_files_go_to_failed(self):
+        self.drop("broken.hl7", "BROKEN")
+        self.drop("valid.hl7", MESSAGE)
+
+        def decode(body):
+            if body == b"BROKEN":
+                raise ValueError("cannot decode")
+            return decode_er7(body)
+
+        with mock.patch("hl7validator.spool.decode_er7", decode):
+            self.assertEqual(self.spool.run_once(), 2)
+        self.assertEqual(os.listdir(self.spool.work), [])
+        self.assertTrue(os.path.exists(os.path.join(self.spool.done, "valid.hl7")))
+        report = self.report(self.spool.failed, "broken.hl7")
+        self.assertEqual(report["messages"][0]["message"], "Error processing file: cannot decode")
+        self.assertEqual(self.spool.stats()["failed"], 1)
+
+    def test_files_removed_while_scanning_are_skipped(self):
+        entry = mock.Mock(is_file=mock.Mock(side_effect=FileNotFoundError()))
+        entry.name = "gone.hl7"
+        self.assertIsNone(self.spool._ready(entry))
+
+    def test_sampling(self):
+        spool = Spool(self.root, pool=self.spool.pool, sampling=SamplingPolicy(1000))
+        self.drop("feed.hl7", INVALID_MESSAGE * 20)
+        spool.run_once()
+        results = self.report(spool.done, "feed.hl7")["messages"]
+        # outside the sample only the header is checked, which this message passes
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(result["sampled"] is False for result in results))
+        self.assertEqual(spool.stats()["sampling"][0]["seen"], 20)
+
+    def test_settle(self):
+        spool = Spool(self.root, pool=self.spool.pool, settle=60)
+        path = self.drop("slow.hl7", MESSAGE)
+        self.assertEqual(spool.claim(), [])
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.assertEqual(len(spool.claim()), 1)
+
+    def test_serve_until_stopped(self):
+        thread = threading.Thread(target=self.spool.serve, kwargs={"poll_interval": 0.1})
+        thread.start()
+        try:
+            self.drop("live.hl7", MESSAGE)
+            deadline = time.monotonic() + 60
+            while not os.path.exists(os.path.join(self.spool.done, "live.hl7")):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+        finally:
+            self.spool.stop()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_command_line(self):
+        self.drop("cli.hl7", INVALID_MESSAGE)
+        main(["spool", self.root, "--once", "--workers", "1"])
+        self.assertEqual(self.report(self.spool.failed, "cli.hl7")["statusCode"], "Failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator import tables
+from hl7validator.api import hl7validatorapi
+from hl7validator.tables import SiteTables, table_findings
+
+
+MESSAGE = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy||19810902|Q||ZZ^^HL70005~2106-3^White^HL70005\r"
+    "PV1|1|I\r"
+)
+
+ENCODING_CHARS = {
+    "FIELD": "|", "COMPONENT": "^", "REPETITION": "~", "ESCAPE": "\\", "SUBCOMPONENT": "&",
+    "GROUP": "\r", "SEGMENT": "\r",
+}
+
+
+def warnings(result):
+    return [d["message"].strip() for d in result["details"] if d["level"] == "Warning"]
+
+
+class TestTables(unittest.TestCase):
+    def site(self, content, **kwargs):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "site.json")
+        with open(path, "w") as f:
+            json.dump(content, f)
+        return path, SiteTables([path], **kwargs)
+
+    def findings(self, site, msg=MESSAGE, version="2.5"):
+        return table_findings(msg, version, ENCODING_CHARS, site=site, cache=None)
+
+    def test_coded_identifier_is_checked(self):
+        findings, overridden = self.findings(SiteTables())
+        self.assertEqual(findings, ["Value ZZ not in table HL70005 in element PID.PID_10"])
+        self.assertEqual(overridden, frozenset())
+        # a code of another coding system is not looked up
+        findings, _ = self.findings(SiteTables(), MESSAGE.replace("ZZ^^HL70005", "ZZ^^LOCAL"))
+        self.assertEqual(findings, [])
+        # nor in versions without bundled tables
+        findings, _ = self.findings(SiteTables(), version="2.3")
+        self.assertEqual(findings, [])
+
+        result = hl7validatorapi(MESSAGE)
+        self.assertEqual(result["statusCode"], "Success")
+        self.assertIn("Value ZZ not in table HL70005 in element PID.PID_10", warnings(result))
+        self.assertIn("Value Q not in table HL70001 in element PID.PID_8", warnings(result))
+
+    def test_site_tables_replace_engine_findings(self):
+        _, site = self.site({"HL70001": {"add": ["Q"]}, "HL70005": ["ZZ", "2106-3"]})
+        self.assertEqual(self.findings(site), ([], frozenset(["HL70001", "HL70005"])))
+        _, site = self.site({"HL70001": ["F", "M"]})
+        findings, _ = self.findings(site)
+        self.assertIn("Value Q not in table HL70001 in element PID.PID_8", findings)
+
+        _, site = self.site({"HL70001": {"add": ["Q"]}})
+        with mock.patch.object(tables, "site_tables", site):
+            result = hl7validatorapi(MESSAGE)
+            self.assertNotIn("Value Q not in table HL70001 in element PID.PID_8", warnings(result))
+            self.assertEqual(hl7validatorapi(MESSAGE, engine="hl7apy")["details"], result["details"])
+
+    def test_version_sections(self):
+        _, site = self.site({"2.4": {"HL70001": {"add": ["Q"]}}, "2.5": {"HL70001": ["Q"]}})
+        tables_25, overridden = site.index("2.5")
+        self.assertEqual(tables_25["HL70001"], frozenset(["Q"]))
+        self.assertEqual(overridden, frozenset(["HL70001"]))
+        self.assertIn("F", site.index("2.4")[0]["HL70001"])
+        self.assertEqual(site.index("2.6")[1], frozenset())
+
+    def test_files_are_reloaded(self):
+        path, site = self.site({"HL70005": ["ZZ"]}, check_interval=0)
+        self.assertEqual(self.findings(site)[0], [
+            "Value 2106-3 not in table HL70005 in element PID.PID_10"
+        ])
+        generation = site.generation
+        with open(path, "w") as f:
+            json.dump({"HL70005": ["ZZ", "2106-3", "2028-9"]}, f)
+        self.assertEqual(self.findings(site)[0], [])
+        self.assertEqual(site.generation, generation + 1)
+
+        # a broken file keeps the tables loaded last
+        with open(path, "w") as f:
+            f.write("{")
+        with self.assertLogs("hl7validator", "ERROR"):
+            self.assertEqual(self.findings(site)[0], [])
+        self.assertEqual(site.generation, generation + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
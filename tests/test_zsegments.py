@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from hl7validator import zsegments
+from hl7validator.api import (
+    build_tree_structure,
+    highlight_message,
+    hl7validatorapi,
+    hl7validatorapi_incremental,
+)
+from hl7validator.constraints import Unsupported, check_segment
+from hl7validator.zsegments import SegmentRegistry
+
+
+ENCODING_CHARS = {
+    "FIELD": "|", "COMPONENT": "^", "SUBCOMPONENT": "&", "REPETITION": "~", "ESCAPE": "\\",
+    "SEGMENT": "\r", "GROUP": "\r",
+}
+
+DEFINITIONS = {
+    "ZPI": {
+        "long_name": "Patient insurance extension",
+        "fields": [
+            {"name": "Set ID", "datatype": "SI", "required": True},
+            {"name": "Plan", "datatype": "CWE", "repeats": True},
+            {"name": "Effective date", "datatype": "DT", "max_length": 8},
+            {"name": "Sex", "datatype": "IS", "table": "HL70001"},
+        ],
+    },
+    "ZLV": {"versions": ["2.4"], "fields": [{"name": "Level"}]},
+}
+
+ADT = (
+    "MSH|^~\\&|EPIC|LAMH|KEANE|KEANE|20090601115851||ADT^A08^ADT_A01|1|P|2.5\r"
+    "EVN|A08|200906011158\r"
+    "PID|1||111987^^^LAMH^MR||Wong^Amy\r"
+    "PV1|1|I\r"
+    "ZPI||ABC^DEF~X|2020010112|Q\r"
+)
+
+FINDINGS = [
+    ("Error", "Missing required child ZPI.ZPI_1"),
+    ("Warning", "Exceeded max length (8) of ZPI.ZPI_3"),
+    ("Warning", "Value Q not in table HL70001 in element ZPI.ZPI_4"),
+]
+
+
+def findings(result):
+    return sorted((d["level"], d["message"].strip()) for d in result["details"])
+
+
+class TestCustomSegments(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(zsegments, "registry", SegmentRegistry(DEFINITIONS))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_definitions_compile_into_the_constraint_tables(self):
+        report = check_segment("ZPI||ABC^DEF~X|2020010112|Q", "2.5", ENCODING_CHARS)
+        self.assertEqual(sorted(report.errors + report.warnings), sorted(m for _, m in FINDINGS))
+        report = check_segment("ZPI|1|ABC|20200101|F|extra", "2.5", ENCODING_CHARS)
+        self.assertEqual(report.errors, ["Invalid children detected for <Segment ZPI>: [None]"])
+        # outside their versions, and undefined segments, are left to hl7apy
+        self.assertEqual(check_segment("ZLV|1", "2.4", ENCODING_CHARS).errors, [])
+        for segment, version in (("ZLV|1", "2.5"), ("ZAL|1", "2.5")):
+            with self.assertRaises(Unsupported):
+                check_segment(segment, version, ENCODING_CHARS)
+
+    def test_engines_validate_custom_segments(self):
+        # hl7apy cannot place the trailing ZPI in the ADT_A01 structure
+        self.assertEqual(findings(hl7validatorapi(ADT)), FINDINGS)
+        self.assertEqual(findings(hl7validatorapi(ADT, engine="hl7apy")), FINDINGS)
+        self.assertEqual(findings(hl7validatorapi_incremental(ADT)), FINDINGS)
+        valid = ADT.replace("ZPI||ABC^DEF~X|2020010112|Q", "ZPI|1|ABC^DEF~X|20200101|F")
+        self.assertEqual(hl7validatorapi(valid)["statusCode"], "Success")
+
+        # registering again invalidates the cached results
+        zsegments.registry.register({"ZPI": {"fields": [{"name": "Set ID"}]}})
+        result = hl7validatorapi(ADT)
+        self.assertNotIn(("Error", "Missing required child ZPI.ZPI_1"), findings(result))
+
+    def test_renderers_use_the_definitions(self):
+        result = hl7validatorapi(ADT)
+        with self.assertNoLogs("hl7validator", "WARNING"):
+            html, result = highlight_message(ADT, result)
+        self.assertEqual(result["warnings"], [])
+        self.assertIn('<span class="tooltiptext">Plan</span><span class="note">ZPI-2</span>', html)
+        self.assertIn('title="Patient insurance extension">ZPI</a>', html)
+        self.assertIn("Invalid date format on field ZPI.ZPI_3", [d["message"] for d in result["details"]])
+        tree, _ = build_tree_structure(ADT, hl7validatorapi(ADT))
+        self.assertIn("Plan (CWE)", tree)
+        self.assertIn("Identifier (ST)", tree)
+        self.assertIn('<span class="node-name">Patient insurance extension</span>', tree)
+
+    def test_loading_definitions(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "site.json"), "w") as f:
+            json.dump(DEFINITIONS, f)
+        with open(os.path.join(directory, "broken.json"), "w") as f:
+            json.dump({"zpi": {"fields": []}}, f)
+        with mock.patch.dict(os.environ, {"HL7VALIDATOR_SEGMENTS": directory}):
+            with self.assertLogs("hl7validator", "ERROR"):
+                registry = SegmentRegistry.from_env()
+        self.assertEqual(registry.names(), ["ZLV", "ZPI"])
+        self.assertEqual(registry.reference("ZPI", "2.5")[1][1][1][2], "CWE")
+
+        with self.assertRaisesRegex(ValueError, "Invalid long_name"):
+            registry.register({"ZXX": {"long_name": 1, "fields": []}})
+        with self.assertRaisesRegex(ValueError, "needs a name"):
+            registry.register({"ZXX": {"fields": [{"datatype": "ST"}]}})
+        self.assertNotIn("ZXX", registry)
+        registry.register({
+            "PID": {"fields": []}, "ZXY": {"fields": [{"name": "A", "datatype": "NOPE"}]},
+        })
+        with self.assertLogs("hl7validator", "WARNING"):
+            self.assertIsNone(registry.reference("PID", "2.5"))
+        with self.assertLogs("hl7validator", "ERROR"):
+            self.assertIsNone(registry.reference("ZXY", "2.5"))
+
+
+if __name__ == "__main__":
+    unittest.main()